@@ -0,0 +1,214 @@
+# Диспетчер микро-пакетов для одиночных прогнозов
+
+# Каждый вызов модели имеет фиксированные накладные расходы,
+# поэтому одиночные запросы к /api/forward выгоднее считать пачкой.
+
+# Логика работы:
+# 1. forward_prediction кладет строку в очередь и ждет свой future
+# 2. Фоновая задача забирает первую строку и добирает остальные,
+#    пока не наберется MICROBATCH_MAX_SIZE строк или не пройдет MICROBATCH_MAX_WAIT_MS
+# 3. Пакет считается одним вызовом predict_proba в пуле InferenceExecutor (вне event loop)
+# 4. Каждый future получает вероятность (или ошибку) своей строки
+
+# Пока все воркеры пула заняты, новый пакет не собирается и строки копятся в очереди,
+# поэтому под нагрузкой пакеты автоматически становятся крупнее
+
+# Метрики для подбора параметров:
+# - microbatch_size - распределение размеров пакетов
+# - microbatch_queue_delay_seconds - время ожидания строки в очереди
+# - microbatch_inference_seconds - время вызова модели на пакет
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+from api.config import MICROBATCH_MAX_SIZE, MICROBATCH_MAX_WAIT_MS
+from api.dependencies import LoadedModel
+from api.inference import InferenceExecutor, inference_executor
+from api.metrics import SIZE_BUCKETS, metrics
+
+
+class PredictionError(Exception):
+    """Модель не смогла обработать строку"""
+
+
+@dataclass
+class _PendingRow:
+    """Строка в очереди диспетчера"""
+    loaded: LoadedModel
+    row: list
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class MicroBatcher:
+    """
+    Собирает конкурентные одиночные запросы в пакеты
+
+    Args:
+        executor: пул для вызова модели
+        max_batch_size: максимальный размер пакета
+        max_wait_ms: сколько ждать добора пакета после первой строки
+    """
+
+    def __init__(
+        self,
+        executor: InferenceExecutor = inference_executor,
+        max_batch_size: int = MICROBATCH_MAX_SIZE,
+        max_wait_ms: float = MICROBATCH_MAX_WAIT_MS
+    ):
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._free_workers: Optional[asyncio.Semaphore] = None
+        # Пакет, который собирается в данный момент
+        self._collecting: List[_PendingRow] = []
+
+        self._batch_size = metrics.histogram("microbatch_size", SIZE_BUCKETS)
+        self._queue_delay = metrics.histogram("microbatch_queue_delay_seconds")
+        self._inference_time = metrics.histogram("microbatch_inference_seconds")
+        self._queue_depth = metrics.gauge("microbatch_queue_depth")
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.running:
+            self._queue = asyncio.Queue()
+            self._free_workers = asyncio.Semaphore(self.executor.max_workers)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Дожидаемся пакетов, которые уже считаются
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+        # Строки, которые не успели попасть в пакет, считаем сразу
+        pending, self._collecting = self._collecting, []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        if pending:
+            await self._dispatch(pending)
+
+    async def submit(self, loaded: LoadedModel, row: list) -> float:
+        """
+        Поставить строку в очередь и дождаться вероятности
+
+        Args:
+            loaded: снимок модели, которой нужно посчитать строку
+            row: значения в порядке столбцов схемы loaded.schema
+
+        Raises:
+            PredictionError: модель не смогла обработать строку
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = _PendingRow(loaded=loaded, row=row, future=future)
+
+        if not self.running:
+            # Диспетчер не запущен (например, без lifespan) - считаем сразу
+            await self._dispatch([item])
+        else:
+            self._queue.put_nowait(item)
+            self._queue_depth.set(self._queue.qsize())
+
+        return await future
+
+    async def _collect(self) -> List[_PendingRow]:
+        """Дождаться первой строки и добрать пакет по размеру или по времени"""
+        batch = self._collecting = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Сначала забираем все, что уже лежит в очереди
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        self._queue_depth.set(self._queue.qsize())
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            # Новый пакет собираем только когда есть свободный воркер
+            await self._free_workers.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._free_workers.release()
+                raise
+
+            self._collecting = []
+            task = asyncio.create_task(self._dispatch_safe(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._on_dispatched)
+
+    def _on_dispatched(self, task: asyncio.Task) -> None:
+        self._in_flight.discard(task)
+        self._free_workers.release()
+
+    async def _dispatch_safe(self, batch: List[_PendingRow]) -> None:
+        try:
+            await self._dispatch(batch)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(PredictionError(str(e)))
+
+    async def _dispatch(self, batch: List[_PendingRow]) -> None:
+        """Посчитать пакет и раздать результаты по future"""
+        started = time.perf_counter()
+        self._batch_size.observe(len(batch))
+        for item in batch:
+            self._queue_delay.observe(started - item.enqueued_at)
+
+        # Во время горячей замены в пакете могут оказаться строки для разных моделей
+        groups = {}
+        for item in batch:
+            groups.setdefault(id(item.loaded), []).append(item)
+
+        for items in groups.values():
+            rows = [item.row for item in items]
+            probabilities, errors = await self.executor.run(items[0].loaded, rows)
+
+            for pos, item in enumerate(items):
+                # Клиент мог отключиться, пока строка ждала в очереди
+                if item.future.done():
+                    continue
+                if pos in errors:
+                    item.future.set_exception(PredictionError(errors[pos]))
+                else:
+                    item.future.set_result(float(probabilities[pos]))
+
+        self._inference_time.observe(time.perf_counter() - started)
+
+
+# Диспетчер на весь процесс
+micro_batcher = MicroBatcher()
+
+
+def get_micro_batcher() -> MicroBatcher:
+    """Зависимость FastAPI: диспетчер микро-пакетов"""
+    return micro_batcher
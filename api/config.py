@@ -0,0 +1,91 @@
+# Настройки сервиса
+
+# Этот модуль собирает в одном месте параметры, которые можно
+# переопределить через переменные окружения:
+# - Пути к модели и списку переменных
+# - Параметры горячей замены модели
+# - Ограничения пакетного прогноза
+# - Параметры микро-пакетов
+# - Пул для вызова модели
+# - Порог бинарного прогноза
+# - Отложенная запись истории
+# - Постраничная выдача истории
+# - Настройки SQLite и архивирование истории
+# - Онлайн-хранилище признаков по картам
+
+import os
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Модель и переменные
+MODEL_PATH = Path(os.getenv("MODEL_PATH", BASE_DIR / "models" / "final_model.cbm"))
+FEATURES_PATH = Path(os.getenv("FEATURES_PATH", BASE_DIR / "models" / "params" / "features.yaml"))
+
+# Как часто (в секундах) проверять, не появился ли новый .cbm файл.
+# 0 - отключить отслеживание
+MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "5"))
+
+# Максимальное количество строк в одном запросе /api/forward/batch
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "10000"))
+
+# Микро-пакеты для одиночных запросов /api/forward:
+# максимальный размер пакета и сколько миллисекунд ждать его добора
+MICROBATCH_MAX_SIZE = int(os.getenv("MICROBATCH_MAX_SIZE", "64"))
+MICROBATCH_MAX_WAIT_MS = float(os.getenv("MICROBATCH_MAX_WAIT_MS", "2"))
+
+# Пул для вызова модели вне event loop:
+# тип пула ("thread" или "process"), количество воркеров
+# и сколько пакетов может ждать свободного воркера
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "32"))
+
+# Потоки CatBoost на один вызов модели. По умолчанию ядра делятся поровну
+# между воркерами пула, чтобы не получить переподписку процессора
+CATBOOST_THREAD_COUNT = int(
+    os.getenv("CATBOOST_THREAD_COUNT", max(1, (os.cpu_count() or 1) // max(1, INFERENCE_WORKERS)))
+)
+
+# Как часто (в секундах) измерять задержку event loop
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+# Порог вероятности для бинарного прогноза: класс 1 при вероятности > порога
+PREDICTION_THRESHOLD = float(os.getenv("PREDICTION_THRESHOLD", "0.5"))
+
+# Отложенная запись истории предсказаний:
+# размер очереди, как часто (мс) и какими пачками (строк) сбрасывать ее в БД
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "10000"))
+HISTORY_FLUSH_INTERVAL_MS = float(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "200"))
+HISTORY_FLUSH_MAX_ROWS = int(os.getenv("HISTORY_FLUSH_MAX_ROWS", "500"))
+
+# Что делать при переполнении очереди:
+# "block" - ждать места, "drop_oldest" - вытеснять самые старые записи,
+# "spill" - дописывать записи в локальный файл HISTORY_SPILL_PATH
+HISTORY_OVERFLOW_POLICY = os.getenv("HISTORY_OVERFLOW_POLICY", "block")
+HISTORY_SPILL_PATH = Path(os.getenv("HISTORY_SPILL_PATH", BASE_DIR / "data" / "history_spill.jsonl"))
+
+# Размер страницы GET /api/history по умолчанию и максимальный
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+HISTORY_PAGE_MAX_SIZE = int(os.getenv("HISTORY_PAGE_MAX_SIZE", "1000"))
+
+# SQLite: режим синхронизации журнала (NORMAL безопасен в режиме WAL),
+# размер кеша страниц (КБ) на соединение, сколько ждать блокировку записи (мс)
+# и количество соединений для чтения
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "5"))
+
+# Архивирование истории: записи старше HISTORY_RETENTION_DAYS дней переносятся
+# в сжатые Parquet файлы (по дням) в HISTORY_ARCHIVE_DIR.
+# 0 - не архивировать
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "30"))
+HISTORY_ARCHIVE_DIR = Path(os.getenv("HISTORY_ARCHIVE_DIR", BASE_DIR / "data" / "history_archive"))
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv("HISTORY_ARCHIVE_INTERVAL", "3600"))
+HISTORY_ARCHIVE_CHUNK_ROWS = int(os.getenv("HISTORY_ARCHIVE_CHUNK_ROWS", "50000"))
+HISTORY_ARCHIVE_COMPRESSION = os.getenv("HISTORY_ARCHIVE_COMPRESSION", "zstd")
+
+# Онлайн-хранилище признаков по картам (card1): сколько карт держать в памяти.
+# При превышении вытесняются карты, по которым дольше всего не было транзакций
+FEATURE_STORE_MAX_CARDS = int(os.getenv("FEATURE_STORE_MAX_CARDS", "1000000"))
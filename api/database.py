@@ -1,34 +1,76 @@
 # Конфигурация базы данных и управление сессиями
 
 # Этот модуль обрабатывает:
-# - Создание асинхронного движка
+# - Создание асинхронных движков
 # - Настройка фабрики сессий
 # - Внедрение зависимостей для сессий
 # - Инициализация базы данных
 
+# SQLite работает в режиме WAL: читатели не блокируют писателя и друг друга.
+# Поэтому движков два:
+# - engine - пул соединений для чтения (эндпоинты истории), только чтение
+# - writer_engine - одно соединение для записи (history_writer, архивирование, миграции),
+#   чтобы записи не конкурировали за блокировку файла
+
 from typing import AsyncGenerator
 from pathlib import Path
+from sqlalchemy import event, inspect, text
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
     AsyncSession,
     async_sessionmaker,
     AsyncEngine
 )
-from .models import Base
+from .config import (
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_READ_POOL_SIZE,
+    SQLITE_SYNCHRONOUS,
+)
+from .models import Base, PredictionHistory
 
 # Асинхронная строка подключения SQLite
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATABASE_URL = f"sqlite+aiosqlite:///{BASE_DIR}/prediction_history.db"
 
-# Создание асинхронного движка
-engine: AsyncEngine = create_async_engine(
-    DATABASE_URL,
-    echo=False,  # True для логирования SQL запросов
-    future=True,  # Использовать стиль SQLAlchemy 2.0
-    pool_pre_ping=True  # Проверять соединение перед использованием
-)
 
-# Фабрика асинхронных сессий
+def _configure_connection(dbapi_connection, read_only: bool) -> None:
+    """Настройки SQLite для каждого нового соединения"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    # Отрицательное значение - размер кеша в КБ, а не в страницах
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def _create_engine(pool_size: int, read_only: bool) -> AsyncEngine:
+    new_engine = create_async_engine(
+        DATABASE_URL,
+        echo=False,  # True для логирования SQL запросов
+        future=True,  # Использовать стиль SQLAlchemy 2.0
+        pool_size=pool_size,
+        max_overflow=0
+    )
+
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        _configure_connection(dbapi_connection, read_only)
+
+    return new_engine
+
+
+# Движок для чтения
+engine: AsyncEngine = _create_engine(SQLITE_READ_POOL_SIZE, read_only=True)
+
+# Движок для записи: одно соединение
+writer_engine: AsyncEngine = _create_engine(1, read_only=False)
+
+# Фабрика асинхронных сессий для чтения
 AsyncSessionLocal = async_sessionmaker(
     engine,
     class_=AsyncSession,
@@ -37,6 +79,15 @@ AsyncSessionLocal = async_sessionmaker(
     autoflush=False
 )
 
+# Фабрика асинхронных сессий для записи
+WriterSessionLocal = async_sessionmaker(
+    writer_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+    autocommit=False,
+    autoflush=False
+)
+
 
 # Зависимость БД
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
@@ -62,12 +113,42 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
             await session.close()
 
 
+def _migrate(sync_conn) -> None:
+    """
+    Добавить в существующую таблицу истории столбцы, появившиеся позже
+
+    create_all не изменяет уже созданные таблицы, поэтому недостающие столбцы
+    добавляются через ALTER TABLE, а затем создаются их индексы
+    """
+    table = PredictionHistory.__table__
+    existing = {col["name"] for col in inspect(sync_conn).get_columns(table.name)}
+
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        # SQLite не позволяет добавить столбец с DEFAULT CURRENT_TIMESTAMP,
+        # поэтому столбец добавляется без значения по умолчанию (значение задает запись истории)
+        column_type = column.type.compile(dialect=sync_conn.dialect)
+        sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+    for index in table.indexes:
+        index.create(sync_conn, checkfirst=True)
+
+
 # Инициализация БД
 async def init_db() -> None:
     """
     Инициализировать таблицы базы данных
     Создает все таблицы определенные в моделях
     """
-    async with engine.begin() as conn:
+    async with writer_engine.begin() as conn:
         # Создать все таблицы
         await conn.run_sync(Base.metadata.create_all)
+        # Добавить новые столбцы и индексы в старую таблицу
+        await conn.run_sync(_migrate)
+
+
+async def dispose_engines() -> None:
+    """Закрыть соединения обоих движков"""
+    await engine.dispose()
+    await writer_engine.dispose()
@@ -1,22 +1,195 @@
 # Загрузчики модели и переменных
 
+# Модель и список переменных загружаются один раз при старте приложения
+# (см. lifespan в main.py) и хранятся в реестре ModelRegistry.
+# Все запросы получают один и тот же объект модели из памяти.
+
+# Горячая замена модели:
+# - фоновая задача периодически проверяет файл .cbm
+# - при изменении новая модель загружается в отдельном потоке
+# - готовый снимок (модель + схема переменных + версия) подменяется одной операцией присваивания,
+#   поэтому запросы в процессе обработки дорабатывают со старой моделью без паузы
+
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
 import yaml
 from catboost import CatBoostClassifier
-from pathlib import Path
 
-BASE_DIR = Path(__file__).parent.parent
+from api.config import FEATURES_PATH, MODEL_PATH, MODEL_RELOAD_INTERVAL
+from api.feature_schema import FeatureSchema
 
 
-def load_model():
+def load_model(model_path: Path = MODEL_PATH, blob: Optional[bytes] = None):
     """Загрузка CatBoost модели"""
-    model_path = BASE_DIR / "models" / "final_model.cbm"
     model = CatBoostClassifier()
-    model.load_model(str(model_path))
+    if blob is not None:
+        model.load_model(blob=blob)
+    else:
+        model.load_model(str(model_path))
     return model
 
 
-def load_features_config():
+def model_version(modified_ns: int, blob: bytes) -> str:
+    """Версия модели = время изменения файла + короткий хеш содержимого"""
+    modified = datetime.fromtimestamp(modified_ns / 1e9, tz=timezone.utc)
+    return f"{modified:%Y%m%d%H%M%S}-{hashlib.sha256(blob).hexdigest()[:12]}"
+
+
+def read_model_file(model_path: Path = MODEL_PATH):
+    """
+    Прочитать файл модели вместе с его версией
+
+    Returns:
+        tuple: (модель, версия, (st_mtime_ns, st_size) файла)
+    """
+    model_path = Path(model_path)
+    stat = model_path.stat()
+    blob = model_path.read_bytes()
+    model = load_model(model_path, blob=blob)
+    return model, model_version(stat.st_mtime_ns, blob), (stat.st_mtime_ns, stat.st_size)
+
+
+def load_features_config(features_path: Path = FEATURES_PATH):
     """Загрузка списка переменных модели"""
-    features_path = BASE_DIR / "models" / "params" / "features.yaml"
     with open(features_path, 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
+
+
+@dataclass(frozen=True)
+class LoadedModel:
+    """
+    Неизменяемый снимок загруженной модели
+
+    Запрос берет снимок один раз и работает с ним до конца,
+    поэтому модель и список переменных всегда согласованы между собой
+    """
+    model: CatBoostClassifier
+    features_config: dict
+    schema: FeatureSchema
+    version: str
+    model_path: Path
+    file_signature: tuple
+    loaded_at: datetime
+
+
+class ModelRegistry:
+    """
+    Реестр модели на весь процесс
+
+    Загружает модель при старте, раздает ее всем запросам
+    и атомарно подменяет при появлении нового файла .cbm
+    """
+
+    def __init__(self, model_path: Path = MODEL_PATH, features_path: Path = FEATURES_PATH):
+        self.model_path = Path(model_path)
+        self.features_path = Path(features_path)
+        self._current: Optional[LoadedModel] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        self._reload_lock = asyncio.Lock()
+
+    @property
+    def current(self) -> LoadedModel:
+        """Текущий снимок модели. Если модель еще не загружена - загружаем синхронно"""
+        if self._current is None:
+            self._current = self._load()
+        return self._current
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._current.version if self._current is not None else None
+
+    def _file_signature(self) -> tuple:
+        stat = self.model_path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> LoadedModel:
+        """Чтение файлов с диска и десериализация модели (блокирующая операция)"""
+        model, version, signature = read_model_file(self.model_path)
+        features_config = load_features_config(self.features_path)
+
+        return LoadedModel(
+            model=model,
+            features_config=features_config,
+            schema=FeatureSchema.from_config(features_config),
+            version=version,
+            model_path=self.model_path,
+            file_signature=signature,
+            loaded_at=datetime.now(timezone.utc)
+        )
+
+    async def load(self) -> LoadedModel:
+        """Первичная загрузка модели при старте приложения"""
+        self._current = await asyncio.to_thread(self._load)
+        return self._current
+
+    async def reload(self, force: bool = False) -> bool:
+        """
+        Перезагрузить модель, если файл изменился
+
+        Новая модель загружается в отдельном потоке, обслуживание запросов
+        при этом продолжается со старой моделью
+
+        Returns:
+            bool: была ли модель заменена
+        """
+        async with self._reload_lock:
+            if not force and self._current is not None:
+                try:
+                    if self._file_signature() == self._current.file_signature:
+                        return False
+                except FileNotFoundError:
+                    # Файл в процессе замены - проверим в следующий раз
+                    return False
+
+            loaded = await asyncio.to_thread(self._load)
+            # Атомарная подмена снимка
+            self._current = loaded
+            return True
+
+    async def _watch(self, interval: float) -> None:
+        """Фоновая задача отслеживания файла модели"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await self.reload():
+                    print(f"Модель обновлена, версия {self.version}")
+            except Exception as e:
+                # Битый или недописанный файл - продолжаем работать со старой моделью
+                print(f"Ошибка обновления модели: {e}")
+
+    def start_watching(self, interval: float = MODEL_RELOAD_INTERVAL) -> None:
+        if interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch(interval))
+
+    async def stop_watching(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+
+# Реестр модели на весь процесс
+model_registry = ModelRegistry()
+
+
+def get_loaded_model() -> LoadedModel:
+    """Зависимость FastAPI: текущий снимок модели из реестра"""
+    return model_registry.current
+
+
+def get_model():
+    """Зависимость FastAPI: загруженная модель"""
+    return model_registry.current.model
+
+
+def get_features_config() -> dict:
+    """Зависимость FastAPI: список переменных модели"""
+    return model_registry.current.features_config
@@ -0,0 +1,181 @@
+# Скомпилированная схема переменных модели
+
+# Схема собирается один раз из models/params/features.yaml
+# (FINAL_FEATURES и FINAL_CAT_FEATURES) при загрузке модели и хранит:
+# - порядок столбцов
+# - тип каждого столбца (числовой / категориальный)
+# - индексы категориальных столбцов
+
+# Запрос (словарь или список словарей) превращается в строки значений
+# в порядке столбцов за один проход, без pandas:
+# - числовые значения приводятся к float, пропуск -> NaN
+# - категориальные значения приводятся к строке (как astype(str) при обучении)
+# Ошибки приведения собираются по всем переменным строки сразу
+
+import math
+from typing import Any, Dict, Iterable, List, Tuple
+
+NUMERIC = "num"
+CATEGORICAL = "cat"
+
+
+class FeatureValidationError(ValueError):
+    """
+    Строка не прошла валидацию
+
+    Attributes:
+        missing: отсутствующие переменные
+        invalid: словарь {переменная: описание ошибки приведения типа}
+    """
+
+    def __init__(self, missing: List[str] = None, invalid: Dict[str, str] = None):
+        self.missing = missing or []
+        self.invalid = invalid or {}
+        super().__init__(self.message)
+
+    @property
+    def message(self) -> str:
+        parts = []
+        if self.missing:
+            parts.append(f"Отсутствуют переменные: {self.missing}")
+        if self.invalid:
+            parts.append(f"Некорректные значения переменных: {self.invalid}")
+        return "; ".join(parts)
+
+
+def _to_float(value: Any) -> float:
+    """Приведение значения к числу. Пропуск -> NaN"""
+    if value is None:
+        return math.nan
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        if value.strip() == "":
+            return math.nan
+        return float(value)
+    raise TypeError(f"ожидается число, получено {type(value).__name__}")
+
+
+def _to_category(value: Any) -> str:
+    """Приведение значения к категории (строке), как astype(str) при обучении"""
+    if value is None:
+        return "nan"
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, (int, float)):
+        return str(value)
+    raise TypeError(f"ожидается строка или число, получено {type(value).__name__}")
+
+
+class FeatureSchema:
+    """
+    Схема входа модели, скомпилированная из списка переменных
+
+    Args:
+        features: переменные модели в порядке подачи в модель
+        cat_features: категориальные переменные
+    """
+
+    def __init__(self, features: Iterable[str], cat_features: Iterable[str] = ()):
+        self.columns: Tuple[str, ...] = tuple(features)
+        cat_features = set(cat_features)
+
+        self.kinds: Tuple[str, ...] = tuple(
+            CATEGORICAL if col in cat_features else NUMERIC for col in self.columns
+        )
+        self.cat_indices: Tuple[int, ...] = tuple(
+            idx for idx, kind in enumerate(self.kinds) if kind == CATEGORICAL
+        )
+        self.index: Dict[str, int] = {col: idx for idx, col in enumerate(self.columns)}
+
+        # Пары (столбец, функция приведения) - чтобы не ветвиться по типу на каждой строке
+        self._converters = tuple(
+            (col, _to_category if kind == CATEGORICAL else _to_float)
+            for col, kind in zip(self.columns, self.kinds)
+        )
+
+    @classmethod
+    def from_config(cls, features_config: dict) -> "FeatureSchema":
+        """Схема из содержимого features.yaml"""
+        return cls(
+            features_config.get("FINAL_FEATURES", []),
+            features_config.get("FINAL_CAT_FEATURES", [])
+        )
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    def _convert(self, values: Iterable[Any]) -> list:
+        """Приведение значений (в порядке столбцов) к типам схемы"""
+        row = []
+        invalid = {}
+
+        for (col, convert), value in zip(self._converters, values):
+            try:
+                row.append(convert(value))
+            except (TypeError, ValueError) as e:
+                invalid[col] = str(e) if isinstance(e, TypeError) else f"не число: {value!r}"
+
+        if invalid:
+            raise FeatureValidationError(invalid=invalid)
+
+        return row
+
+    def coerce_row(self, record: Dict[str, Any]) -> list:
+        """
+        Словарь -> строка значений в порядке столбцов
+
+        Raises:
+            FeatureValidationError: отсутствуют переменные или значения не приводятся к типу
+        """
+        missing = [col for col in self.columns if col not in record]
+        if missing:
+            raise FeatureValidationError(missing=missing)
+
+        return self._convert(record[col] for col in self.columns)
+
+    def _coerce_many(self, values_iter: Iterable[Iterable[Any]], to_values):
+        rows, valid_idx, errors = [], [], {}
+
+        for idx, item in enumerate(values_iter):
+            try:
+                rows.append(to_values(item))
+            except FeatureValidationError as e:
+                errors[idx] = e.message
+                continue
+            valid_idx.append(idx)
+
+        return rows, valid_idx, errors
+
+    def coerce_rows(self, records: Iterable[Dict[str, Any]]):
+        """
+        Список словарей -> строки значений
+
+        Невалидные строки не прерывают обработку
+
+        Returns:
+            tuple: (валидные строки, их индексы, словарь {индекс: ошибка})
+        """
+        return self._coerce_many(records, self.coerce_row)
+
+    def coerce_columns(self, columns: Dict[str, List[Any]]):
+        """
+        Столбцовый формат {переменная: [значения]} -> строки значений
+
+        Returns:
+            tuple: (валидные строки, их индексы, словарь {индекс: ошибка})
+        """
+        total = len(next(iter(columns.values()), []))
+
+        # В столбцовом формате переменная либо есть у всех строк, либо ни у одной
+        missing = [col for col in self.columns if col not in columns]
+        if missing:
+            message = FeatureValidationError(missing=missing).message
+            return [], [], {idx: message for idx in range(total)}
+
+        ordered = [columns[col] for col in self.columns]
+        return self._coerce_many(zip(*ordered), self._convert)
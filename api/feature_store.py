@@ -0,0 +1,248 @@
+# Онлайн-хранилище признаков по картам
+
+# Переменные модели (FINAL_FEATURES) частично строятся офлайн по истории карты
+# (utils/card_features_utils.py, utils/time_features_utils.py, utils/cat_features_utils.py).
+# Чтобы клиент мог присылать сырую транзакцию IEEE-CIS, хранилище держит в памяти
+# состояние каждой карты (card1) и достраивает эти переменные на сервере:
+# - {col}_new - категория с пропуском, замененным на 'missing' (P_emaildomain_new, card6_new, M5_new, ...)
+# - P_emaildomain_grouped, id_30_grouped, id_31_grouped, id_33_ratio, DeviceInfo_brand - группы категорий
+#   по тем же правилам, что в preparing_cat_features
+# - card_addr1_pair, card_email_p, card_email_r - комбинации карты с адресом и email доменами
+# - card_unique_P_email, card_unique_R_email - количество уникальных email доменов карты
+#   в более ранних транзакциях (без текущей), как make_card_features(point_in_time=True)
+# - оконные признаки за последние w часов (count_{w}h, amt_sum_{w}h, amt_max_{w}h, amt_median_{w}h,
+#   mean_gap_{w}h, ...) - потоковый расчет api/card_windows.py, совпадающий с make_time_window_features
+
+# Транзакция проходит в два шага:
+# - peek - признаки читаются без изменения состояния карты. Соглашение то же, что офлайн:
+#   агрегаты карты (уникальные домены) - только по более ранним транзакциям, у первой
+#   транзакции карты - 0; оконные признаки - окна (t - w, t], текущая транзакция в них входит
+# - commit - транзакция добавляется в состояние карты; вызывается только после того, как
+#   строка прошла валидацию и получила прогноз, чтобы отклоненные запросы не портили историю
+# Переменные, которые клиент прислал сам, не перезаписываются
+
+# Оба шага вызываются из event loop без await, поэтому блокировки не нужны
+
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from api.card_windows import CardWindows
+from api.config import FEATURE_STORE_MAX_CARDS
+from api.metrics import metrics
+from utils.cat_features_utils import FILL_CAT_COLS, GROUPED_COLS, MISSING_CATEGORY
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _card_key(value: Any) -> str:
+    """card1 строкой, как astype(str) для целочисленного столбца"""
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _float_str(value: Any) -> str:
+    """Значение числового столбца строкой, как astype(str) для float (пропуск -> 'nan')"""
+    if _is_missing(value):
+        return "nan"
+    try:
+        return str(float(value))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _category(value: Any) -> Any:
+    """Категория с пропуском, замененным на 'missing', как fillna в preparing_cat_features"""
+    return MISSING_CATEGORY if _is_missing(value) else value
+
+
+class CardState:
+    """
+    Состояние одной карты
+
+    Attributes:
+        windows: оконные признаки карты (транзакции за последние 168 часов)
+        p_emails: уникальные P_emaildomain_new карты
+        r_emails: уникальные R_emaildomain_new карты
+
+    Доменов у карты единицы, поэтому они хранятся кортежами: пустой set
+    занимает больше памяти, чем все остальное состояние карты
+    """
+    __slots__ = ("windows", "p_emails", "r_emails")
+
+    def __init__(self):
+        self.windows = CardWindows()
+        self.p_emails = ()
+        self.r_emails = ()
+
+
+def _with_email(emails: tuple, email: Any) -> tuple:
+    return emails if email in emails else emails + (email,)
+
+
+def _window_input(record: Dict[str, Any]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Время и сумма транзакции для оконных признаков
+
+    Без времени или суммы оконные признаки не строятся - их отсутствие покажет валидация
+    """
+    try:
+        dt, amount = float(record.get("TransactionDT")), float(record.get("TransactionAmt"))
+    except (TypeError, ValueError):
+        return None, None
+    if math.isnan(dt) or math.isnan(amount):
+        return None, None
+    return dt, amount
+
+
+class OnlineFeatureStore:
+    """
+    Состояние карт в памяти процесса
+
+    Args:
+        max_cards: сколько карт хранить (вытесняются давно неактивные)
+    """
+
+    def __init__(self, max_cards: int = FEATURE_STORE_MAX_CARDS):
+        self.max_cards = max(1, max_cards)
+        self._cards: "OrderedDict[str, CardState]" = OrderedDict()
+
+        self._cards_gauge = metrics.gauge("feature_store_cards")
+        self._enrich_time = metrics.histogram("feature_store_enrich_seconds")
+        self._evicted = metrics.counter("feature_store_evicted_cards")
+
+    def __len__(self) -> int:
+        return len(self._cards)
+
+    def _state(self, card: str) -> CardState:
+        state = self._cards.get(card)
+        if state is None:
+            state = self._cards[card] = CardState()
+            if len(self._cards) > self.max_cards:
+                self._cards.popitem(last=False)
+                self._evicted.inc()
+            self._cards_gauge.set(len(self._cards))
+        else:
+            self._cards.move_to_end(card)
+        return state
+
+    def seed(self, card_state, transactions=None) -> int:
+        """
+        Заполнить состояние карт по офлайн-истории
+
+        Args:
+            card_state: состояние карт из make_card_state (utils/card_features_utils.py):
+                        индекс - card1, столбцы P_emails и R_emails
+            transactions: транзакции для оконных признаков (card1, TransactionDT, TransactionAmt),
+                          достаточно последних 168 часов истории
+
+        Returns:
+            int: количество заполненных карт
+        """
+        for card_value, p_emails, r_emails in zip(
+            card_state.index, card_state["P_emails"], card_state["R_emails"]
+        ):
+            if _is_missing(card_value):
+                continue
+            state = self._state(_card_key(card_value))
+            for email in p_emails:
+                state.p_emails = _with_email(state.p_emails, _category(email))
+            for email in r_emails:
+                state.r_emails = _with_email(state.r_emails, _category(email))
+
+        if transactions is not None:
+            transactions = transactions.dropna(subset=["card1", "TransactionDT", "TransactionAmt"])
+            transactions = transactions.sort_values("TransactionDT", kind="stable")
+            for card_value, dt, amount in zip(
+                transactions["card1"], transactions["TransactionDT"], transactions["TransactionAmt"]
+            ):
+                self._state(_card_key(card_value)).windows.commit(float(dt), float(amount))
+
+        return len(card_state)
+
+    def peek(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Достроить переменные транзакции, не меняя состояние карты
+
+        card_unique_P_email / card_unique_R_email - домены более ранних транзакций карты,
+        без текущей (как _point_in_time в utils/card_features_utils.py), оконные признаки
+        включают текущую транзакцию. Состояние меняет только commit - после того, как транзакция прошла валидацию
+        и получила прогноз, поэтому отклоненный запрос не попадает в историю карты
+
+        Args:
+            record: сырая транзакция (card1, TransactionDT, TransactionAmt, addr1,
+                    P_emaildomain, R_emaildomain, ...)
+
+        Returns:
+            dict: транзакция с добавленными переменными (исходный словарь не меняется)
+        """
+        started = time.perf_counter()
+        features: Dict[str, Any] = {}
+
+        for col in FILL_CAT_COLS:
+            features[f"{col}_new"] = _category(record.get(col))
+        for col, (new_col, mapper) in GROUPED_COLS.items():
+            features[new_col] = mapper(features[col])
+
+        card_value = record.get("card1")
+        if not _is_missing(card_value):
+            card = _card_key(card_value)
+            p_email = features["P_emaildomain_new"]
+            r_email = features["R_emaildomain_new"]
+
+            features["card_addr1_pair"] = f"{card}_{_float_str(record.get('addr1'))}"
+            features["card_email_p"] = f"{card}_{p_email}"
+            features["card_email_r"] = f"{card}_{r_email}"
+
+            # Новая карта читается как пустая, в хранилище она появится только в commit
+            state = self._cards.get(card) or CardState()
+            features["card_unique_P_email"] = float(len(state.p_emails))
+            features["card_unique_R_email"] = float(len(state.r_emails))
+
+            dt, amount = _window_input(record)
+            if dt is not None:
+                features.update(state.windows.peek(dt, amount))
+
+        # Присланные клиентом значения имеют приоритет
+        enriched = {**features, **record}
+        self._enrich_time.observe(time.perf_counter() - started)
+        return enriched
+
+    def commit(self, record: Dict[str, Any]) -> None:
+        """
+        Добавить транзакцию в состояние карты
+
+        Если между peek и commit по карте прошли другие транзакции, транзакция
+        добавляется уже после них (ее признаки, прочитанные в peek, не пересчитываются)
+
+        Args:
+            record: та же сырая транзакция, что была передана в peek
+        """
+        card_value = record.get("card1")
+        if _is_missing(card_value):
+            return
+
+        state = self._state(_card_key(card_value))
+        state.p_emails = _with_email(state.p_emails, _category(record.get("P_emaildomain")))
+        state.r_emails = _with_email(state.r_emails, _category(record.get("R_emaildomain")))
+
+        dt, amount = _window_input(record)
+        if dt is not None:
+            state.windows.commit(dt, amount)
+
+
+# Хранилище на весь процесс
+feature_store = OnlineFeatureStore()
+
+
+def get_feature_store() -> OnlineFeatureStore:
+    """Зависимость FastAPI: онлайн-хранилище признаков"""
+    return feature_store
@@ -0,0 +1,398 @@
+# Архивирование истории предсказаний в Parquet
+
+# Живая таблица prediction_history хранит только последние HISTORY_RETENTION_DAYS дней.
+# Фоновая задача раз в HISTORY_ARCHIVE_INTERVAL секунд:
+# 1. Читает записи старше срока хранения частями по HISTORY_ARCHIVE_CHUNK_ROWS (по id)
+# 2. Пишет их в сжатые Parquet файлы по дням:
+#    HISTORY_ARCHIVE_DIR/date=YYYY-MM-DD/part-<min id>-<max id>.parquet
+#    (записи без времени запроса - в date=1970-01-01)
+# 3. Удаляет записанные строки из живой таблицы
+
+# Файл пишется до удаления строк. Если процесс упадет между этими шагами,
+# строки попадут в архив повторно. Имя файла при этом может отличаться
+# (в повторной части могут оказаться другие строки, и min/max id дня сдвинутся),
+# поэтому оба читателя (read_archive_page, iter_archive) отбрасывают дубликаты по id:
+# если диапазоны id файлов пересекаются, уже прочитанные id запоминаются
+
+# Список файлов архива кэшируется (_archive_files): он перечитывается после записи
+# архиватором этого процесса или при изменении mtime каталога архива
+# (появился новый день), а не на каждый запрос истории
+
+# Эндпоинты истории читают живую таблицу и архив вместе (read_archive_page, iter_archive).
+# Агрегаты history_rollup при архивировании не меняются, поэтому /history/stats
+# продолжает учитывать всю историю
+
+import asyncio
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import Text, cast, delete, or_, select
+
+from api.config import (
+    HISTORY_ARCHIVE_CHUNK_ROWS,
+    HISTORY_ARCHIVE_COMPRESSION,
+    HISTORY_ARCHIVE_DIR,
+    HISTORY_ARCHIVE_INTERVAL,
+    HISTORY_RETENTION_DAYS,
+)
+from api.database import AsyncSessionLocal, WriterSessionLocal
+from api.history_stats import EPOCH, utc_now
+from api.metrics import metrics
+from api.models import PredictionHistory
+
+# Схема архивных файлов. request_data хранится исходным JSON текстом
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("created_at", pa.timestamp("us")),
+    ("request_data", pa.string()),
+    ("prediction", pa.int64()),
+    ("probability", pa.float64()),
+    ("processing_time", pa.float64()),
+])
+
+_PART_RE = re.compile(r"^part-(\d+)-(\d+)\.parquet$")
+
+# каталог архива -> (mtime_ns каталога, список файлов)
+_files_cache: Dict[Path, Tuple[int, List[Tuple[int, int, date, Path]]]] = {}
+
+
+@dataclass(frozen=True)
+class HistoryFilter:
+    """
+    Фильтр истории: одни и те же условия для живой таблицы (SQL) и архива (pyarrow)
+
+    Attributes:
+        created_from: время запроса от (включительно)
+        created_to: время запроса до (не включительно)
+        prediction: предсказание модели
+        min_probability: вероятность от
+        max_probability: вероятность до
+    """
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    prediction: Optional[int] = None
+    min_probability: Optional[float] = None
+    max_probability: Optional[float] = None
+
+    def sql_conditions(self) -> list:
+        conditions = []
+        if self.created_from is not None:
+            conditions.append(PredictionHistory.created_at >= self.created_from)
+        if self.created_to is not None:
+            conditions.append(PredictionHistory.created_at < self.created_to)
+        if self.prediction is not None:
+            conditions.append(PredictionHistory.prediction == self.prediction)
+        if self.min_probability is not None:
+            conditions.append(PredictionHistory.probability >= self.min_probability)
+        if self.max_probability is not None:
+            conditions.append(PredictionHistory.probability <= self.max_probability)
+        return conditions
+
+    def arrow_expression(self, cursor: Optional[int] = None) -> Optional[ds.Expression]:
+        expression = None
+        conditions = []
+        if cursor is not None:
+            conditions.append(ds.field("id") < cursor)
+        if self.created_from is not None:
+            conditions.append(ds.field("created_at") >= pa.scalar(self.created_from, pa.timestamp("us")))
+        if self.created_to is not None:
+            conditions.append(ds.field("created_at") < pa.scalar(self.created_to, pa.timestamp("us")))
+        if self.prediction is not None:
+            conditions.append(ds.field("prediction") == self.prediction)
+        if self.min_probability is not None:
+            conditions.append(ds.field("probability") >= self.min_probability)
+        if self.max_probability is not None:
+            conditions.append(ds.field("probability") <= self.max_probability)
+
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def may_match_day(self, day: date) -> bool:
+        """Может ли в архиве за этот день быть подходящая запись"""
+        if self.created_from is not None and day < self.created_from.date():
+            return False
+        if self.created_to is not None and day > self.created_to.date():
+            return False
+        return True
+
+
+def _archive_files(archive_dir: Path) -> List[Tuple[int, int, date, Path]]:
+    """Архивные файлы (min id, max id, день, путь) от новых записей к старым, из кэша"""
+    archive_dir = Path(archive_dir)
+    try:
+        mtime = archive_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        _files_cache.pop(archive_dir, None)
+        return []
+
+    cached = _files_cache.get(archive_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    files = _list_archive_files(archive_dir)
+    _files_cache[archive_dir] = (mtime, files)
+    return files
+
+
+def invalidate_archive_files(archive_dir: Path) -> None:
+    """Сбросить кэш списка файлов (после записи в архив)"""
+    _files_cache.pop(Path(archive_dir), None)
+
+
+def _list_archive_files(archive_dir: Path) -> List[Tuple[int, int, date, Path]]:
+    files = []
+    for partition in archive_dir.iterdir():
+        if not partition.is_dir() or not partition.name.startswith("date="):
+            continue
+        day = date.fromisoformat(partition.name[len("date="):])
+        for path in partition.iterdir():
+            match = _PART_RE.match(path.name)
+            if match:
+                files.append((int(match.group(1)), int(match.group(2)), day, path))
+
+    return sorted(files, key=lambda item: item[1], reverse=True)
+
+
+def _overlapping_files(files: List[Tuple[int, int, date, Path]]) -> Set[Path]:
+    """Файлы, диапазон id которых пересекается с диапазоном другого файла (группы пересечений)"""
+    overlapping: Set[Path] = set()
+    group: List[Path] = []
+    reach = None
+    for min_id, max_id, _, path in sorted(files, key=lambda item: item[0]):
+        if reach is not None and min_id <= reach:
+            group.append(path)
+            reach = max(reach, max_id)
+            continue
+        if len(group) > 1:
+            overlapping.update(group)
+        group, reach = [path], max_id
+    if len(group) > 1:
+        overlapping.update(group)
+    return overlapping
+
+
+def _read_file(path: Path, expression: Optional[ds.Expression]) -> List[dict]:
+    """Записи файла, прошедшие фильтр, от новых к старым"""
+    table = ds.dataset(path, format="parquet").to_table(filter=expression)
+    table = table.sort_by([("id", "descending")])
+
+    records = table.to_pylist()
+    for record in records:
+        record["request_data"] = json.loads(record["request_data"])
+    return records
+
+
+def read_archive_page(
+    history_filter: HistoryFilter,
+    cursor: Optional[int],
+    limit: int,
+    archive_dir: Path = HISTORY_ARCHIVE_DIR
+) -> List[dict]:
+    """
+    Страница архива: до limit записей с id < cursor от новых к старым
+
+    Файлы перебираются по убыванию max id; перебор останавливается,
+    когда набрано limit записей новее любого из оставшихся файлов
+    """
+    expression = history_filter.arrow_expression(cursor)
+    records: List[dict] = []
+    seen: Set[int] = set()
+
+    for min_id, max_id, day, path in _archive_files(archive_dir):
+        if cursor is not None and min_id >= cursor:
+            continue
+        if len(records) >= limit and max_id < records[limit - 1]["id"]:
+            break
+        if not history_filter.may_match_day(day):
+            continue
+
+        # Повторно заархивированные строки: оставляем первую копию
+        for record in _read_file(path, expression):
+            if record["id"] not in seen:
+                seen.add(record["id"])
+                records.append(record)
+        records.sort(key=lambda record: record["id"], reverse=True)
+
+    return records[:limit]
+
+
+def iter_archive(
+    history_filter: HistoryFilter,
+    archive_dir: Path = HISTORY_ARCHIVE_DIR
+) -> Iterator[List[dict]]:
+    """
+    Все архивные записи, прошедшие фильтр, по одному файлу за шаг
+
+    id запоминаются только для файлов с пересекающимися диапазонами id,
+    поэтому память не растет с размером архива при обычной работе
+    """
+    expression = history_filter.arrow_expression()
+    files = _archive_files(archive_dir)
+    overlapping = _overlapping_files(files)
+    seen: Set[int] = set()
+    for _, _, day, path in files:
+        if not history_filter.may_match_day(day):
+            continue
+        records = _read_file(path, expression)
+        if path in overlapping:
+            records = [record for record in records if record["id"] not in seen]
+            seen.update(record["id"] for record in records)
+        yield records
+
+
+def archive_max_id(archive_dir: Path = HISTORY_ARCHIVE_DIR) -> Optional[int]:
+    """Наибольший id в архиве (None - архив пуст)"""
+    files = _archive_files(archive_dir)
+    return files[0][1] if files else None
+
+
+class HistoryArchiver:
+    """
+    Фоновый перенос старой истории в Parquet
+
+    Args:
+        archive_dir: каталог архива
+        retention_days: сколько дней история хранится в живой таблице (0 - не архивировать)
+        interval: как часто (в секундах) запускать перенос
+        chunk_rows: сколько строк переносится за одну транзакцию
+        compression: алгоритм сжатия Parquet
+    """
+
+    def __init__(
+        self,
+        archive_dir: Path = HISTORY_ARCHIVE_DIR,
+        retention_days: int = HISTORY_RETENTION_DAYS,
+        interval: float = HISTORY_ARCHIVE_INTERVAL,
+        chunk_rows: int = HISTORY_ARCHIVE_CHUNK_ROWS,
+        compression: str = HISTORY_ARCHIVE_COMPRESSION
+    ):
+        self.archive_dir = Path(archive_dir)
+        self.retention_days = retention_days
+        self.interval = interval
+        self.chunk_rows = max(1, chunk_rows)
+        self.compression = compression
+        self._task: Optional[asyncio.Task] = None
+
+        self._archived = metrics.counter("history_archived_rows")
+        self._archive_time = metrics.histogram("history_archive_seconds")
+        self._errors = metrics.counter("history_archive_errors")
+
+    def _write_partitions(self, rows) -> None:
+        """Записать строки в Parquet файлы по дням"""
+        partitions = {}
+        for row in rows:
+            day = (row.created_at or EPOCH).date()
+            partitions.setdefault(day, []).append(row)
+
+        for day, day_rows in partitions.items():
+            table = pa.Table.from_pydict(
+                {name: [getattr(row, name) for row in day_rows] for name in ARCHIVE_SCHEMA.names},
+                schema=ARCHIVE_SCHEMA
+            )
+
+            partition_dir = self.archive_dir / f"date={day.isoformat()}"
+            partition_dir.mkdir(parents=True, exist_ok=True)
+            path = partition_dir / f"part-{day_rows[0].id:012d}-{day_rows[-1].id:012d}.parquet"
+
+            # Пишем во временный файл, чтобы читатели не увидели файл частично
+            tmp_path = path.with_suffix(".tmp")
+            pq.write_table(table, tmp_path, compression=self.compression)
+            os.replace(tmp_path, path)
+
+        invalidate_archive_files(self.archive_dir)
+
+    async def archive_once(self) -> int:
+        """
+        Перенести в архив записи старше срока хранения
+
+        Returns:
+            int: количество перенесенных записей
+        """
+        if self.retention_days <= 0:
+            return 0
+
+        # Срок хранения отсчитывается целыми днями, чтобы файл дня не дописывался
+        cutoff = (utc_now() - timedelta(days=self.retention_days)).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        expired = or_(
+            PredictionHistory.created_at < cutoff,
+            PredictionHistory.created_at.is_(None)
+        )
+
+        query = (
+            select(
+                PredictionHistory.id,
+                PredictionHistory.created_at,
+                cast(PredictionHistory.request_data, Text).label("request_data"),
+                PredictionHistory.prediction,
+                PredictionHistory.probability,
+                PredictionHistory.processing_time,
+            )
+            .where(expired)
+            .order_by(PredictionHistory.id)
+            .limit(self.chunk_rows)
+        )
+
+        total = 0
+        while True:
+            started = time.perf_counter()
+            async with AsyncSessionLocal() as session:
+                rows = (await session.execute(query)).all()
+            if not rows:
+                break
+
+            # Запись Parquet - синхронная работа с диском, выполняем вне event loop
+            await asyncio.to_thread(self._write_partitions, rows)
+
+            # Строки выбраны по возрастанию id, поэтому все истекшие записи
+            # с id <= max id - это ровно записанные строки
+            async with WriterSessionLocal() as session:
+                await session.execute(
+                    delete(PredictionHistory).where(expired, PredictionHistory.id <= rows[-1].id)
+                )
+                await session.commit()
+
+            total += len(rows)
+            self._archived.inc(len(rows))
+            self._archive_time.observe(time.perf_counter() - started)
+
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                archived = await self.archive_once()
+                if archived:
+                    print(f"Перенесено в архив записей истории: {archived}")
+            except Exception as e:
+                print(f"Ошибка архивирования истории: {e}")
+                self._errors.inc()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None and self.retention_days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Архивирование на весь процесс
+history_archiver = HistoryArchiver()
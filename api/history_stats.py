@@ -0,0 +1,301 @@
+# Накопленная статистика истории предсказаний
+
+# Статистика не пересчитывается по всей таблице истории на каждый запрос.
+# Агрегаты хранятся в таблице history_rollup и обновляются при записи
+# каждой пачки истории (history_writer) в той же транзакции:
+# - hour - агрегаты за час
+# - day - агрегаты за день
+# - total - агрегаты за всю историю (одна строка, из нее отвечает /history/stats)
+
+# Агрегат хранит количества и суммы (для средних) и скетч квантилей времени обработки.
+# Скетч - логарифмические корзины с относительной точностью RELATIVE_ACCURACY:
+# два скетча объединяются сложением счетчиков корзин, поэтому из часовых
+# агрегатов можно получить дневные и общие без исходных записей
+
+import math
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.models import HistoryRollup, PredictionHistory
+
+# Относительная точность квантилей времени обработки
+RELATIVE_ACCURACY = 0.01
+
+# Значения не больше этого порога попадают в отдельную нулевую корзину
+MIN_SKETCH_VALUE = 1e-9
+
+# Начало периода для строки total и для записей без времени запроса
+EPOCH = datetime(1970, 1, 1)
+
+HOUR = "hour"
+DAY = "day"
+TOTAL = "total"
+
+# Сколько строк истории читается за раз при первичном заполнении агрегатов
+BACKFILL_CHUNK_SIZE = 10000
+
+
+class QuantileSketch:
+    """
+    Скетч квантилей на логарифмических корзинах
+
+    Значение v попадает в корзину ceil(log_gamma(v)), где gamma = (1 + a) / (1 - a).
+    Оценка квантиля отличается от истинного значения не более чем в (1 ± a) раз
+
+    Args:
+        relative_accuracy: относительная точность a
+    """
+
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        if value <= MIN_SKETCH_VALUE:
+            self.zero_count += 1
+        else:
+            self.bins[math.ceil(math.log(value) / self._log_gamma)] += 1
+        self.count += 1
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Нельзя объединить скетчи с разной точностью")
+
+        for key, bin_count in other.bins.items():
+            self.bins[key] += bin_count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        cumulative = self.zero_count
+        for key in sorted(self.bins):
+            cumulative += self.bins[key]
+            if cumulative > rank:
+                # Середина корзины (gamma^(key-1), gamma^key] в относительной мере
+                return 2 * self.gamma ** key / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_count": self.zero_count,
+            "bins": {str(key): bin_count for key, bin_count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[dict]) -> "QuantileSketch":
+        data = data or {}
+        sketch = cls(data.get("relative_accuracy", RELATIVE_ACCURACY))
+        for key, bin_count in data.get("bins", {}).items():
+            sketch.bins[int(key)] = bin_count
+        sketch.zero_count = data.get("zero_count", 0)
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
+
+
+@dataclass
+class HistoryAggregate:
+    """Количества, суммы и скетч времени обработки за период"""
+    requests: int = 0
+    prediction_count: int = 0
+    prediction_sum: float = 0.0
+    probability_count: int = 0
+    probability_sum: float = 0.0
+    processing_time_sum: float = 0.0
+    processing_time_sketch: QuantileSketch = field(default_factory=QuantileSketch)
+
+    def add(self, prediction, probability, processing_time) -> None:
+        self.requests += 1
+        if prediction is not None:
+            self.prediction_count += 1
+            self.prediction_sum += prediction
+        if probability is not None:
+            self.probability_count += 1
+            self.probability_sum += probability
+        if processing_time is not None:
+            self.processing_time_sum += processing_time
+            self.processing_time_sketch.add(processing_time)
+
+    def merge(self, other: "HistoryAggregate") -> None:
+        self.requests += other.requests
+        self.prediction_count += other.prediction_count
+        self.prediction_sum += other.prediction_sum
+        self.probability_count += other.probability_count
+        self.probability_sum += other.probability_sum
+        self.processing_time_sum += other.processing_time_sum
+        self.processing_time_sketch.merge(other.processing_time_sketch)
+
+    @classmethod
+    def from_row(cls, row: HistoryRollup) -> "HistoryAggregate":
+        return cls(
+            requests=row.requests,
+            prediction_count=row.prediction_count,
+            prediction_sum=row.prediction_sum,
+            probability_count=row.probability_count,
+            probability_sum=row.probability_sum,
+            processing_time_sum=row.processing_time_sum,
+            processing_time_sketch=QuantileSketch.from_dict(row.processing_time_sketch),
+        )
+
+    def store(self, row: HistoryRollup) -> None:
+        """Записать агрегат в строку таблицы history_rollup"""
+        row.requests = self.requests
+        row.prediction_count = self.prediction_count
+        row.prediction_sum = self.prediction_sum
+        row.probability_count = self.probability_count
+        row.probability_sum = self.probability_sum
+        row.processing_time_count = self.processing_time_sketch.count
+        row.processing_time_sum = self.processing_time_sum
+        row.processing_time_sketch = self.processing_time_sketch.to_dict()
+
+    def summary(self) -> dict:
+        """Средние и квантили времени обработки"""
+        sketch = self.processing_time_sketch
+        return {
+            "total_requests": self.requests,
+            "average_prediction": (
+                self.prediction_sum / self.prediction_count if self.prediction_count else None
+            ),
+            "average_probability": (
+                self.probability_sum / self.probability_count if self.probability_count else None
+            ),
+            "average_processing_time": (
+                self.processing_time_sum / sketch.count if sketch.count else None
+            ),
+            "processing_time_p50": sketch.quantile(0.5),
+            "processing_time_p95": sketch.quantile(0.95),
+            "processing_time_p99": sketch.quantile(0.99),
+        }
+
+
+def utc_now() -> datetime:
+    """Текущее время UTC без часового пояса (как CURRENT_TIMESTAMP в SQLite)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_keys(created_at: Optional[datetime]) -> List[Tuple[str, datetime]]:
+    """Периоды (уровень, начало), в которые попадает запись"""
+    if created_at is None:
+        return [(HOUR, EPOCH), (DAY, EPOCH), (TOTAL, EPOCH)]
+
+    return [
+        (HOUR, created_at.replace(minute=0, second=0, microsecond=0)),
+        (DAY, created_at.replace(hour=0, minute=0, second=0, microsecond=0)),
+        (TOTAL, EPOCH),
+    ]
+
+
+def aggregate_records(records: Iterable) -> Dict[Tuple[str, datetime], HistoryAggregate]:
+    """
+    Агрегаты по периодам для набора записей
+
+    Args:
+        records: кортежи (created_at, prediction, probability, processing_time)
+    """
+    groups: Dict[Tuple[str, datetime], HistoryAggregate] = {}
+    for created_at, prediction, probability, processing_time in records:
+        for key in bucket_keys(created_at):
+            aggregate = groups.get(key)
+            if aggregate is None:
+                aggregate = groups[key] = HistoryAggregate()
+            aggregate.add(prediction, probability, processing_time)
+    return groups
+
+
+async def apply_aggregates(
+    session: AsyncSession,
+    groups: Dict[Tuple[str, datetime], HistoryAggregate]
+) -> None:
+    """Добавить агрегаты к строкам history_rollup (в текущей транзакции)"""
+    for (granularity, bucket_start), aggregate in groups.items():
+        row = await session.get(HistoryRollup, (granularity, bucket_start))
+        if row is None:
+            row = HistoryRollup(granularity=granularity, bucket_start=bucket_start)
+            session.add(row)
+        else:
+            aggregate.merge(HistoryAggregate.from_row(row))
+        aggregate.store(row)
+
+
+async def backfill_rollups(session: AsyncSession) -> int:
+    """
+    Заполнить history_rollup по уже сохраненной истории
+
+    Выполняется один раз: если строки total еще нет, а история не пустая
+    (база создана до появления агрегатов)
+
+    Returns:
+        int: количество учтенных записей истории
+    """
+    if await session.get(HistoryRollup, (TOTAL, EPOCH)) is not None:
+        return 0
+
+    query = select(
+        PredictionHistory.created_at,
+        PredictionHistory.prediction,
+        PredictionHistory.probability,
+        PredictionHistory.processing_time,
+    ).execution_options(yield_per=BACKFILL_CHUNK_SIZE)
+
+    groups: Dict[Tuple[str, datetime], HistoryAggregate] = {}
+    result = await session.stream(query)
+    async for rows in result.partitions():
+        for key, aggregate in aggregate_records(rows).items():
+            if key in groups:
+                groups[key].merge(aggregate)
+            else:
+                groups[key] = aggregate
+
+    total = groups.get((TOTAL, EPOCH))
+    if total is None:
+        return 0
+
+    await apply_aggregates(session, groups)
+    await session.commit()
+    return total.requests
+
+
+async def load_aggregate(
+    session: AsyncSession,
+    granularity: str = TOTAL,
+    bucket_start: datetime = EPOCH
+) -> HistoryAggregate:
+    """Агрегат за период (пустой, если записей не было)"""
+    row = await session.get(HistoryRollup, (granularity, bucket_start))
+    return HistoryAggregate.from_row(row) if row is not None else HistoryAggregate()
+
+
+async def load_rollups(
+    session: AsyncSession,
+    granularity: str,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    limit: Optional[int] = None
+) -> List[Tuple[datetime, HistoryAggregate]]:
+    """Агрегаты по часам или дням от новых периодов к старым"""
+    query = select(HistoryRollup).where(HistoryRollup.granularity == granularity)
+    if created_from is not None:
+        query = query.where(HistoryRollup.bucket_start >= created_from)
+    if created_to is not None:
+        query = query.where(HistoryRollup.bucket_start < created_to)
+    query = query.order_by(HistoryRollup.bucket_start.desc()).limit(limit)
+
+    result = await session.execute(query)
+    return [(row.bucket_start, HistoryAggregate.from_row(row)) for row in result.scalars()]
@@ -0,0 +1,260 @@
+# Отложенная (write-behind) запись истории предсказаний
+
+# Раньше каждый запрос открывал сессию, добавлял одну запись и делал commit
+# до отправки ответа. Теперь:
+# 1. Middleware кладет запись в ограниченную очередь в памяти и сразу отвечает клиенту
+# 2. Фоновая задача раз в HISTORY_FLUSH_INTERVAL_MS или по набору HISTORY_FLUSH_MAX_ROWS
+#    записей вставляет пачку одним INSERT в одной транзакции
+# 3. В той же транзакции обновляются агрегаты history_rollup (history_stats.py)
+# 4. При остановке приложения очередь сбрасывается в БД полностью
+
+# Переполнение очереди (HISTORY_OVERFLOW_POLICY):
+# - block - запрос ждет, пока в очереди освободится место
+# - drop_oldest - самые старые записи вытесняются
+# - spill - записи дописываются в локальный файл и загружаются в БД при следующем старте
+
+# Метрики: history_queue_depth, history_flush_batch_size, history_flush_seconds,
+# history_dropped, history_spilled, history_write_errors
+
+import asyncio
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import insert
+
+from api.config import (
+    HISTORY_FLUSH_INTERVAL_MS,
+    HISTORY_FLUSH_MAX_ROWS,
+    HISTORY_OVERFLOW_POLICY,
+    HISTORY_QUEUE_SIZE,
+    HISTORY_SPILL_PATH,
+)
+from api.database import WriterSessionLocal
+from api.history_stats import aggregate_records, apply_aggregates, backfill_rollups, utc_now
+from api.metrics import SIZE_BUCKETS, metrics
+from api.models import PredictionHistory
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "spill")
+
+
+class HistoryWriter:
+    """
+    Очередь записей истории с пакетной записью в БД
+
+    Args:
+        max_queue: максимальный размер очереди
+        flush_interval_ms: максимальное время между сбросами очереди
+        flush_max_rows: максимальное количество записей в одном INSERT
+        overflow_policy: поведение при переполнении очереди
+        spill_path: файл для записей, не поместившихся в очередь или в БД
+    """
+
+    def __init__(
+        self,
+        max_queue: int = HISTORY_QUEUE_SIZE,
+        flush_interval_ms: float = HISTORY_FLUSH_INTERVAL_MS,
+        flush_max_rows: int = HISTORY_FLUSH_MAX_ROWS,
+        overflow_policy: str = HISTORY_OVERFLOW_POLICY,
+        spill_path: Path = HISTORY_SPILL_PATH
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Неизвестная политика переполнения: {overflow_policy}. Допустимо: {OVERFLOW_POLICIES}"
+            )
+
+        self.max_queue = max(1, max_queue)
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000
+        self.flush_max_rows = max(1, flush_max_rows)
+        self.overflow_policy = overflow_policy
+        self.spill_path = Path(spill_path)
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Пачка, которая собирается в данный момент, и ее запись в БД
+        self._collecting: List[dict] = []
+        self._flushing: Optional[asyncio.Task] = None
+
+        self._queue_depth = metrics.gauge("history_queue_depth")
+        self._batch_size = metrics.histogram("history_flush_batch_size", SIZE_BUCKETS)
+        self._flush_time = metrics.histogram("history_flush_seconds")
+        self._dropped = metrics.counter("history_dropped")
+        self._spilled = metrics.counter("history_spilled")
+        self._errors = metrics.counter("history_write_errors")
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+
+        # Заполняем агрегаты по истории, сохраненной до их появления
+        async with WriterSessionLocal() as session:
+            backfilled = await backfill_rollups(session)
+        if backfilled:
+            print(f"Агрегаты истории посчитаны по {backfilled} записям")
+
+        # Загружаем записи, которые не попали в БД при прошлом запуске
+        await self._load_spilled()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановить фоновую задачу и сбросить остаток очереди в БД"""
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Дожидаемся пачки, которая уже пишется в БД
+        if self._flushing is not None:
+            await self._flushing
+            self._flushing = None
+
+        # Записываем недобранную пачку и остаток очереди
+        pending, self._collecting = self._collecting, []
+        pending.extend(self._take(self._queue.qsize()))
+        for start in range(0, len(pending), self.flush_max_rows):
+            await self._flush(pending[start: start + self.flush_max_rows])
+
+    async def enqueue(self, record: dict) -> None:
+        """
+        Поставить запись в очередь на запись
+
+        Args:
+            record: значения столбцов PredictionHistory
+        """
+        if not self.running:
+            # Фоновая задача не запущена (например, без lifespan) - пишем сразу
+            await self._flush([record])
+            return
+
+        if self._queue.full():
+            if self.overflow_policy == "drop_oldest":
+                self._queue.get_nowait()
+                self._dropped.inc()
+            elif self.overflow_policy == "spill":
+                self._spill([record])
+                return
+
+        # При политике block ждем свободного места
+        await self._queue.put(record)
+        self._queue_depth.set(self._queue.qsize())
+
+    def _take(self, limit: int) -> List[dict]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        self._queue_depth.set(self._queue.qsize())
+        return batch
+
+    async def _collect(self) -> List[dict]:
+        """Дождаться первой записи и добрать пачку до интервала или до лимита строк"""
+        batch = self._collecting = [await self._queue.get()]
+        deadline = time.perf_counter() + self.flush_interval
+
+        while len(batch) < self.flush_max_rows:
+            batch.extend(self._take(self.flush_max_rows - len(batch)))
+            timeout = deadline - time.perf_counter()
+            if len(batch) >= self.flush_max_rows or timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        self._queue_depth.set(self._queue.qsize())
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            self._collecting = []
+
+            # Запись выполняется отдельной задачей, чтобы остановка не прервала транзакцию
+            self._flushing = asyncio.create_task(self._flush(batch))
+            await asyncio.shield(self._flushing)
+            self._flushing = None
+
+    async def _flush(self, batch: List[dict]) -> None:
+        """Вставить пачку записей одним INSERT и обновить агрегаты в одной транзакции"""
+        if not batch:
+            return
+
+        # Время запроса нужно агрегатам, поэтому задаем его до вставки
+        for record in batch:
+            if record.get("created_at") is None:
+                record["created_at"] = utc_now()
+
+        groups = aggregate_records(
+            (record["created_at"], record.get("prediction"),
+             record.get("probability"), record.get("processing_time"))
+            for record in batch
+        )
+
+        started = time.perf_counter()
+        async with WriterSessionLocal() as session:
+            try:
+                await session.execute(insert(PredictionHistory), batch)
+                await apply_aggregates(session, groups)
+                await session.commit()
+            except Exception as e:
+                print(f"Ошибка сохранения истории: {e}")
+                self._errors.inc()
+                await session.rollback()
+                # Не теряем записи - откладываем в файл до следующего старта
+                self._spill(batch)
+                return
+
+        self._batch_size.observe(len(batch))
+        self._flush_time.observe(time.perf_counter() - started)
+
+    def _spill(self, batch: List[dict]) -> None:
+        """Дописать записи в локальный файл (JSON Lines)"""
+        try:
+            self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for record in batch:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self._spilled.inc(len(batch))
+        except OSError as e:
+            print(f"Ошибка записи истории в файл {self.spill_path}: {e}")
+            self._dropped.inc(len(batch))
+
+    async def _load_spilled(self) -> None:
+        """Загрузить в БД записи из файла переполнения и удалить файл"""
+        # Переименовываем файл, чтобы новые записи о сбоях не смешивались со старыми.
+        # Если загрузка прервалась при прошлом старте - сначала дозагружаем старый файл
+        pending_path = self.spill_path.with_suffix(".loading")
+        if not pending_path.exists():
+            if not self.spill_path.exists():
+                return
+            self.spill_path.replace(pending_path)
+
+        with open(pending_path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+        # Время запроса в файле хранится строкой
+        for record in records:
+            if isinstance(record.get("created_at"), str):
+                record["created_at"] = datetime.fromisoformat(record["created_at"])
+
+        for start in range(0, len(records), self.flush_max_rows):
+            await self._flush(records[start: start + self.flush_max_rows])
+
+        pending_path.unlink()
+        print(f"Загружено записей истории из файла переполнения: {len(records)}")
+
+
+# Очередь записи истории на весь процесс
+history_writer = HistoryWriter()
@@ -0,0 +1,189 @@
+# Вызов модели
+
+# Общая функция прогноза для пакета строк.
+# Используется пакетным эндпоинтом и диспетчером микро-пакетов (batching.py)
+
+# Вызов CatBoost блокирующий, поэтому он выполняется в пуле InferenceExecutor,
+# а event loop в это время продолжает обслуживать /health, /api/history и запись истории.
+# Пул ограничен: одновременно выполняется не более INFERENCE_WORKERS пакетов,
+# еще INFERENCE_MAX_QUEUE пакетов могут ждать, остальные вызовы ждут свободного места
+
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from api.config import (
+    CATBOOST_THREAD_COUNT,
+    INFERENCE_EXECUTOR,
+    INFERENCE_MAX_QUEUE,
+    INFERENCE_WORKERS,
+)
+from api.dependencies import LoadedModel, read_model_file
+from api.metrics import metrics
+
+
+def score_batch(model, rows, thread_count: int = -1):
+    """
+    Прогноз по пакету одним вызовом predict_proba
+
+    Если модель не смогла обработать пакет целиком (например, из-за типа
+    значения в одной строке), считаем строки по отдельности,
+    чтобы найти проблемные и не потерять остальные
+
+    Args:
+        rows: строки значений в порядке столбцов схемы (FeatureSchema)
+
+    Returns:
+        tuple: (массив вероятностей с NaN для ошибочных строк,
+                словарь {позиция строки: ошибка})
+    """
+    try:
+        return model.predict_proba(rows, thread_count=thread_count)[:, 1], {}
+    except Exception:
+        pass
+
+    probabilities = np.full(len(rows), np.nan)
+    errors = {}
+    for pos, row in enumerate(rows):
+        try:
+            probabilities[pos] = model.predict_proba([row], thread_count=thread_count)[0, 1]
+        except Exception as e:
+            errors[pos] = f"Модель не смогла обработать данные: {str(e)}"
+
+    return probabilities, errors
+
+
+# Модель в процессе-воркере: (версия, модель).
+# Загружается при первом пакете и после горячей замены в основном процессе.
+# Путь к файлу у всех версий один, поэтому версия прочитанного файла сверяется с запрошенной:
+# запрос со старым снимком после горячей замены иначе посчитался бы новой моделью,
+# а в истории записался бы со старой версией
+_worker_model = (None, None)
+
+
+def _score_in_process(model_path, version, rows, thread_count, model=None):
+    """
+    Прогноз в процессе-воркере с кешированием модели по версии
+
+    Args:
+        model: модель запрошенной версии из основного процесса (None - прочитать файл)
+
+    Returns:
+        tuple | None: результат score_batch; None - в файле уже другая версия модели
+    """
+    global _worker_model
+
+    if _worker_model[0] != version:
+        if model is None:
+            try:
+                model, file_version, _ = read_model_file(model_path)
+            except OSError:
+                # Файл в процессе замены
+                return None
+            if file_version != version:
+                return None
+        _worker_model = (version, model)
+
+    return score_batch(_worker_model[1], rows, thread_count)
+
+
+class InferenceExecutor:
+    """
+    Ограниченный пул для вызова модели вне event loop
+
+    Args:
+        kind: "thread" - пул потоков (CatBoost отпускает GIL во время прогноза),
+              "process" - пул процессов (модель загружается в каждом процессе)
+        max_workers: количество воркеров
+        max_queue: сколько пакетов может ждать свободного воркера
+        thread_count: потоки CatBoost на один вызов модели
+    """
+
+    def __init__(
+        self,
+        kind: str = INFERENCE_EXECUTOR,
+        max_workers: int = INFERENCE_WORKERS,
+        max_queue: int = INFERENCE_MAX_QUEUE,
+        thread_count: int = CATBOOST_THREAD_COUNT
+    ):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Неизвестный тип пула: {kind}. Допустимо: 'thread', 'process'")
+
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.thread_count = thread_count
+        self._pool: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        self._pending = 0
+
+        self._queue_depth = metrics.gauge("inference_pending_batches")
+        self._wait_time = metrics.histogram("inference_slot_wait_seconds")
+        self._stale_model = metrics.counter("inference_stale_model_file")
+
+    def start(self) -> None:
+        if self._pool is not None:
+            return
+
+        if self.kind == "process":
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="inference"
+            )
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    async def run(self, loaded: LoadedModel, rows):
+        """
+        Посчитать пакет в пуле
+
+        Returns:
+            tuple: (массив вероятностей, словарь {позиция строки: ошибка})
+        """
+        if self._pool is None:
+            # Пул не запущен (например, без lifespan) - считаем в текущем потоке
+            return score_batch(loaded.model, rows, self.thread_count)
+
+        started = time.perf_counter()
+        async with self._slots:
+            self._wait_time.observe(time.perf_counter() - started)
+            self._pending += 1
+            self._queue_depth.set(self._pending)
+            try:
+                loop = asyncio.get_running_loop()
+                if self.kind == "process":
+                    result = await loop.run_in_executor(
+                        self._pool, _score_in_process,
+                        loaded.model_path, loaded.version, rows, self.thread_count
+                    )
+                    if result is None:
+                        # Файл модели уже заменен: передаем воркеру модель своего снимка
+                        # (модель сериализуется, но только в момент горячей замены)
+                        self._stale_model.inc()
+                        result = await loop.run_in_executor(
+                            self._pool, _score_in_process,
+                            loaded.model_path, loaded.version, rows, self.thread_count, loaded.model
+                        )
+                    return result
+                return await loop.run_in_executor(
+                    self._pool, score_batch, loaded.model, rows, self.thread_count
+                )
+            finally:
+                self._pending -= 1
+                self._queue_depth.set(self._pending)
+
+
+# Пул на весь процесс
+inference_executor = InferenceExecutor()
+
+
+def get_inference_executor() -> InferenceExecutor:
+    """Зависимость FastAPI: пул для вызова модели"""
+    return inference_executor
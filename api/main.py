@@ -10,7 +10,14 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, status
 
-from api.database import engine, init_db
+from api.batching import micro_batcher
+from api.config import LOOP_LAG_INTERVAL
+from api.database import dispose_engines, init_db
+from api.dependencies import model_registry
+from api.history_archive import history_archiver
+from api.history_writer import history_writer
+from api.inference import inference_executor
+from api.metrics import LoopLagMonitor, metrics
 from api.middleware import PredictionHistoryMiddleware
 from api.routers import forward, history
 
@@ -28,10 +35,37 @@ async def lifespan(app: FastAPI):
     await init_db()
     print("База данных инициализирована")
 
+    # Запускаем фоновую запись истории предсказаний
+    await history_writer.start()
+
+    # Запускаем перенос старой истории в архив
+    history_archiver.start()
+
+    # Загружаем модель и список переменных один раз на весь процесс
+    await model_registry.load()
+    model_registry.start_watching()
+    print(f"Модель загружена, версия {model_registry.version}")
+
+    # Запускаем пул для вызова модели и диспетчер микро-пакетов
+    inference_executor.start()
+    micro_batcher.start()
+
+    # Следим за задержкой event loop
+    loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+    loop_lag_monitor.start()
+
     yield  # Приложение работает здесь
 
     # События при остановке приложения
-    await engine.dispose()
+    await loop_lag_monitor.stop()
+    await micro_batcher.stop()
+    inference_executor.shutdown()
+
+    # Останавливаем архивирование и сбрасываем в БД историю, которая еще в очереди
+    await history_archiver.stop()
+    await history_writer.stop()
+    await model_registry.stop_watching()
+    await dispose_engines()
     print("Соединение с базой данных закрыто")
     print("Приложение остановлено")
 
@@ -63,6 +97,11 @@ async def root():
                 "path": "/api/forward",
                 "description": "Получить предсказание модели"
             },
+            "prediction_batch": {
+                "method": "POST",
+                "path": "/api/forward/batch",
+                "description": "Получить предсказания модели для пакета транзакций"
+            },
             "history_all": {
                 "method": "GET",
                 "path": "/api/history",
@@ -73,6 +112,11 @@ async def root():
                 "path": "/api/history/stats",
                 "description": "Получить статистику по истории запросов"
             },
+            "metrics": {
+                "method": "GET",
+                "path": "/metrics",
+                "description": "Метрики сервиса"
+            },
             "health": {
                 "method": "GET",
                 "path": "/health",
@@ -93,10 +137,19 @@ async def health_check():
     """
     return {
         "status": "healthy",
-        "service": "ml-prediction-service"
+        "service": "ml-prediction-service",
+        "model_version": model_registry.version
     }
 
 
+@app.get("/metrics", tags=["Health"])
+async def get_metrics():
+    """
+    Эндпоинт с метриками сервиса (размеры пакетов, задержки, очереди)
+    """
+    return metrics.snapshot()
+
+
 # Регистрируем роутер для формирования прогноза
 app.include_router(forward.router, prefix="/api")
 
@@ -0,0 +1,167 @@
+# Метрики сервиса
+
+# Простые метрики в памяти процесса без внешних зависимостей:
+# - Counter - счетчик событий
+# - Gauge - текущее значение
+# - Histogram - распределение значений по корзинам (для размеров пакетов, задержек)
+
+# Снимок всех метрик отдается эндпоинтом GET /metrics
+
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Dict, Optional, Sequence
+
+# Корзины по умолчанию для задержек в секундах
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+# Корзины по умолчанию для размеров пакетов
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Текущее значение величины (глубина очереди, лаг и т.д.)"""
+
+    def __init__(self):
+        self.value = 0.0
+        self.max_value = 0.0
+
+    def set(self, value) -> None:
+        self.value = value
+        self.max_value = max(self.max_value, value)
+
+    def snapshot(self) -> dict:
+        return {"value": self.value, "max": self.max_value}
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами
+
+    Квантили оцениваются линейной интерполяцией внутри корзины,
+    поэтому точность определяется сеткой корзин
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # Последняя корзина - все значения больше верхней границы
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count > 0:
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                **{f"le_{bound}": cnt for bound, cnt in zip(self.buckets, self.counts)},
+                "le_inf": self.counts[-1],
+            },
+        }
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса. Метрика создается при первом обращении по имени"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _get(self, name: str, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = factory()
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge)
+
+    def histogram(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(name, lambda: Histogram(buckets))
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+
+
+# Реестр метрик на весь процесс
+metrics = MetricsRegistry()
+
+
+class LoopLagMonitor:
+    """
+    Измеряет задержку event loop
+
+    Фоновая задача засыпает на interval секунд и замеряет, насколько позже
+    она проснулась. Если loop заблокирован синхронным кодом, задержка растет
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task = None
+        self._lag = metrics.gauge("event_loop_lag_seconds")
+        self._lag_hist = metrics.histogram("event_loop_lag_distribution_seconds")
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self._lag.set(lag)
+            self._lag_hist.observe(lag)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -4,137 +4,100 @@
 # Этот middleware перехватывает все POST запросы к /api/forward
 # и сохраняет их вместе с результатами в базу данных
 
+# Middleware написан как чистое ASGI-приложение: тело запроса и ответа
+# не читается, не разбирается повторно и не копируется.
+# Данные для истории передает роутер через состояние запроса (request.state):
+# - history_request - провалидированные данные запроса
+# - history_response - ForwardResponse с прогнозом
+
 # Логика работы Middleware на примере 1 запроса:
 
 # Шаг 1: Клиент отправляет запрос
 # POST http://localhost:8000/api/forward
 
 # Шаг 2: Middleware перехватывает (но НЕ обрабатывает)
-# PredictionHistoryMiddleware.dispatch() запускается
-#   → читает тело запроса
+# PredictionHistoryMiddleware.__call__() запускается
 #   → запоминает время start_time
-#   → вызывает call_next(request)
+#   → передает запрос дальше без изменений
 
-# Шаг 3: call_next вызывает основной роутер
-# call_next(request) → FastAPI → forward.router → forward_prediction()
-#   → load_model()
-#   → model.predict()
-#   → возвращает ответ
+# Шаг 3: Основной роутер обрабатывает запрос
+# FastAPI → forward.router → forward_prediction()
+#   → кладет данные запроса в request.state.history_request
+#   → получает прогноз
+#   → кладет ответ в request.state.history_response
+#   → ответ уходит клиенту напрямую
 
-# Шаг 4: Middleware получает ответ от роутера
-# middleware получает response с прогнозом
-#   → читает prediction и probability из ответа
+# Шаг 4: Middleware после отправки ответа
+#   → берет данные запроса и прогноз из состояния запроса
 #   → считает время processing_time
-#   → сохраняет в БД
-#   → возвращает ответ клиенту
+#   → ставит запись в очередь history_writer (запись в БД выполняется в фоне пачками)
 
-import json
 import time
+from datetime import datetime, timezone
 
-from fastapi import Response
-from starlette.middleware.base import BaseHTTPMiddleware
-
-from .database import AsyncSessionLocal
-from .models import PredictionHistory
+from .history_writer import history_writer
 
 
-class PredictionHistoryMiddleware(BaseHTTPMiddleware):
+class PredictionHistoryMiddleware:
     """
     Middleware для логирования истории предсказаний
     Логирует каждый POST запрос к эндпоинту /api/forward
     """
-    
+
     def __init__(self, app):
-        super().__init__(app)
+        self.app = app
 
-    async def dispatch(self, request, call_next):
+    async def __call__(self, scope, receive, send):
         """
         Обработать каждый запрос
 
         Args:
-            request: HTTP запрос от клиента
-            call_next: Функция для вызова следующего обработчика
-
-        Returns:
-            Response: HTTP ответ клиенту
+            scope: описание запроса ASGI
+            receive: функция чтения тела запроса
+            send: функция отправки ответа
         """
 
         # 1. Проверяем, нужно ли логировать этот запрос
         # Логируем только POST запросы к /api/forward
-        if request.method != "POST" or not request.url.path.endswith("/api/forward"):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].endswith("/api/forward")
+        ):
             # Если это не наш запрос - просто пропускаем дальше
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
 
         # 2. Запоминаем время начала обработки
         start_time = time.time()
 
-        # 3. Читаем тело запроса
-        body_bytes = await request.body()
-
-        # 4. Сохраняем тело для повторного использования
-        request._body = body_bytes
-
-        # 5. Преобразуем данные из JSON в словарь Python
-        request_data = {}
-        if body_bytes:
-            try:
-                request_data = json.loads(body_bytes.decode("utf-8"))
-            except json.JSONDecodeError:
-                # Если клиент прислал невалидный JSON
-                request_data = {"error": "Invalid JSON"}
+        # 3. Состояние запроса - тот же словарь, что request.state в роутере
+        state = scope.setdefault("state", {})
 
-        # 6. Передаем запрос основному обработчику (нашему роутеру)
+        # 4. Передаем запрос основному обработчику (нашему роутеру)
         # Здесь вызывается функция forward_prediction из forward.py
-        response = await call_next(request)
+        await self.app(scope, receive, send)
 
-        # 7. Вычисляем сколько времени заняла обработка
+        # 5. Вычисляем сколько времени заняла обработка
         processing_time = time.time() - start_time
 
-        # 8. Читаем ответ от обработчика
-        # Ответ приходит частями, собираем их вместе
-        response_body = b""
-        async for chunk in response.body_iterator:
-            response_body += chunk
-
-        # 9. Создаем новый ответ с тем же содержимым
-        response = Response(
-            content=response_body,
-            status_code=response.status_code,
-            headers=dict(response.headers),
-            media_type=response.media_type
-        )
-
-        # 10. Извлекаем данные из ответа
-        try:
-            result = json.loads(response_body.decode("utf-8"))
-            prediction = result.get("prediction")
-            probability = result.get("probability")
-        except (json.JSONDecodeError, KeyError):
-            prediction = None
-            probability = None
-
-        # 11. Сохраняем все в базу данных
-        # async with автоматически управляет соединением
-        async with AsyncSessionLocal() as session:
-            try:
-                # Создаем новую запись истории
-                history_item = PredictionHistory(
-                    request_data=request_data,
-                    prediction=prediction,
-                    probability=probability,
-                    processing_time=processing_time
-                )
-
-                # Добавляем запись в сессию
-                session.add(history_item)
-
-                # Сохраняем в базу данных
-                await session.commit()
-
-            except Exception as e:
-                print(f"Ошибка сохранения истории: {e}")
-                # Отменяем изменения
-                await session.rollback()
-
-        # 12. Возвращаем ответ клиенту
-        return response
+        # 6. Берем данные запроса и ответа, которые оставил роутер
+        # Если запрос не прошел разбор JSON/схемы, роутер не вызывался
+        request_data = state.get("history_request")
+        if request_data is None:
+            request_data = {"error": "Invalid request"}
+
+        response = state.get("history_response")
+        prediction = response.prediction if response is not None else None
+        probability = response.probability if response is not None else None
+
+        # 7. Ставим запись в очередь на сохранение в базу данных
+        # Запись в БД выполняется фоновой задачей пачками, ответ клиенту не ждет commit
+        # Время запроса фиксируем здесь: запись в БД происходит позже, пачкой
+        await history_writer.enqueue({
+            "request_data": request_data,
+            "prediction": prediction,
+            "probability": probability,
+            "processing_time": processing_time,
+            "created_at": datetime.fromtimestamp(start_time, timezone.utc).replace(tzinfo=None)
+        })
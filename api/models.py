@@ -2,9 +2,10 @@
 
 # Этот файл определяет структуру таблиц в базе данных
 
+from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import JSON, Float, Integer
+from sqlalchemy import JSON, DateTime, Float, Integer, String, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -40,12 +41,14 @@ class PredictionHistory(Base):
     prediction: Mapped[Optional[int]] = mapped_column(
         Integer,
         nullable=True,
+        index=True,
         comment="Предсказание модели"
     )
 
     probability: Mapped[Optional[float]] = mapped_column(
         Float,
         nullable=True,
+        index=True,
         comment="Вероятность положительного класса"
     )
 
@@ -54,3 +57,90 @@ class PredictionHistory(Base):
         nullable=True,
         comment="Время обработки запроса в секундах"
     )
+
+    # Записи, созданные до появления столбца, имеют NULL
+    created_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime,
+        nullable=True,
+        server_default=func.now(),
+        index=True,
+        comment="Время запроса (UTC)"
+    )
+
+
+class HistoryRollup(Base):
+    """
+    Модель SQLAlchemy для таблицы накопленных агрегатов истории
+    Имя таблицы: history_rollup
+    Агрегаты обновляются при каждой записи пачки истории (в той же транзакции)
+    по трем уровням: час, день и вся история целиком
+    """
+    __tablename__ = "history_rollup"
+
+    granularity: Mapped[str] = mapped_column(
+        String(8),
+        primary_key=True,
+        comment="Уровень агрегации: hour, day или total"
+    )
+
+    bucket_start: Mapped[datetime] = mapped_column(
+        DateTime,
+        primary_key=True,
+        comment="Начало периода (UTC). Для total и записей без времени - 1970-01-01"
+    )
+
+    requests: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        comment="Количество запросов"
+    )
+
+    prediction_count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        comment="Количество запросов с предсказанием"
+    )
+
+    prediction_sum: Mapped[float] = mapped_column(
+        Float,
+        nullable=False,
+        default=0.0,
+        comment="Сумма предсказаний"
+    )
+
+    probability_count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        comment="Количество запросов с вероятностью"
+    )
+
+    probability_sum: Mapped[float] = mapped_column(
+        Float,
+        nullable=False,
+        default=0.0,
+        comment="Сумма вероятностей"
+    )
+
+    processing_time_count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        comment="Количество запросов со временем обработки"
+    )
+
+    processing_time_sum: Mapped[float] = mapped_column(
+        Float,
+        nullable=False,
+        default=0.0,
+        comment="Сумма времени обработки в секундах"
+    )
+
+    processing_time_sketch: Mapped[dict] = mapped_column(
+        JSON,
+        nullable=False,
+        default=dict,
+        comment="Скетч квантилей времени обработки (QuantileSketch.to_dict)"
+    )
@@ -3,34 +3,61 @@
 
 # Ключевые эндпоинты:
 # - POST /forward - Получить предсказание для одного объекта
-
-import pandas as pd
-from fastapi import APIRouter, Depends, HTTPException, status
-
-from api.dependencies import load_features_config, load_model
-from api.schemas import ForwardRequest, ForwardResponse
+# - POST /forward/batch - Получить предсказания для пакета объектов
+
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+
+from api.batching import MicroBatcher, PredictionError, get_micro_batcher
+from api.config import PREDICTION_THRESHOLD
+from api.dependencies import LoadedModel, get_loaded_model
+from api.feature_schema import FeatureSchema, FeatureValidationError
+from api.feature_store import OnlineFeatureStore, get_feature_store
+from api.inference import InferenceExecutor, get_inference_executor
+from api.schemas import (
+    ForwardBatchItem,
+    ForwardBatchRequest,
+    ForwardBatchResponse,
+    ForwardRequest,
+    ForwardResponse,
+)
 
 router = APIRouter(tags=["Predictions"])
 
 
-def validate_request_data(data, required_features):
+def validate_request_data(data, schema: FeatureSchema):
     """
-    Валидация JSON данных и преобразование их в DataFrame
+    Валидация JSON данных и преобразование их в строку значений
+    в порядке столбцов схемы модели
     """
-
-    # Проверяем наличие всех необходимых признаков
-    missing_features = [
-        feature for feature in required_features if feature not in data
-    ]
-    if missing_features:
+    try:
+        return schema.coerce_row(data)
+    except FeatureValidationError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Отсутствуют переменные: {missing_features}"
+            detail=e.message
         )
 
-    df = pd.DataFrame([data])[required_features]
 
-    return df
+def validate_batch_data(request: ForwardBatchRequest, schema: FeatureSchema):
+    """
+    Построчная валидация пакета
+
+    Невалидные строки не прерывают обработку пакета,
+    для них запоминается текст ошибки
+
+    Returns:
+        tuple: (валидные строки, индексы валидных строк,
+                словарь {индекс: ошибка}, общее количество строк)
+    """
+    if request.records is not None:
+        total = len(request.records)
+        rows, valid_idx, errors = schema.coerce_rows(request.records)
+    else:
+        total = len(next(iter(request.columns.values()), []))
+        rows, valid_idx, errors = schema.coerce_columns(request.columns)
+
+    return rows, valid_idx, errors, total
 
 
 @router.post(
@@ -50,7 +77,10 @@ def validate_request_data(data, required_features):
         }
     }
 
-    Все переменные из FINAL_FEATURES обязательны
+    Достаточно прислать сырые поля транзакции (card1, addr1, TransactionDT,
+    TransactionAmt, P_emaildomain, R_emaildomain, ...): переменные по истории карты
+    (card_addr1_pair, card_email_p, card_unique_R_email, count_168h, amt_max_24h, ...)
+    достраиваются на сервере. Присланные значения этих переменных не перезаписываются
     """,
     responses={
         403: {"description": "Модель не смогла обработать данные"},
@@ -58,30 +88,109 @@ def validate_request_data(data, required_features):
 )
 async def forward_prediction(
     request: ForwardRequest,
-    model=Depends(load_model),
-    features_config=Depends(load_features_config)
+    http_request: Request,
+    loaded: LoadedModel = Depends(get_loaded_model),
+    batcher: MicroBatcher = Depends(get_micro_batcher),
+    store: OnlineFeatureStore = Depends(get_feature_store)
 ):
-    # Получаем список переменных
-    required_features = features_config.get("FINAL_FEATURES", [])
+    # Данные запроса для истории (PredictionHistoryMiddleware) - без повторного разбора тела
+    http_request.state.history_request = {"data": request.data}
 
-    # Валидация и подготовка данных
-    df = validate_request_data(request.data, required_features)
+    # Достраиваем переменные по истории карты, состояние карты пока не меняется
+    data = store.peek(request.data)
 
-    # Получение предсказания
-    try:
-        prediction = model.predict(df)
-        probabilities = model.predict_proba(df)
+    # Модель и схема переменных берутся из реестра (загружены при старте)
+    # Валидация и приведение типов по схеме
+    row = validate_request_data(data, loaded.schema)
 
-        prediction_value = int(prediction[0])
-        probability = float(probabilities[0, 1])
+    # Получение предсказания: строка считается в общем пакете
+    # с другими конкурентными запросами одним вызовом predict_proba
+    try:
+        probability = await batcher.submit(loaded, row)
 
-    except Exception as e:
+    except PredictionError as e:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"Модель не смогла обработать данные: {str(e)}"
+            detail=str(e)
         )
 
-    return ForwardResponse(
-        prediction=prediction_value,
+    # Транзакция прошла валидацию и получила прогноз - добавляем ее в историю карты
+    store.commit(request.data)
+
+    # Бинарный прогноз по той же вероятности - без повторного прохода по деревьям
+    response = ForwardResponse(
+        prediction=int(probability > PREDICTION_THRESHOLD),
         probability=probability
     )
+
+    # Прогноз для истории
+    http_request.state.history_response = response
+
+    return response
+
+
+@router.post(
+    "/forward/batch",
+    response_model=ForwardBatchResponse,
+    summary="Пакетный прогноз вероятности фрода",
+    description="""
+    Принимает пакет транзакций и формирует прогноз одним вызовом модели
+
+    Формат запроса (по строкам):
+    {
+        "records": [
+            {"TransactionAmt": 189.0, "C1": 1.0, ...},
+            {"TransactionAmt": 35.5, "C1": 2.0, ...}
+        ]
+    }
+
+    Формат запроса (по столбцам):
+    {
+        "columns": {
+            "TransactionAmt": [189.0, 35.5],
+            "C1": [1.0, 2.0],
+            ...
+        }
+    }
+
+    Строки без всех переменных из FINAL_FEATURES не прерывают обработку:
+    для них в ответе возвращается ошибка, остальные строки получают прогноз
+    """
+)
+async def forward_batch_prediction(
+    request: ForwardBatchRequest,
+    loaded: LoadedModel = Depends(get_loaded_model),
+    executor: InferenceExecutor = Depends(get_inference_executor)
+):
+    # Валидация и приведение типов по схеме
+    rows, valid_idx, errors, total = validate_batch_data(request, loaded.schema)
+
+    # Получение предсказаний одним вызовом модели в пуле (вне event loop)
+    probabilities = np.array([])
+    if valid_idx:
+        probabilities, score_errors = await executor.run(loaded, rows)
+        for pos, error in score_errors.items():
+            errors[valid_idx[pos]] = error
+
+    # Бинарный прогноз по порогу PREDICTION_THRESHOLD
+    results = [None] * total
+    for pos, idx in enumerate(valid_idx):
+        if idx in errors:
+            continue
+        probability = float(probabilities[pos])
+        results[idx] = ForwardBatchItem(
+            index=idx,
+            success=True,
+            prediction=int(probability > PREDICTION_THRESHOLD),
+            probability=probability
+        )
+
+    for idx, error in errors.items():
+        results[idx] = ForwardBatchItem(index=idx, success=False, error=error)
+
+    return ForwardBatchResponse(
+        total=total,
+        scored=total - len(errors),
+        failed=len(errors),
+        results=results
+    )
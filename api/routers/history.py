@@ -2,17 +2,40 @@
 # Этот роутер обрабатывает GET запросы для истории предсказаний
 
 # Ключевые эндпоинты:
-# - GET /history -  Получить историю предсказаний
+# - GET /history - Получить страницу истории предсказаний
+# - GET /history/export - Выгрузить историю потоком (NDJSON)
 # - GET /history/stats - Получить статистику
+# - GET /history/rollups - Получить статистику по часам или дням
 
-from typing import List
-from sqlalchemy import select, func, desc
+# История отдается страницами по id (keyset-пагинация): страница - это записи
+# с id < cursor, отсортированные от новых к старым. В отличие от OFFSET,
+# стоимость запроса не растет с номером страницы, а вся таблица не загружается в память
+
+# Старая история переносится в Parquet архив (history_archive.py).
+# Страницы и выгрузка читают живую таблицу и архив вместе
+
+import asyncio
+import json
+from datetime import datetime
+from typing import AsyncIterator, Literal, Optional
+
+from sqlalchemy import select, desc
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
 
-from ..database import get_db
+from ..config import HISTORY_PAGE_MAX_SIZE, HISTORY_PAGE_SIZE
+from ..database import AsyncSessionLocal, get_db
+from ..history_archive import HistoryFilter, archive_max_id, iter_archive, read_archive_page
+from ..history_stats import HOUR, load_aggregate, load_rollups
 from ..models import PredictionHistory
-from ..schemas import HistoryItemResponse, HistoryStatsResponse
+from ..schemas import (
+    HistoryItemResponse,
+    HistoryPageResponse,
+    HistoryRollupItem,
+    HistoryRollupResponse,
+    HistoryStatsResponse,
+)
 
 router = APIRouter(
     prefix="/history",
@@ -22,27 +45,99 @@ router = APIRouter(
     }
 )
 
+# Столбцы выгрузки в порядке вывода
+EXPORT_COLUMNS = (
+    PredictionHistory.id,
+    PredictionHistory.created_at,
+    PredictionHistory.request_data,
+    PredictionHistory.prediction,
+    PredictionHistory.probability,
+    PredictionHistory.processing_time,
+)
+
+# Сколько строк выгрузки читается из БД за один раз
+EXPORT_CHUNK_SIZE = 1000
+
+
+def history_filters(
+    created_from: Optional[datetime] = Query(None, description="Время запроса от (UTC, включительно)"),
+    created_to: Optional[datetime] = Query(None, description="Время запроса до (UTC, не включительно)"),
+    prediction: Optional[int] = Query(None, description="Предсказание модели"),
+    min_probability: Optional[float] = Query(None, ge=0.0, le=1.0, description="Вероятность от"),
+    max_probability: Optional[float] = Query(None, ge=0.0, le=1.0, description="Вероятность до")
+) -> HistoryFilter:
+    """
+    Зависимость FastAPI: фильтр истории из параметров запроса
+
+    Каждое условие использует индекс по своему столбцу
+    """
+    return HistoryFilter(
+        created_from=created_from,
+        created_to=created_to,
+        prediction=prediction,
+        min_probability=min_probability,
+        max_probability=max_probability
+    )
+
+
+def _export_line(record: dict) -> str:
+    created_at = record["created_at"]
+    return json.dumps({
+        "id": record["id"],
+        "created_at": created_at.isoformat() if created_at else None,
+        "request_data": record["request_data"],
+        "prediction": record["prediction"],
+        "probability": record["probability"],
+        "processing_time": record["processing_time"]
+    }, ensure_ascii=False) + "\n"
+
 
 @router.get(
     "",
-    response_model=List[HistoryItemResponse],
+    response_model=HistoryPageResponse,
     summary="История запросов",
     description="""
-    Возвращает список всех запросов
+    Возвращает страницу запросов от новых к старым
+
+    Для следующей страницы передайте next_cursor из ответа в параметр cursor.
+    Если next_cursor равен null - страниц больше нет
     """
 )
 async def get_history(
+    cursor: Optional[int] = Query(None, ge=1, description="Вернуть записи с id меньше cursor"),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_PAGE_MAX_SIZE, description="Размер страницы"),
+    history_filter: HistoryFilter = Depends(history_filters),
     db: AsyncSession = Depends(get_db)
-) -> List[HistoryItemResponse]:
+) -> HistoryPageResponse:
     try:
-        # Простой запрос - все записи отсортированные по id
-        query = select(PredictionHistory).order_by(desc(PredictionHistory.id))
+        query = select(PredictionHistory).where(*history_filter.sql_conditions())
+        if cursor is not None:
+            query = query.where(PredictionHistory.id < cursor)
+
+        # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+        query = query.order_by(desc(PredictionHistory.id)).limit(limit + 1)
 
         # Выполнить запрос
         result = await db.execute(query)
-        history_items = result.scalars().all()
-
-        return list(history_items)
+        history_items = [HistoryItemResponse.model_validate(item) for item in result.scalars()]
+
+        # Добираем страницу из архива, если в нем могут быть записи новее найденных
+        max_archived = archive_max_id()
+        if max_archived is not None and (
+            len(history_items) <= limit or history_items[-1].id < max_archived
+        ):
+            archived = await asyncio.to_thread(read_archive_page, history_filter, cursor, limit + 1)
+            items_by_id = {item["id"]: HistoryItemResponse(**item) for item in archived}
+            # Запись может оказаться и в архиве, и в таблице, если перенос прервался
+            items_by_id.update((item.id, item) for item in history_items)
+            history_items = sorted(items_by_id.values(), key=lambda item: item.id, reverse=True)
+
+        next_cursor = None
+        if len(history_items) > limit:
+            history_items = history_items[:limit]
+            next_cursor = history_items[-1].id
+
+        return HistoryPageResponse(items=history_items, next_cursor=next_cursor)
 
     except Exception as e:
         raise HTTPException(
@@ -51,6 +146,45 @@ async def get_history(
         )
 
 
+async def _export_lines(history_filter: HistoryFilter) -> AsyncIterator[bytes]:
+    """Строки выгрузки в формате NDJSON: сначала живая таблица частями, затем архив по файлам"""
+    query = (
+        select(*EXPORT_COLUMNS)
+        .where(*history_filter.sql_conditions())
+        .order_by(desc(PredictionHistory.id))
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+
+    # Сессия открывается внутри генератора: ответ отправляется после выхода из эндпоинта
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            yield "".join(_export_line(row._mapping) for row in rows).encode("utf-8")
+
+    # Архивные файлы читаются вне event loop
+    archive = iter_archive(history_filter)
+    while True:
+        records = await asyncio.to_thread(next, archive, None)
+        if records is None:
+            break
+        if records:
+            yield "".join(_export_line(record) for record in records).encode("utf-8")
+
+
+@router.get(
+    "/export",
+    summary="Выгрузка истории",
+    description="""
+    Выгружает историю от новых к старым в формате NDJSON (одна запись JSON на строку)
+
+    Поддерживает те же фильтры, что и GET /api/history.
+    Записи читаются из БД и архива и отправляются клиенту частями
+    """
+)
+async def export_history(history_filter: HistoryFilter = Depends(history_filters)) -> StreamingResponse:
+    return StreamingResponse(_export_lines(history_filter), media_type="application/x-ndjson")
+
+
 @router.get(
     "/stats",
     response_model=HistoryStatsResponse,
@@ -62,41 +196,49 @@ async def get_history(
         - Кол-во запросов
         - Средний прогноз
         - Среднее время обработки запросов
+        - Медиана, 95-й и 99-й процентили времени обработки (точность ~1%)
+
+    Статистики накапливаются при записи истории, поэтому запрос
+    не зависит от размера таблицы истории
     """)
 async def get_history_stats(db: AsyncSession = Depends(get_db)):
     try:
-        # Общее количество
-        total_result = await db.execute(
-            select(func.count(PredictionHistory.id))
-        )
-        total = total_result.scalar_one()
+        # Одна строка агрегатов за всю историю
+        aggregate = await load_aggregate(db)
+        return HistoryStatsResponse(**aggregate.summary())
 
-        # Среднее предсказание
-        avg_pred_result = await db.execute(
-            select(func.avg(PredictionHistory.prediction))
-            .where(PredictionHistory.prediction.isnot(None))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
         )
-        avg_prediction = avg_pred_result.scalar_one()
 
-        # Средняя вероятность
-        avg_prob_result = await db.execute(
-            select(func.avg(PredictionHistory.probability))
-            .where(PredictionHistory.probability.isnot(None))
-        )
-        avg_probability = avg_prob_result.scalar_one()
 
-        # Среднее время обработки
-        avg_time_result = await db.execute(
-            select(func.avg(PredictionHistory.processing_time))
-            .where(PredictionHistory.processing_time.isnot(None))
-        )
-        avg_processing_time = avg_time_result.scalar_one()
+@router.get(
+    "/rollups",
+    response_model=HistoryRollupResponse,
+    summary="Статистика запросов по периодам",
+    description="""
+    Возвращает статистики по часам (granularity=hour) или дням (granularity=day)
+    от новых периодов к старым
 
-        return HistoryStatsResponse(
-            total_requests=total,
-            average_prediction=float(avg_prediction),
-            average_probability=float(avg_probability),
-            average_processing_time=float(avg_processing_time)
+    Записи, сохраненные до появления времени запроса, относятся к периоду 1970-01-01
+    """)
+async def get_history_rollups(
+    granularity: Literal["hour", "day"] = Query(HOUR, description="Длина периода"),
+    created_from: Optional[datetime] = Query(None, description="Начало периода от (UTC, включительно)"),
+    created_to: Optional[datetime] = Query(None, description="Начало периода до (UTC, не включительно)"),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_PAGE_MAX_SIZE, description="Количество периодов"),
+    db: AsyncSession = Depends(get_db)
+) -> HistoryRollupResponse:
+    try:
+        rollups = await load_rollups(db, granularity, created_from, created_to, limit)
+        return HistoryRollupResponse(
+            granularity=granularity,
+            items=[
+                HistoryRollupItem(bucket_start=bucket_start, **aggregate.summary())
+                for bucket_start, aggregate in rollups
+            ]
         )
 
     except Exception as e:
@@ -10,9 +10,12 @@
 # - Field() используется для добавления метаданных и валидации
 # - ConfigDict настраивает поведение Pydantic
 
-from typing import Any, Dict, Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+
+from api.config import BATCH_MAX_ROWS
 
 
 class ForwardRequest(BaseModel):
@@ -87,6 +90,109 @@ class ForwardResponse(BaseModel):
     )
 
 
+class ForwardBatchRequest(BaseModel):
+    """
+    Схема для запроса пакета транзакций
+
+    Используется: POST /api/forward/batch
+    Данные передаются в одном из двух форматов:
+    - records: список словарей (одна транзакция = один словарь)
+    - columns: словарь массивов (одна переменная = один массив значений)
+    """
+    records: Optional[List[Dict[str, Any]]] = Field(
+        None,
+        max_length=BATCH_MAX_ROWS,
+        description="Список транзакций в формате {переменная: значение}",
+        examples=[[{"TransactionAmt": 189.0, "C1": 1.0}, {"TransactionAmt": 35.5, "C1": 2.0}]]
+    )
+    columns: Optional[Dict[str, List[Any]]] = Field(
+        None,
+        description="Транзакции по столбцам в формате {переменная: [значения]}",
+        examples=[{"TransactionAmt": [189.0, 35.5], "C1": [1.0, 2.0]}]
+    )
+
+    @model_validator(mode="after")
+    def check_format(self):
+        """Должен быть передан ровно один формат, массивы столбцов одной длины"""
+        if (self.records is None) == (self.columns is None):
+            raise ValueError("Нужно передать ровно одно из полей: 'records' или 'columns'")
+
+        if self.columns is not None:
+            lengths = {len(values) for values in self.columns.values()}
+            if len(lengths) > 1:
+                raise ValueError(f"Столбцы имеют разную длину: {sorted(lengths)}")
+            if lengths and lengths.pop() > BATCH_MAX_ROWS:
+                raise ValueError(f"Превышен размер пакета: не более {BATCH_MAX_ROWS} строк")
+
+        return self
+
+
+class ForwardBatchItem(BaseModel):
+    """
+    Результат по одной строке пакета
+
+    Используется: элемент ответа POST /api/forward/batch
+    Для невалидных строк заполняется только поле error
+    """
+    index: int = Field(
+        ...,
+        ge=0,
+        description="Порядковый номер строки в запросе"
+    )
+    success: bool = Field(
+        ...,
+        description="Удалось ли получить прогноз для строки"
+    )
+    prediction: Optional[int] = Field(
+        None,
+        ge=0,
+        le=1,
+        description="Предсказание модели"
+    )
+    probability: Optional[float] = Field(
+        None,
+        ge=0.0,
+        le=1.0,
+        description="Вероятность положительного класса"
+    )
+    error: Optional[str] = Field(
+        None,
+        description="Описание ошибки валидации или прогноза"
+    )
+
+
+class ForwardBatchResponse(BaseModel):
+    """
+    Схема для ответа с прогнозами по пакету
+
+    Используется: ответ POST /api/forward/batch
+    Результаты возвращаются в том же порядке, что и строки запроса
+    """
+    success: bool = Field(
+        default=True,
+        description="Успешно ли выполнен запрос"
+    )
+    total: int = Field(
+        ...,
+        ge=0,
+        description="Количество строк в запросе"
+    )
+    scored: int = Field(
+        ...,
+        ge=0,
+        description="Количество строк с прогнозом"
+    )
+    failed: int = Field(
+        ...,
+        ge=0,
+        description="Количество строк с ошибкой"
+    )
+    results: List[ForwardBatchItem] = Field(
+        ...,
+        description="Результаты по строкам"
+    )
+
+
 class HistoryItemResponse(BaseModel):
     """
     Схема для ответа с элементом истории
@@ -114,11 +220,32 @@ class HistoryItemResponse(BaseModel):
         None,
         description="Время обработки запроса в секундах"
     )
+    created_at: Optional[datetime] = Field(
+        None,
+        description="Время запроса (UTC)"
+    )
 
     # Конфигурация для работы с SQLAlchemy моделями
     model_config = ConfigDict(from_attributes=True)
 
 
+class HistoryPageResponse(BaseModel):
+    """
+    Схема для страницы истории
+
+    Используется: ответ GET /api/history
+    Записи отсортированы от новых к старым
+    """
+    items: List[HistoryItemResponse] = Field(
+        ...,
+        description="Записи истории на странице"
+    )
+    next_cursor: Optional[int] = Field(
+        None,
+        description="Значение cursor для следующей страницы (None - страниц больше нет)"
+    )
+
+
 class HistoryStatsResponse(BaseModel):
     """
     Схема для статистики истории
@@ -148,3 +275,47 @@ class HistoryStatsResponse(BaseModel):
         ge=0.0,
         description="Среднее время обработки запроса в секундах"
     )
+    processing_time_p50: Optional[float] = Field(
+        None,
+        ge=0.0,
+        description="Медиана времени обработки запроса в секундах"
+    )
+    processing_time_p95: Optional[float] = Field(
+        None,
+        ge=0.0,
+        description="95-й процентиль времени обработки запроса в секундах"
+    )
+    processing_time_p99: Optional[float] = Field(
+        None,
+        ge=0.0,
+        description="99-й процентиль времени обработки запроса в секундах"
+    )
+
+
+class HistoryRollupItem(HistoryStatsResponse):
+    """
+    Схема для статистики истории за период
+
+    Используется: элемент ответа GET /api/history/rollups
+    """
+    bucket_start: datetime = Field(
+        ...,
+        description="Начало периода (UTC)"
+    )
+
+
+class HistoryRollupResponse(BaseModel):
+    """
+    Схема для статистики истории по периодам
+
+    Используется: ответ GET /api/history/rollups
+    Периоды отсортированы от новых к старым
+    """
+    granularity: str = Field(
+        ...,
+        description="Длина периода: hour или day"
+    )
+    items: List[HistoryRollupItem] = Field(
+        ...,
+        description="Статистика по периодам"
+    )
@@ -0,0 +1,52 @@
+"""
+Benchmark of adaptive quantile binning (StabilityIndexCalculator.adaptive_qcut).
+
+Compares current implementation with the previous one (benchmarks/qcut_reference.py)
+on large skewed, low-cardinality and heavy-tie distributions. Bin edges are checked
+to be identical on every sample (the same check on many small samples - tests/test_psi_qcut.py).
+
+Usage:
+	python -m benchmarks.benchmark_qcut [--n 10000000] [--q 10]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.qcut_reference import distributions, reference_adaptive_qcut
+from utils.psi.stability import StabilityIndexCalculator
+
+
+def run_benchmark(rng, n, q):
+	calculator = StabilityIndexCalculator()
+	rows = []
+	for name, variable in distributions(rng, n).items():
+		start = time.perf_counter()
+		expected = reference_adaptive_qcut(calculator, variable, q)
+		t_ref = time.perf_counter() - start
+
+		start = time.perf_counter()
+		result = calculator.adaptive_qcut(variable, q)
+		t_new = time.perf_counter() - start
+
+		assert np.array_equal(expected, result), name
+		rows.append((name, t_ref, t_new, len(result) - 1))
+	return rows
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--n", type=float, default=1e7, help="values in benchmark samples")
+	parser.add_argument("--q", type=int, default=10, help="number of bins")
+	parser.add_argument("--seed", type=int, default=7)
+	args = parser.parse_args()
+	rng = np.random.default_rng(args.seed)
+
+	n = int(args.n)
+	print(f"adaptive_qcut(q={args.q}), n={n:,}")
+	for name, t_ref, t_new, n_bins in run_benchmark(rng, n, args.q):
+		print(f"{name:18s} old {t_ref:6.2f}s  new {t_new:6.2f}s  x{t_ref / t_new:4.1f}  bins={n_bins}")
+
+
+if __name__ == "__main__":
+	main()
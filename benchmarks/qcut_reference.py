@@ -0,0 +1,172 @@
+"""
+Previous implementation of adaptive quantile binning (StabilityIndexCalculator.adaptive_qcut)
+and sample distributions to compare it with the current one.
+
+Previous version sorted and ran np.unique on every q decrement and used python loops
+in initiate_bins / qcut_correction. Current version must give identical bin edges:
+checked by tests/test_psi_qcut.py, timings - benchmarks/benchmark_qcut.py
+"""
+import numpy as np
+
+
+# REFERENCE (previous implementation)
+def reference_find_adaptive_qcut_bins(variable, q, left_minv=0.0001):
+	"""
+	Algorithm for finding optimal quantile bins.
+	Made for cases when one value has more than q repetions in variable.
+	This creates 'duplicate bins' for pandas.qcut and decreases q.
+
+	Algorithm first assignes bins to quantiles as pd.qcut, but then instead of dropping
+	duplicate bins moves them to better positions if possible
+	"""
+	var = np.array(variable)
+	# not working with nans, they will stay inplace
+	var_notna = var[~np.isnan(var)].copy()
+	var_sorted = np.sort(var_notna)
+
+	# get counts
+	var_unique, var_counts = np.unique(var_sorted, return_counts=1)
+	var_counts = np.append([0], var_counts)
+	var_unique = np.append([var_unique[0] - left_minv], var_unique)
+
+	assert (var_unique == np.sort(var_unique)).all()
+
+	var_cnt_csum = var_counts.cumsum()
+	expected_len = len(var_sorted) / q
+
+	# initiate bins (qcut on unique values)
+	bins_cs_idxs = reference_initiate_bins(q, var_cnt_csum, var_unique, expected_len)
+
+	# adaptive correction of initiated bins
+	bins_cs_idxs = reference_qcut_correction(q, bins_cs_idxs, var_cnt_csum)
+
+	bins = var_unique[bins_cs_idxs]
+	bucket_sizes = var_cnt_csum[bins_cs_idxs][1:] - var_cnt_csum[bins_cs_idxs][:-1]
+
+	bins = np.sort(np.unique(bins))
+	return bins, bucket_sizes
+
+def reference_initiate_bins(q, var_cnt_csum, var_unique, expected_len):
+	norm_cnt_csum = var_cnt_csum / expected_len
+	# look for closest value to expected_len
+	bins_cs_idxs = [0]
+	for i in range(1, q):
+		_idx = (norm_cnt_csum < i).sum()
+		if abs(norm_cnt_csum[_idx - 1] - i) > abs(norm_cnt_csum[_idx] - i):
+				bins_cs_idxs.append(_idx)
+		else:
+			bins_cs_idxs.append(_idx - 1)
+	bins_cs_idxs.append(len(var_unique) - 1)
+	# or_bins = np.sort(np.unique(var_unique[bins_cs_idxs]))
+
+	# if qcut failed with duplicate edges, use unique elements
+	if len(bins_cs_idxs) != len(np.unique(bins_cs_idxs)):
+		added_bins = np.unique(bins_cs_idxs).copy()
+		n_add = len(bins_cs_idxs) - len(np.unique(bins_cs_idxs)) # how many bins to add
+		for n in range(n_add):
+			bucket_sizes = var_cnt_csum[added_bins][1:] - var_cnt_csum[added_bins][:-1] # difference between counts
+			for _idx_insert in np.argsort(bucket_sizes)[::-1] + 1:
+				if added_bins[_idx_insert] - added_bins[_idx_insert - 1] > 1: # if has unique values between edges
+					if added_bins[_idx_insert] - added_bins[_idx_insert - 1] == 2:
+						_val_insert = int(np.round(np.mean([added_bins[_idx_insert], added_bins[_idx_insert - 1]])))
+					else:
+						_il, _ir = added_bins[_idx_insert - 1], added_bins[_idx_insert]
+						_arr_counts = var_cnt_csum[_il + 1: _ir]
+						_elen = var_cnt_csum[_il] + (var_cnt_csum[_ir] - var_cnt_csum[_il]) / 2
+						# choose left or right value
+						_idx = int(np.clip((_arr_counts < _elen).sum(), 0, len(_arr_counts) - 1))
+						if abs(_arr_counts[_idx - 1] - _elen) > abs(_arr_counts[_idx] - _elen):
+							_val_insert = _il + _idx
+						else:
+							_val_insert = _il + _idx + 1
+					break
+			# print(_idx_insert, _val_insert, var_unique[_val_insert])
+			added_bins = np.insert(added_bins, _idx_insert, _val_insert)
+
+		bins_cs_idxs = np.array(added_bins)
+	else:
+		bins_cs_idxs = np.array(bins_cs_idxs)
+
+	return bins_cs_idxs
+
+def reference_qcut_correction(q, bins_cs_idxs, var_cnt_csum):
+	bins_ids = np.arange(q + 1)
+	forbid_move_bins = np.array([])
+	metr_bucket_sizes = []
+	counter = 0
+	# while all bins expect edges are not forbidden to move
+	while (counter < q * 10) & (len(forbid_move_bins) != len(bins_ids) - 2):
+		# get sizes of buckets
+		bucket_sizes = (
+			var_cnt_csum[bins_cs_idxs][1:] - var_cnt_csum[bins_cs_idxs][:-1]
+		)
+		bucket_sizes_diff = np.abs(bucket_sizes[:-1] - bucket_sizes[1:])
+
+		metr_bucket_sizes.append(np.std(bucket_sizes))
+
+		# reindex bin ids for bucket_sizes
+		forbid_buckets_idxs = np.unique(
+			np.clip(forbid_move_bins - 1, 0, max(bins_ids) - 1)
+		).astype(int)
+		# set forbidden bins to 0
+		if len(forbid_buckets_idxs) > 0:
+			bucket_sizes_diff[forbid_buckets_idxs] = 0
+
+		# if nothing to move
+		if bucket_sizes_diff.max() == 0:
+			break
+
+		# worse position
+		move_bin_id = bins_ids[bucket_sizes_diff.argmax() + 1]
+
+		prev_pos_idx = bins_cs_idxs[move_bin_id]
+
+		# find middle of the segment and closest array value to it
+		middle_cs_val = (
+			var_cnt_csum[
+				[bins_cs_idxs[move_bin_id - 1], bins_cs_idxs[move_bin_id + 1]]
+			].sum()
+			/ 2
+		)
+		new_pos_idx = np.abs(var_cnt_csum - middle_cs_val).argmin()
+
+		# if moved then releasing neighboors from forbid_move_bins
+		if prev_pos_idx != new_pos_idx:
+			bins_cs_idxs[move_bin_id] = new_pos_idx
+			forbid_move_bins = forbid_move_bins[
+				~np.isin(forbid_move_bins, [move_bin_id - 1, move_bin_id + 1])
+			]
+
+		# always add last moded/attempted bin to forbidden
+		forbid_move_bins = np.unique(np.append(forbid_move_bins, move_bin_id))
+
+		counter += 1
+
+	return bins_cs_idxs
+
+
+def reference_adaptive_qcut(calculator, variable, q):
+	min_bucket_size = (len(variable) / q) * calculator.min_bin_coeff
+
+	bins, bucket_sizes = reference_find_adaptive_qcut_bins(variable, q, calculator.left_minv)
+
+	while (bucket_sizes.min() < min_bucket_size) & (q > 1):
+		q = q - 1
+		bins, bucket_sizes = reference_find_adaptive_qcut_bins(variable, q)
+
+	return bins
+
+
+# SAMPLES
+def distributions(rng, n):
+	return {
+		"normal": rng.normal(size=n),
+		"lognormal skewed": rng.lognormal(0, 2, n),
+		"zero inflated": np.where(rng.random(n) < 0.7, 0.0, rng.exponential(3, n)),
+		"low cardinality": rng.integers(0, 15, n).astype(float),
+		"heavy ties": np.round(rng.gamma(0.5, 2, n), 1),
+		"few huge ties": rng.choice(
+			[0.0, 1.0, 2.0, 5.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0, 16.0, 17.0, 18.0], n, p=[0.5, 0.2, 0.1] + [0.02] * 10
+		),
+		"nans + ints": np.where(rng.random(n) < 0.2, np.nan, rng.poisson(3, n)).astype(float),
+	}
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from api.card_windows import CardWindows
+from utils.time_features_utils import make_time_window_features
+
+DAY = 86400
+
+
+def assert_same(online, offline):
+    bad = {
+        col: (value, offline[col]) for col, value in online.items()
+        if not (value == offline[col] or (value != value and offline[col] != offline[col]))
+    }
+    assert not bad
+
+
+def offline_row(times, amounts, row):
+    data = pd.DataFrame({'card1': 1.0, 'TransactionDT': times, 'TransactionAmt': amounts})
+    return make_time_window_features(data).loc[row]
+
+
+def snapshot(windows):
+    # байты, а не значения: в состоянии есть nan
+    return [getattr(windows, name).tobytes() for name in
+            ('buffer', 'state', 'sorted_amounts', 'max_queue', 'min_queue')] + [repr(windows.prev_time)]
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_stream_matches_offline_bit_for_bit(seed):
+    # повторяющиеся суммы, пропуски сумм и одинаковое время внутри карты
+    rng = np.random.default_rng(seed)
+    n = 4000
+    data = pd.DataFrame({
+        'card1': rng.integers(0, 40, n).astype(float),
+        'TransactionDT': np.sort(rng.integers(0, 30 * DAY, n)).astype(float),
+        'TransactionAmt': rng.choice([10.0, 25.5, 99.99, 3.0, 0.1], n) * rng.choice([1.0, 1.37], n),
+    })
+    data.loc[rng.random(n) < 0.05, 'TransactionAmt'] = np.nan
+    offline = make_time_window_features(data.copy()).sort_index()
+
+    cards, committed = {}, {}
+    for idx, card, dt, amount in data[['card1', 'TransactionDT', 'TransactionAmt']].itertuples():
+        windows = cards.setdefault(card, CardWindows())
+        peeked = windows.peek(dt, amount)
+        features = windows.update(dt, amount)
+        assert peeked.keys() == features.keys()
+        assert_same(peeked, features)
+        assert_same(features, offline.loc[idx])
+
+        # commit после peek переиспользует его суммы, после чужого peek - считает заново
+        other = committed.setdefault(card, CardWindows())
+        other.peek(dt, amount)
+        if idx % 3 == 0:
+            other.peek(dt + 1.0, 1.0)
+        other.commit(dt, amount)
+        assert snapshot(other) == snapshot(windows)
+
+
+def test_late_transaction_after_trim_uses_evicted_neighbour():
+    times = [0.0, 1000.0, 30.0 * DAY]
+    windows = CardWindows()
+    for i, dt in enumerate(times):
+        windows.update(dt, 10.0 + i)
+    # две первые транзакции отрезаны, опоздавшая встает в начало буфера
+    assert len(windows) == 1
+
+    features = windows.update(29.0 * DAY, 7.0)
+    assert features['time_since_last_1h'] == 29.0 * DAY - 1000.0
+    assert_same(features, offline_row(times + [29.0 * DAY], [10.0, 11.0, 12.0, 7.0], 3))
+
+
+def test_late_transaction_older_than_trimmed_history_is_skipped():
+    windows = CardWindows()
+    for dt in [0.0, 1000.0, 30.0 * DAY]:
+        windows.update(dt, 10.0)
+
+    assert windows.update(1500.0, 7.0) == {}
+    assert len(windows) == 1
+
+
+def test_peek_does_not_change_state():
+    # убывающие суммы: в очереди максимума - все транзакции окна
+    windows = CardWindows()
+    for i, dt in enumerate(np.arange(0, 10 * DAY, 3600.0)):
+        windows.update(float(dt), 1000.0 - i)
+    before = snapshot(windows)
+
+    windows.peek(10.0 * DAY, 8.0)
+    windows.peek(9.5 * DAY, 8.0)
+    windows.peek(12.0 * DAY, float('nan'))
+    windows.peek(14.0 * DAY, 2000.0)
+    assert snapshot(windows) == before
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.dtype_utils import infer_parquet_dtypes, read_features_parquet
+
+
+def write_batches(path, columns, row_group_size=10):
+    pq.write_table(pa.table(columns), path, row_group_size=row_group_size)
+
+
+def test_int_column_with_nulls_in_later_batches(tmp_path):
+    # первые пачки без пропусков (pandas: int64), в последней - пропуск (pandas: float64)
+    path = tmp_path / 'ints.parquet'
+    big = [16_777_217] + list(range(19)) + [None] + list(range(9))
+    small = list(range(20)) + [None] * 10
+    write_batches(path, {
+        'big': pa.array(big, pa.int64()),
+        'small': pa.array(small, pa.int64()),
+        'dense': pa.array(range(30), pa.int64()),
+    })
+
+    dtypes = infer_parquet_dtypes(path, batch_rows=10)
+    assert dtypes == {'big': 'Int32', 'small': 'Int8', 'dense': 'int8'}
+
+    data = read_features_parquet(path, dtypes, batch_rows=10)
+    assert data.dtypes.astype(str).to_dict() == dtypes
+    assert list(data.columns) == ['big', 'small', 'dense']
+    pd.testing.assert_series_equal(data['big'], pd.Series(big, dtype='Int32', name='big'))
+    pd.testing.assert_series_equal(data['small'], pd.Series(small, dtype='Int8', name='small'))
+
+
+def test_float_column_keeps_float32_check_across_batches(tmp_path):
+    path = tmp_path / 'floats.parquet'
+    values = np.r_[np.full(10, 0.5), [0.1], np.full(9, 2.0)]
+    write_batches(path, {'amount': pa.array(values, pa.float64())})
+
+    assert infer_parquet_dtypes(path, batch_rows=10) == {'amount': 'float64'}
+    data = read_features_parquet(path, batch_rows=10)
+    np.testing.assert_array_equal(data['amount'].to_numpy(), values)
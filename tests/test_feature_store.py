@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from api.feature_store import OnlineFeatureStore
+from utils.card_features_utils import make_card_features
+from utils.cat_features_utils import preparing_cat_features
+
+
+def transaction(card, dt, amount, p_email='gmail.com'):
+    return {'card1': card, 'TransactionDT': dt, 'TransactionAmt': amount,
+            'addr1': 325.0, 'P_emaildomain': p_email, 'R_emaildomain': None}
+
+
+def test_peek_does_not_change_card_state():
+    store = OnlineFeatureStore()
+    store.commit(transaction(1, 0.0, 10.0))
+
+    first = store.peek(transaction(1, 600.0, 20.0, 'yahoo.com'))
+    second = store.peek(transaction(1, 600.0, 20.0, 'yahoo.com'))
+    assert first == second
+    assert first['count_1h'] == 2.0
+
+    # карта без commit в хранилище не появляется
+    store.peek(transaction(2, 600.0, 20.0))
+    assert len(store) == 1
+
+
+def test_commit_adds_transaction_to_history():
+    store = OnlineFeatureStore()
+    for dt in [0.0, 600.0, 1200.0]:
+        features = store.peek(transaction(1, dt, 10.0))
+        store.commit(transaction(1, dt, 10.0))
+
+    assert features['count_1h'] == 3.0
+    assert features['amt_sum_1h'] == 30.0
+    assert store.peek(transaction(1, 1800.0, 10.0))['count_1h'] == 4.0
+
+
+def test_unique_emails_match_point_in_time_features():
+    # и онлайн, и офлайн текущая транзакция в количество уникальных доменов не входит
+    rng = np.random.default_rng(0)
+    n = 500
+    emails = np.array(['gmail.com', 'yahoo.com', None, 'anonymous.com'], dtype=object)
+    raw = pd.DataFrame({
+        'card1': rng.integers(0, 20, n).astype(float),
+        'TransactionDT': np.arange(n, dtype=float) * 60,
+        'TransactionAmt': 10.0,
+        'P_emaildomain': emails[rng.integers(0, 4, n)],
+        'R_emaildomain': emails[rng.integers(0, 4, n)],
+    })
+    columns = ['card_unique_P_email', 'card_unique_R_email']
+    data = preparing_cat_features(raw.copy(), features=['P_emaildomain_new', 'R_emaildomain_new'])
+    offline = make_card_features(data, point_in_time=True, features=columns)
+
+    store = OnlineFeatureStore()
+    online = []
+    for record in raw.to_dict('records'):
+        features = store.peek(record)
+        store.commit(record)
+        online.append([features[col] for col in columns])
+
+    assert online[0] == [0.0, 0.0]
+    np.testing.assert_array_equal(np.array(online), offline[columns].to_numpy())
@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from catboost import CatBoostClassifier
+
+from api import inference
+from api.dependencies import read_model_file
+from api.inference import InferenceExecutor, _score_in_process
+
+
+def train_model(seed):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(200, 3))
+    y = (X[:, seed % 3] > 0).astype(int)
+    return CatBoostClassifier(iterations=5, depth=2, random_seed=seed, verbose=False,
+                              allow_writing_files=False).fit(X, y)
+
+
+@pytest.fixture
+def hot_swapped(tmp_path):
+    """Снимок старой модели и файл, уже перезаписанный новой моделью"""
+    path = tmp_path / 'model.cbm'
+    old, new = train_model(0), train_model(1)
+    old.save_model(str(path))
+    _, old_version, _ = read_model_file(path)
+    new.save_model(str(path))
+    _, new_version, _ = read_model_file(path)
+    assert old_version != new_version
+
+    rows = np.random.default_rng(2).normal(size=(5, 3)).tolist()
+    inference._worker_model = (None, None)
+    yield SimpleNamespace(path=path, old=old, new=new, old_version=old_version,
+                          new_version=new_version, rows=rows)
+    inference._worker_model = (None, None)
+
+
+def test_worker_does_not_cache_new_file_under_old_version(hot_swapped):
+    s = hot_swapped
+    assert _score_in_process(s.path, s.old_version, s.rows, 1) is None
+    assert inference._worker_model == (None, None)
+
+    probabilities, errors = _score_in_process(s.path, s.old_version, s.rows, 1, s.old)
+    np.testing.assert_array_equal(probabilities, s.old.predict_proba(s.rows)[:, 1])
+    assert not errors
+
+    probabilities, _ = _score_in_process(s.path, s.new_version, s.rows, 1)
+    np.testing.assert_array_equal(probabilities, s.new.predict_proba(s.rows)[:, 1])
+    assert inference._worker_model[0] == s.new_version
+
+
+def test_process_pool_scores_old_snapshot_with_old_model(hot_swapped):
+    s = hot_swapped
+    loaded = SimpleNamespace(model=s.old, model_path=s.path, version=s.old_version)
+
+    async def run():
+        executor = InferenceExecutor(kind='process', max_workers=1, thread_count=1)
+        executor.start()
+        try:
+            return await executor.run(loaded, s.rows)
+        finally:
+            executor.shutdown()
+
+    probabilities, errors = asyncio.run(run())
+    np.testing.assert_array_equal(probabilities, s.old.predict_proba(s.rows)[:, 1])
+    assert not errors
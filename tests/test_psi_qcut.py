@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from benchmarks.qcut_reference import distributions, reference_adaptive_qcut
+from utils.psi.stability import StabilityIndexCalculator
+
+# Границы бинов adaptive_qcut должны совпадать с прежней реализацией (benchmarks/qcut_reference.py)
+# на случайных выборках разного размера: перекошенных, с большими повторами и пропусками
+
+DISTRIBUTIONS = list(distributions(np.random.default_rng(0), 10))
+
+
+@pytest.mark.parametrize('name', DISTRIBUTIONS)
+def test_adaptive_qcut_edges_match_reference(name):
+    rng = np.random.default_rng(DISTRIBUTIONS.index(name))
+    calculator = StabilityIndexCalculator()
+
+    checked = 0
+    for _ in range(40):
+        variable = distributions(rng, int(rng.integers(300, 5000)))[name]
+        n_unique = len(np.unique(variable[~np.isnan(variable)]))
+        for q in (2, 3, 5, 10, 20):
+            if n_unique <= q:
+                continue
+            expected = reference_adaptive_qcut(calculator, variable, q)
+            result = calculator.adaptive_qcut(variable, q)
+            np.testing.assert_array_equal(result, expected, err_msg=f'q={q}, n={len(variable)}')
+            checked += 1
+
+    assert checked > 0
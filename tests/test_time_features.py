@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.time_features_utils import (
+    WINDOWS,
+    TimeWindowIndexer,
+    make_time_window_features,
+    time_window_bounds,
+    time_window_columns,
+)
+
+# Медленный эталон: по каждой карте отдельно, rolling pandas со смещением по времени.
+# Окно строки - транзакции той же карты с TransactionDT в (t - w, t], не позже самой строки
+# (при равном времени - только строки до нее), как у time-offset rolling
+
+
+def reference_window_features(data, w, group_col='card1'):
+    """Признаки окна w часов для таблицы, уже отсортированной по (group_col, TransactionDT)"""
+    columns = time_window_columns(w)
+    result = pd.DataFrame(np.nan, index=data.index, columns=columns)
+
+    for _, card in data.groupby(group_col, sort=False):
+        times = pd.to_datetime(card['TransactionDT'], unit='s')
+        amount = pd.Series(card['TransactionAmt'].to_numpy(dtype=float), index=times)
+        gaps = pd.Series(card['TransactionDT'].to_numpy(dtype=float), index=times).diff()
+        ones = pd.Series(1.0, index=times)
+
+        amt_roll = amount.rolling(f'{w}h', min_periods=1)
+        gap_roll = gaps.rolling(f'{w}h', min_periods=2)
+        values = {
+            f'count_{w}h': ones.rolling(f'{w}h').sum(),
+            f'amt_mean_{w}h': amt_roll.mean(),
+            f'amt_median_{w}h': amt_roll.median(),
+            f'amt_min_{w}h': amt_roll.min(),
+            f'amt_max_{w}h': amt_roll.max(),
+            f'amt_sum_{w}h': amt_roll.sum(),
+            f'amt_std_{w}h': amount.rolling(f'{w}h', min_periods=2).std(),
+            f'mean_gap_{w}h': gap_roll.mean(),
+            f'min_gap_{w}h': gap_roll.min(),
+            f'max_gap_{w}h': gap_roll.max(),
+            f'time_since_last_{w}h': gaps,
+        }
+        for col, series in values.items():
+            result.loc[card.index, col] = series.to_numpy()
+
+    amount = data['TransactionAmt'].astype(float)
+    result[f'amt_ratio_to_mean_{w}h'] = amount / (result[f'amt_mean_{w}h'] + 1)
+    result[f'amt_ratio_to_median_{w}h'] = amount / (result[f'amt_median_{w}h'] + 1)
+    # пропуски, как в исходном построителе: fillna(0) (строки без карты - тоже)
+    for stat in ['amt_std', 'mean_gap', 'min_gap', 'max_gap', 'time_since_last']:
+        result[f'{stat}_{w}h'] = result[f'{stat}_{w}h'].fillna(0)
+    result[f'log_time_since_last_{w}h'] = np.log1p(result[f'time_since_last_{w}h'])
+    return result
+
+
+def random_transactions(seed, n=3000, n_cards=60):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'card1': rng.integers(1000, 1000 + n_cards, n).astype(float),
+        # мелкий шаг времени - много одинаковых TransactionDT и окон разной длины
+        'TransactionDT': 86400 + rng.integers(0, 14 * 24, n) * 1800,
+        'TransactionAmt': np.round(rng.lognormal(3, 1, n), 2),
+    })
+    data.loc[rng.random(n) < 0.05, 'TransactionAmt'] = np.nan
+    data.loc[rng.random(n) < 0.03, 'card1'] = np.nan
+    return data
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_make_time_window_features_matches_reference(seed):
+    data = random_transactions(seed)
+    result = make_time_window_features(data.copy())
+
+    assert result.index.equals(data.sort_values(['card1', 'TransactionDT']).index)
+    assert data['TransactionDT'].duplicated().any()
+
+    for w in WINDOWS:
+        expected = reference_window_features(result[data.columns], w)
+        pd.testing.assert_frame_equal(result[expected.columns], expected, rtol=1e-9, check_dtype=False)
+
+
+def test_tied_times_only_count_earlier_rows():
+    data = pd.DataFrame({
+        'card1': [1, 1, 1, 1, 2],
+        'TransactionDT': [0, 0, 0, 3600, 0],
+        'TransactionAmt': [1.0, 2.0, np.nan, 4.0, 5.0],
+    })
+    result = make_time_window_features(data)
+
+    assert result['count_1h'].tolist() == [1, 2, 3, 1, 1]
+    assert result['amt_sum_1h'].tolist() == [1, 3, 3, 4, 5]
+    assert result['count_6h'].tolist() == [1, 2, 3, 4, 1]
+    assert result['time_since_last_1h'].tolist() == [0, 0, 0, 3600, 0]
+
+
+def test_missing_card_gets_empty_window():
+    data = pd.DataFrame({
+        'card1': [np.nan, 1, np.nan, 1],
+        'TransactionDT': [0, 10, 20, 30],
+        'TransactionAmt': [1.0, 2.0, 3.0, 4.0],
+    })
+    result = make_time_window_features(data)
+    missing = result[result['card1'].isna()]
+
+    assert missing['count_24h'].isna().all()
+    assert missing['amt_mean_24h'].isna().all()
+    assert (missing['amt_std_24h'] == 0).all()
+    assert (missing['time_since_last_24h'] == 0).all()
+    assert result.loc[result['card1'] == 1, 'count_24h'].tolist() == [1, 2]
+
+
+def test_time_window_indexer_bounds_match_brute_force():
+    rng = np.random.default_rng(5)
+    n = 500
+    # как после sort_values по карте: строки без карты (код -1) - в конце
+    group_codes = np.sort(rng.integers(-1, 8, n))
+    group_codes = np.r_[group_codes[group_codes >= 0], group_codes[group_codes < 0]]
+    times = np.empty(n)
+    for code in np.unique(group_codes):
+        mask = group_codes == code
+        times[mask] = np.sort(rng.integers(0, 50, mask.sum()) * 600.0)
+    w_sec = 3600
+
+    start, end = time_window_bounds(group_codes, times, w_sec)
+    for i in range(n):
+        if group_codes[i] < 0:
+            assert start[i] == end[i]
+            continue
+        rows = [j for j in range(i + 1) if group_codes[j] == group_codes[i] and times[j] > times[i] - w_sec]
+        assert (start[i], end[i]) == (rows[0], i + 1)
+
+    values = pd.Series(rng.random(n))
+    rolled = values.rolling(TimeWindowIndexer(start=start, end=end), min_periods=1).sum()
+    expected = [values.iloc[s:e].sum() if e > s else np.nan for s, e in zip(start, end)]
+    np.testing.assert_allclose(rolled.to_numpy(), expected, rtol=1e-12)
@@ -1,89 +1,431 @@
 import pandas as pd
 import numpy as np
 
+from utils.time_features_utils import TimeWindowIndexer
+
 import warnings
 warnings.filterwarnings('ignore')
 
-def make_card_features(data, group_col='card1'):
+
+def _group_codes(keys):
+    """Коды групп (-1 - пропуск, такие строки в группы не входят) и число групп"""
+    codes, uniques = pd.factorize(keys)
+    return codes.astype(np.int64), len(uniques)
+
+
+def _broadcast(values, codes, index):
+    """Значения групп -> строки. Строки без группы получают NaN, как в transform"""
+    values = np.asarray(values)
+    result = values[np.maximum(codes, 0)]
+    no_group = codes < 0
+    if no_group.any():
+        result = result.astype(float)
+        result[no_group] = np.nan
+    return pd.Series(result, index=index)
+
+
+def _group_nunique(codes, n_groups, values):
+    """Количество уникальных значений (без пропусков) в каждой группе"""
+    value_codes, uniques = pd.factorize(values)
+    mask = (codes >= 0) & (value_codes >= 0)
+    n_values = max(len(uniques), 1)
+
+    pairs = np.unique(codes[mask] * n_values + value_codes[mask])
+    return np.bincount(pairs // n_values, minlength=n_groups)
+
+
+def _group_mode(codes, n_groups, values):
+    """
+    Мода каждой группы, как x.mode().iloc[0]: самое частое значение,
+    при равенстве - наименьшее, для группы без значений - -1
+    """
+    value_codes, uniques = pd.factorize(values, sort=True)
+    mask = (codes >= 0) & (value_codes >= 0)
+    n_values = max(len(uniques), 1)
+
+    pairs, counts = np.unique(codes[mask] * n_values + value_codes[mask], return_counts=True)
+    pair_groups, pair_values = pairs // n_values, pairs % n_values
+
+    # внутри группы: по убыванию частоты, затем по возрастанию значения
+    order = np.lexsort((pair_values, -counts, pair_groups))
+    first = order[np.r_[True, pair_groups[order][1:] != pair_groups[order][:-1]]]
+
+    mode_codes = np.full(n_groups, -1, dtype=np.int64)
+    mode_codes[pair_groups[first]] = pair_values[first]
+
+    modes = np.asarray(uniques)[np.maximum(mode_codes, 0)]
+    return np.where(mode_codes >= 0, modes, -1)
+
+
+def _pair_key(left, right, right_as_str=False):
+    """
+    Комбинация left.astype(str) + '_' + right категорией
+
+    Строка собирается только для уникальных пар, строкам таблицы достаются коды
+    """
+    left_codes, left_uniques = pd.factorize(left, use_na_sentinel=False)
+    right_codes, right_uniques = pd.factorize(right, use_na_sentinel=False)
+    n_right = max(len(right_uniques), 1)
+
+    pair_codes, pairs = pd.factorize(left_codes.astype(np.int64) * n_right + right_codes)
+
+    left_str = pd.Series(left_uniques, dtype=left.dtype).astype(str).to_numpy()
+    right_values = pd.Series(right_uniques, dtype=right.dtype)
+    if right_as_str:
+        right_values = right_values.astype(str)
+    right_values = right_values.to_numpy()
+
+    values = pd.Series(left_str[pairs // n_right]) + '_' + pd.Series(right_values[pairs % n_right])
+    value_codes, categories = pd.factorize(values)
+    return pd.Categorical.from_codes(value_codes[pair_codes], categories=categories)
+
+
+def _card_stats(codes, n_groups, amount=None, is_night=None, is_weekend=None):
+    """Суммы и доли по всей истории карты одним проходом (строка на карту, только по переданным столбцам)"""
+    valid = codes >= 0
+    columns, aggregations = {}, {}
+    if amount is not None:
+        columns['amt'] = np.asarray(amount)[valid]
+        aggregations.update(
+            amt_mean=('amt', 'mean'),
+            amt_median=('amt', 'median'),
+            amt_std=('amt', 'std'),
+            amt_max=('amt', 'max'),
+            amt_min=('amt', 'min'),
+        )
+    if is_night is not None:
+        columns['is_night'] = np.asarray(is_night)[valid]
+        aggregations['night_ratio'] = ('is_night', 'mean')
+    if is_weekend is not None:
+        columns['is_weekend'] = np.asarray(is_weekend)[valid]
+        aggregations['weekend_ratio'] = ('is_weekend', 'mean')
+
+    return pd.DataFrame(columns).groupby(codes[valid]).agg(**aggregations).reindex(np.arange(n_groups))
+
+
+def _full_history(data, codes, n_groups, amount, is_night, is_weekend):
+    """Агрегаты по всей истории карты, включая будущие транзакции"""
+    index = data.index
+    stats = {}
+
+    def per_card(col):
+        if not stats:
+            stats['table'] = _card_stats(codes, n_groups, amount, is_night, is_weekend)
+        return _broadcast(stats['table'][col].to_numpy(), codes, index)
+
+    def per_card_nunique(values):
+        return _broadcast(_group_nunique(codes, n_groups, values), codes, index)
+
+    def per_card_mode(values):
+        return _broadcast(_group_mode(codes, n_groups, values), codes, index)
+
+    return per_card, per_card_nunique, per_card_mode
+
+
+def _point_in_time(data, codes, amount, is_night, is_weekend):
+    """
+    Агрегаты по более ранним транзакциям карты (без текущей и будущих)
+
+    Строки сортируются по (карта, TransactionDT) один раз; при равном времени раньше
+    считается строка, которая раньше в таблице. История строки i - строки [начало карты, i):
+    - суммы, медиана, минимум, максимум, доли - rolling по этим границам
+    - количество уникальных значений - накопленная сумма флагов первого появления пары (карта, значение)
+    - мода - накопленный максимум ключа (сколько раз значение уже встречалось, -значение) по карте
+    У первой транзакции карты истории нет: средние и доли - NaN, уникальных значений - 0, мода - -1
+
+    То же соглашение (текущая транзакция в историю не входит) использует онлайн-хранилище
+    признаков: OnlineFeatureStore.peek в api/feature_store.py
+    """
+    index = data.index
+    n = len(codes)
+    n_groups = codes.max() + 1 if n else 0
+
+    # строки без карты - в конце, их история пустая
+    order = np.lexsort((data['TransactionDT'].to_numpy(), np.where(codes >= 0, codes, n_groups)))
+    groups = codes[order]
+    no_card = groups < 0
+
+    new_group = np.r_[True, groups[1:] != groups[:-1]] if n else np.zeros(0, dtype=bool)
+    row = np.arange(n, dtype=np.int64)
+    group_start = np.maximum.accumulate(np.where(new_group, row, 0)) if n else row
+    start = np.where(no_card, row, group_start)
+    indexer = TimeWindowIndexer(start=start, end=row)
+
+    def unsort(values):
+        values = np.asarray(values)
+        if no_card.any():
+            values = values.astype(float)
+            values[no_card] = np.nan
+        result = np.empty(n, dtype=values.dtype)
+        result[order] = values
+        return pd.Series(result, index=index)
+
+    def rolling_mean(values):
+        return pd.Series(np.asarray(values, dtype=float)[order]).rolling(indexer, min_periods=1).mean
+
+    stats = {}
+    if amount is not None:
+        amt_roll = pd.Series(np.asarray(amount, dtype=float)[order]).rolling(indexer, min_periods=1)
+        stats.update(
+            amt_mean=amt_roll.mean,
+            amt_median=amt_roll.median,
+            amt_std=amt_roll.std,
+            amt_max=amt_roll.max,
+            amt_min=amt_roll.min,
+        )
+    if is_night is not None:
+        stats['night_ratio'] = rolling_mean(is_night)
+    if is_weekend is not None:
+        stats['weekend_ratio'] = rolling_mean(is_weekend)
+
+    def per_card(col):
+        return unsort(stats[col]().to_numpy())
+
+    def pair_codes(values, sort=False):
+        value_codes, uniques = pd.factorize(values, sort=sort)
+        value_codes = value_codes[order]
+        n_values = max(len(uniques), 1)
+        valid = ~no_card & (value_codes >= 0)
+        return np.where(valid, groups * n_values + value_codes, -1), value_codes, uniques, n_values
+
+    def per_card_nunique(values):
+        pairs = pair_codes(values)[0]
+        first = (pairs >= 0) & ~pd.Series(pairs).duplicated().to_numpy()
+        seen = np.cumsum(first) - first
+        return unsort(seen - seen[start])
+
+    def per_card_mode(values):
+        pairs, value_codes, uniques, n_values = pair_codes(values, sort=True)
+        counts = pd.Series(pairs).groupby(pairs).cumcount().to_numpy() + 1
+        key = np.where(pairs >= 0, counts * n_values + (n_values - 1 - value_codes), -1)
+        best = pd.Series(key).groupby(groups).cummax().to_numpy()
+
+        # лучший ключ до текущей строки - на предыдущей строке той же карты
+        prev = np.where(new_group, -1, np.r_[-1, best[:-1]])
+        mode_codes = np.where(prev >= 0, n_values - 1 - prev % n_values, -1)
+        modes = np.asarray(uniques)[np.maximum(mode_codes, 0)] if len(uniques) else mode_codes
+        return unsort(np.where(mode_codes >= 0, modes, -1))
+
+    return per_card, per_card_nunique, per_card_mode
+
+
+def make_card_features(data, group_col='card1', point_in_time=False, features=None):
     """
     Агрегация сумм транзакций по картам, отношения сумм транзакций к среднему и медиане
-    
+
     + комбинации с категориальными и другими показателями
-    
+
+    Все агрегаты по карте считаются одним groupby, моды и количества уникальных значений -
+    подсчетом пар (карта, значение) на кодах, комбинации карты - категориями
+
+    point_in_time=True - агрегаты только по более ранним транзакциям карты (по TransactionDT),
+    как их видит онлайн-скоринг; состояние карты после всей истории - make_card_state
+
+    features - какие столбцы добавить (None - все); промежуточные значения
+    (например, card_amt_mean для card_amt_ratio_to_mean) считаются, но не добавляются
+
     """
-    grouped = data.groupby(group_col)
-    
-    data['card_amt_mean'] = grouped['TransactionAmt'].transform('mean')
-    data['card_amt_median'] = grouped['TransactionAmt'].transform('median')
-    data['card_amt_std'] = grouped['TransactionAmt'].transform('std').fillna(0)
-    data['card_amt_max'] = grouped['TransactionAmt'].transform('max')
-    data['card_amt_min'] = grouped['TransactionAmt'].transform('min')
-    
-    # отношение к среднему / медиане
-    data['card_amt_ratio_to_mean'] = data['TransactionAmt'] / (data['card_amt_mean'] + 1)
-    data['card_amt_ratio_to_median'] = data['TransactionAmt'] / (data['card_amt_median'] + 1)
-    
-    # флаги
-    data['card_amt_more_2x_mean'] = (data['TransactionAmt'] > 2 * data['card_amt_mean']).astype(int)
-    data['card_amt_more_3x_mean'] = (data['TransactionAmt'] > 3 * data['card_amt_mean']).astype(int)
-    data['card_amt_is_max'] = (data['TransactionAmt'] == data['card_amt_max']).astype(int)
-    
-    
+    columns = None if features is None else set(features)
+
+    def need(*cols):
+        return columns is None or any(col in columns for col in cols)
+
+    def emit(col, value):
+        if columns is None or col in columns:
+            data[col] = value
+
+    codes, n_groups = _group_codes(data[group_col])
+
+    amount_cols = ['card_amt_mean', 'card_amt_median', 'card_amt_std', 'card_amt_max', 'card_amt_min',
+                   'card_amt_ratio_to_mean', 'card_amt_ratio_to_median',
+                   'card_amt_more_2x_mean', 'card_amt_more_3x_mean', 'card_amt_is_max']
+    amount = data['TransactionAmt'].to_numpy() if need(*amount_cols) else None
+    is_night = None
+    if need('is_night', 'card_night_ratio', 'card_unusual_night'):
+        is_night = ((data['hour'] < 6) | (data['hour'] > 22)).astype(int)
+    is_weekend = (data['day'] >= 5).astype(int) if need('is_weekend', 'card_weekend_ratio') else None
+
+    if point_in_time:
+        per_card, per_card_nunique, per_card_mode = _point_in_time(data, codes, amount, is_night, is_weekend)
+    else:
+        per_card, per_card_nunique, per_card_mode = _full_history(data, codes, n_groups, amount, is_night, is_weekend)
+
+    # порядок столбцов - как при последовательном расчете
+    if amount is not None:
+        amt_mean = per_card('amt_mean')
+        amt_median = per_card('amt_median')
+        amt_max = per_card('amt_max')
+        transaction_amt = data['TransactionAmt']
+
+        emit('card_amt_mean', amt_mean)
+        emit('card_amt_median', amt_median)
+        if need('card_amt_std'):
+            emit('card_amt_std', per_card('amt_std').fillna(0))
+        emit('card_amt_max', amt_max)
+        if need('card_amt_min'):
+            emit('card_amt_min', per_card('amt_min'))
+
+        # отношение к среднему / медиане
+        emit('card_amt_ratio_to_mean', transaction_amt / (amt_mean + 1))
+        emit('card_amt_ratio_to_median', transaction_amt / (amt_median + 1))
+
+        # флаги
+        emit('card_amt_more_2x_mean', (transaction_amt > 2 * amt_mean).astype(int))
+        emit('card_amt_more_3x_mean', (transaction_amt > 3 * amt_mean).astype(int))
+        emit('card_amt_is_max', (transaction_amt == amt_max).astype(int))
+
+
     # уникальные email на карту
-    data['card_unique_P_email'] = grouped['P_emaildomain_new'].transform('nunique')
-    data['card_unique_R_email'] = grouped['R_emaildomain_new'].transform('nunique')
-    
-    data['card_unique_P_email_gr'] = grouped['P_emaildomain_grouped'].transform('nunique')
-    data['card_unique_R_email_gr'] = grouped['R_emaildomain_grouped'].transform('nunique')
-    
-    
+    for col, source in [('card_unique_P_email', 'P_emaildomain_new'),
+                        ('card_unique_R_email', 'R_emaildomain_new'),
+                        ('card_unique_P_email_gr', 'P_emaildomain_grouped'),
+                        ('card_unique_R_email_gr', 'R_emaildomain_grouped')]:
+        if need(col):
+            emit(col, per_card_nunique(data[source]))
+
+
     # комбинации
-    data['card_email_p'] = data[group_col].astype(str) + '_' + data['P_emaildomain_new']
-    data['card_email_r'] = data[group_col].astype(str) + '_' + data['R_emaildomain_new']
-    
-    
-    
+    if need('card_email_p'):
+        emit('card_email_p', _pair_key(data[group_col], data['P_emaildomain_new']))
+    if need('card_email_r'):
+        emit('card_email_r', _pair_key(data[group_col], data['R_emaildomain_new']))
+
+
+
     # deepseek
     # Типичный час использования
-    def get_mode(x):
-        return x.mode().iloc[0] if not x.mode().empty else -1
-    
-    data['card_mode_hour'] = grouped['hour'].transform(get_mode)
-    data['card_hour_changed'] = (data['hour'] != data['card_mode_hour']).astype(int)
-    
+    if need('card_mode_hour', 'card_hour_changed'):
+        mode_hour = per_card_mode(data['hour'])
+        emit('card_mode_hour', mode_hour)
+        emit('card_hour_changed', (data['hour'] != mode_hour).astype(int))
+
     # Доля ночных транзакций на карте
-    data['is_night'] = ((data['hour'] < 6) | (data['hour'] > 22)).astype(int)
-    data['card_night_ratio'] = grouped['is_night'].transform('mean')
-    
-    # Аномалия: ночная транзакция на карте, которая обычно не активна ночью
-    data['card_unusual_night'] = ((data['is_night'] == 1) & (data['card_night_ratio'] < 0.1)).astype(int)
-    
+    if is_night is not None:
+        night_ratio = per_card('night_ratio')
+        emit('is_night', is_night)
+        emit('card_night_ratio', night_ratio)
+
+        # Аномалия: ночная транзакция на карте, которая обычно не активна ночью
+        emit('card_unusual_night', ((is_night == 1) & (night_ratio < 0.1)).astype(int))
+
     # Выходные vs будни
-    data['is_weekend'] = (data['day'] >= 5).astype(int)
-    data['card_weekend_ratio'] = grouped['is_weekend'].transform('mean')
-    
+    if is_weekend is not None:
+        emit('is_weekend', is_weekend)
+        emit('card_weekend_ratio', per_card('weekend_ratio'))
+
     # Типичный адрес для карты
-    def get_mode(x):
-        return x.mode().iloc[0] if not x.mode().empty else -1
-    
     # карты + адреса
-    data['addr1_new'] = data['addr1'].fillna(999)
-    data['addr2_new'] = data['addr1'].fillna(999)
-    
-    data['card_mode_addr1'] = grouped['addr1_new'].transform(get_mode)
-    data['card_mode_addr2'] = grouped['addr2_new'].transform(get_mode)
-    
-    # Сменился ли адрес
-    data['card_addr1_changed'] = (data['addr1_new'] != data['card_mode_addr1']).astype(int)
-    data['card_addr2_changed'] = (data['addr2_new'] != data['card_mode_addr2']).astype(int)
-    
-    # Количество уникальных адресов для карты
-    data['card_unique_addr1'] = grouped['addr1_new'].transform('nunique')
-    data['card_unique_addr2'] = grouped['addr2_new'].transform('nunique')
-    
+    addr_cols = ['addr1_new', 'addr2_new', 'card_mode_addr1', 'card_mode_addr2', 'card_addr1_changed',
+                 'card_addr2_changed', 'card_unique_addr1', 'card_unique_addr2']
+    if need(*addr_cols):
+        addr1_new = data['addr1'].fillna(999)
+        addr2_new = data['addr1'].fillna(999)
+        emit('addr1_new', addr1_new)
+        emit('addr2_new', addr2_new)
+
+        if need('card_mode_addr1', 'card_addr1_changed'):
+            mode_addr1 = per_card_mode(addr1_new)
+            emit('card_mode_addr1', mode_addr1)
+        if need('card_mode_addr2', 'card_addr2_changed'):
+            mode_addr2 = per_card_mode(addr2_new)
+            emit('card_mode_addr2', mode_addr2)
+
+        # Сменился ли адрес
+        if need('card_addr1_changed'):
+            emit('card_addr1_changed', (addr1_new != mode_addr1).astype(int))
+        if need('card_addr2_changed'):
+            emit('card_addr2_changed', (addr2_new != mode_addr2).astype(int))
+
+        # Количество уникальных адресов для карты
+        if need('card_unique_addr1'):
+            emit('card_unique_addr1', per_card_nunique(addr1_new))
+        if need('card_unique_addr2'):
+            emit('card_unique_addr2', per_card_nunique(addr2_new))
+
     # Комбинация карта + адрес
-    data['card_addr1_pair'] = data[group_col].astype(str) + '_' + data['addr1'].astype(str)
-    data['card_addr2_pair'] = data[group_col].astype(str) + '_' + data['addr2'].astype(str)
-    
-    
+    if need('card_addr1_pair'):
+        emit('card_addr1_pair', _pair_key(data[group_col], data['addr1'], right_as_str=True))
+    if need('card_addr2_pair'):
+        emit('card_addr2_pair', _pair_key(data[group_col], data['addr2'], right_as_str=True))
+
+
     return data
+
+
+# столбцы, которые добавляет make_card_features, и исходные столбцы каждого из них
+CARD_FEATURE_INPUTS = {
+    **{col: ['TransactionAmt'] for col in [
+        'card_amt_mean', 'card_amt_median', 'card_amt_std', 'card_amt_max', 'card_amt_min',
+        'card_amt_ratio_to_mean', 'card_amt_ratio_to_median',
+        'card_amt_more_2x_mean', 'card_amt_more_3x_mean', 'card_amt_is_max']},
+    'card_unique_P_email': ['P_emaildomain_new'],
+    'card_unique_R_email': ['R_emaildomain_new'],
+    'card_unique_P_email_gr': ['P_emaildomain_grouped'],
+    'card_unique_R_email_gr': ['R_emaildomain_grouped'],
+    'card_email_p': ['P_emaildomain_new'],
+    'card_email_r': ['R_emaildomain_new'],
+    'card_mode_hour': ['hour'],
+    'card_hour_changed': ['hour'],
+    'is_night': ['hour'],
+    'card_night_ratio': ['hour'],
+    'card_unusual_night': ['hour'],
+    'is_weekend': ['day'],
+    'card_weekend_ratio': ['day'],
+    **{col: ['addr1'] for col in [
+        'addr1_new', 'addr2_new', 'card_mode_addr1', 'card_mode_addr2', 'card_addr1_changed',
+        'card_addr2_changed', 'card_unique_addr1', 'card_unique_addr2', 'card_addr1_pair']},
+    'card_addr2_pair': ['addr2'],
+}
+
+
+def make_card_state(data, group_col='card1'):
+    """
+    Состояние карт после всей истории (строка на карту)
+
+    Значения совпадают с тем, что make_card_features(point_in_time=True) даст следующей
+    транзакции карты. P_emails / R_emails - уникальные домены карты, ими заполняется
+    онлайн-хранилище признаков (OnlineFeatureStore.seed в api/feature_store.py)
+
+    """
+    codes, cards = pd.factorize(data[group_col])
+    codes = codes.astype(np.int64)
+    n_groups = len(cards)
+
+    is_night = ((data['hour'] < 6) | (data['hour'] > 22)).astype(int)
+    is_weekend = (data['day'] >= 5).astype(int)
+    stats = _card_stats(codes, n_groups, data['TransactionAmt'].to_numpy(), is_night, is_weekend)
+    addr_new = data['addr1'].fillna(999)
+
+    def unique_values(col):
+        valid = (codes >= 0) & data[col].notna().to_numpy()
+        # category -> object: groupby().unique() для категорий возвращает не np.ndarray
+        values = data[col][valid].astype(object).groupby(codes[valid]).unique().reindex(np.arange(n_groups))
+        return [list(v) if isinstance(v, np.ndarray) else [] for v in values]
+
+    valid = codes >= 0
+    state = pd.DataFrame({
+        'card_n_transactions': np.bincount(codes[valid], minlength=n_groups),
+        'card_amt_mean': stats['amt_mean'].to_numpy(),
+        'card_amt_median': stats['amt_median'].to_numpy(),
+        'card_amt_std': stats['amt_std'].fillna(0).to_numpy(),
+        'card_amt_max': stats['amt_max'].to_numpy(),
+        'card_amt_min': stats['amt_min'].to_numpy(),
+        'card_unique_P_email': _group_nunique(codes, n_groups, data['P_emaildomain_new']),
+        'card_unique_R_email': _group_nunique(codes, n_groups, data['R_emaildomain_new']),
+        'card_unique_P_email_gr': _group_nunique(codes, n_groups, data['P_emaildomain_grouped']),
+        'card_unique_R_email_gr': _group_nunique(codes, n_groups, data['R_emaildomain_grouped']),
+        'card_mode_hour': _group_mode(codes, n_groups, data['hour']),
+        'card_night_ratio': stats['night_ratio'].to_numpy(),
+        'card_weekend_ratio': stats['weekend_ratio'].to_numpy(),
+        # addr2_new в make_card_features тоже строится из addr1
+        'card_mode_addr1': _group_mode(codes, n_groups, addr_new),
+        'card_mode_addr2': _group_mode(codes, n_groups, addr_new),
+        'card_unique_addr1': _group_nunique(codes, n_groups, addr_new),
+        'card_unique_addr2': _group_nunique(codes, n_groups, addr_new),
+        'last_TransactionDT': pd.Series(data['TransactionDT'].to_numpy()[valid]).groupby(codes[valid]).max()
+                                .reindex(np.arange(n_groups)).to_numpy(),
+        'P_emails': unique_values('P_emaildomain_new'),
+        'R_emails': unique_values('R_emaildomain_new'),
+    }, index=pd.Index(cards, name=group_col))
+
+    return state
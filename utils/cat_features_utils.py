@@ -1,192 +1,286 @@
+import re
+
 import pandas as pd
 import numpy as np
 
 import warnings
 warnings.filterwarnings('ignore')
 
-def preparing_cat_features(data: pd.DataFrame) -> pd.DataFrame:
-    """
-    Функция для преобразрвания категориальных признаков
-    """
-    
-    # идея преобразований своя. 
-    # словари и условия для объединения категорий - deepseek
-    
-    # заполнение пропусков категорией missing
-    fill_cat_cols  = ['ProductCD', 'card4', 'card6', 'M1', 'M2', 'M3', 'M4', 'M5', 'M6', 'M7', 'M8', 'M9',
-                      'id_12', 'id_15', 'id_16', 'id_23', 'id_27', 'id_28', 'id_29', 'id_30', 'id_31', 'id_33',
-                      'id_34', 'id_35', 'id_36', 'id_37', 'id_38', 'DeviceType', 'DeviceInfo', 'P_emaildomain', 'R_emaildomain']
-    
+# заполнение пропусков категорией missing: для каждого столбца создается {col}_new
+# (используется и онлайн-хранилищем признаков api/feature_store.py)
+FILL_CAT_COLS = ['ProductCD', 'card4', 'card6', 'M1', 'M2', 'M3', 'M4', 'M5', 'M6', 'M7', 'M8', 'M9',
+                 'id_12', 'id_15', 'id_16', 'id_23', 'id_27', 'id_28', 'id_29', 'id_30', 'id_31', 'id_33',
+                 'id_34', 'id_35', 'id_36', 'id_37', 'id_38', 'DeviceType', 'DeviceInfo', 'P_emaildomain', 'R_emaildomain']
+
+MISSING_CATEGORY = 'missing'
+
+# идея преобразований своя.
+# словари и условия для объединения категорий - deepseek
+
+## 'P_emaildomain', 'R_emaildomain'
+# Словарь для группировки email доменов
+EMAIL_MAPPING = {
+    # Google
+    'gmail.com': 'google',
+    'gmail': 'google',
+    'googlemail.com': 'google',
     
-    # fillna 'missing'
-    for col in fill_cat_cols:
-        data[f'{col}_new'] = data[col].fillna('missing')
+    # Microsoft
+    'hotmail.com': 'microsoft',
+    'outlook.com': 'microsoft',
+    'live.com': 'microsoft',
+    'live.com.mx': 'microsoft',
+    'msn.com': 'microsoft',
+    'hotmail.fr': 'microsoft',
+    'hotmail.de': 'microsoft',
+    'hotmail.co.uk': 'microsoft',
+    'hotmail.es': 'microsoft',
+    'outlook.es': 'microsoft',
     
+    # Yahoo
+    'yahoo.com': 'yahoo',
+    'yahoo.com.mx': 'yahoo',
+    'yahoo.co.jp': 'yahoo',
+    'ymail.com': 'yahoo',
+    'rocketmail.com': 'yahoo',
+    'yahoo.fr': 'yahoo', 
+    'yahoo.de': 'yahoo',
+    'yahoo.es': 'yahoo',
+    'yahoo.co.uk': 'yahoo',
     
-    ## 'P_emaildomain', 'R_emaildomain'
-    # Словарь для группировки email доменов
-    email_mapping = {
-        # Google
-        'gmail.com': 'google',
-        'gmail': 'google',
-        'googlemail.com': 'google',
-        
-        # Microsoft
-        'hotmail.com': 'microsoft',
-        'outlook.com': 'microsoft',
-        'live.com': 'microsoft',
-        'live.com.mx': 'microsoft',
-        'msn.com': 'microsoft',
-        'hotmail.fr': 'microsoft',
-        'hotmail.de': 'microsoft',
-        'hotmail.co.uk': 'microsoft',
-        'hotmail.es': 'microsoft',
-        'outlook.es': 'microsoft',
-        
-        # Yahoo
-        'yahoo.com': 'yahoo',
-        'yahoo.com.mx': 'yahoo',
-        'yahoo.co.jp': 'yahoo',
-        'ymail.com': 'yahoo',
-        'rocketmail.com': 'yahoo',
-        'yahoo.fr': 'yahoo', 
-        'yahoo.de': 'yahoo',
-        'yahoo.es': 'yahoo',
-        'yahoo.co.uk': 'yahoo',
-        
-        # AOL
-        'aol.com': 'aol',
-        'aim.com': 'aol',
-        
-        # Apple
-        'icloud.com': 'apple',
-        'me.com': 'apple',
-        'mac.com': 'apple',
-        
-        # Провайдеры США
-        'att.net': 'us_provider',
-        'verizon.net': 'us_provider',
-        'comcast.net': 'us_provider',
-        'charter.net': 'us_provider',
-        'cox.net': 'us_provider',
-        'optonline.net': 'us_provider',
-        'sbcglobal.net': 'us_provider',
-        'bellsouth.net': 'us_provider',
-        'juno.com': 'us_provider',
-        'embarqmail.com': 'us_provider',
-        
-        # Европейские other
-        'gmx.de': 'europe_provider',
-        'web.de': 'europe_provider',
-        'live.fr': 'europe_provider',
-        
-        'missing': 'missing'}
-
-    #'P_emaildomain', 'R_emaildomain'
-    # 
-    data['P_emaildomain_grouped'] = data['P_emaildomain_new'].map(email_mapping).fillna('other')
-    data['R_emaildomain_grouped'] = data['R_emaildomain_new'].map(email_mapping).fillna('other')
+    # AOL
+    'aol.com': 'aol',
+    'aim.com': 'aol',
     
+    # Apple
+    'icloud.com': 'apple',
+    'me.com': 'apple',
+    'mac.com': 'apple',
     
-    ## id_30
-    conditions = [
-        data['id_30_new'].str.contains('windows|win10|win7|win8|winxp|winvista|win', na=False),
-        data['id_30_new'].str.contains('mac os|macos|macintosh|os x|mac', na=False),
-        data['id_30_new'].str.contains('ios|iphone|ipad|ipod', na=False),
-        data['id_30_new'].str.contains('android', na=False),
-        data['id_30_new'].str.contains('linux|ubuntu|debian|fedora|centos', na=False),
-        data['id_30_new'].str.contains('chrome os|chrome', na=False),
-        data['id_30_new'].str.contains('missing', na=False)]   
-
-    choices = ['windows', 'mac', 'ios', 'android', 'linux', 'chrome_os', 'missing']
-
-    data['id_30_grouped'] = np.select(conditions, choices, default='other')
-
-
-    ## id 31
-    # Условия для группировки браузеров
-    conditions = [
-        data['id_31_new'].str.contains('chrome|crm', na=False),
-        data['id_31_new'].str.contains('safari|mobile safari', na=False),
-        data['id_31_new'].str.contains('firefox|fxios', na=False),
-        data['id_31_new'].str.contains('edge|edg', na=False),
-        data['id_31_new'].str.contains('ie|internet explorer|trident', na=False),
-        data['id_31_new'].str.contains('samsung|samsung browser', na=False),
-        data['id_31_new'].str.contains('opera|opr', na=False),
-        data['id_31_new'].str.contains('android webview', na=False),
-        data['id_31_new'].str.contains('missing', na=False),
-    ]
-
-    choices = ['chrome', 'safari', 'firefox', 'edge', 'ie', 'samsung', 'opera', 'android_webview', 'missing']
-
-    data['id_31_grouped'] = np.select(conditions, choices, default='other')
+    # Провайдеры США
+    'att.net': 'us_provider',
+    'verizon.net': 'us_provider',
+    'comcast.net': 'us_provider',
+    'charter.net': 'us_provider',
+    'cox.net': 'us_provider',
+    'optonline.net': 'us_provider',
+    'sbcglobal.net': 'us_provider',
+    'bellsouth.net': 'us_provider',
+    'juno.com': 'us_provider',
+    'embarqmail.com': 'us_provider',
     
+    # Европейские other
+    'gmx.de': 'europe_provider',
+    'web.de': 'europe_provider',
+    'live.fr': 'europe_provider',
     
-    ## id_33
-    # 
-    def get_ratio(res):
-        if res == 'missing':
-            return 'missing'
-        
-        try:
-            w, h = map(int, str(res).split('x'))
-            ratio = round(w / h, 2)
-            
-            if ratio == 1.33 or ratio == 1.34:
-                return '4:3'
-            elif ratio == 1.25:
-                return '5:4'
-            elif ratio == 1.6:
-                return '16:10'
-            elif ratio == 1.78:
-                return '16:9'
-            elif ratio == 2.0: 
-                return '2:1'
-            elif ratio > 2.0:
-                return 'ultrawide'
-            else:
-                return 'other'
-        except:
+    'missing': 'missing'}
+
+
+## id_30
+# (шаблон, группа): побеждает первый сработавший шаблон, как в np.select
+ID_30_RULES = [
+    ('windows|win10|win7|win8|winxp|winvista|win', 'windows'),
+    ('mac os|macos|macintosh|os x|mac', 'mac'),
+    ('ios|iphone|ipad|ipod', 'ios'),
+    ('android', 'android'),
+    ('linux|ubuntu|debian|fedora|centos', 'linux'),
+    ('chrome os|chrome', 'chrome_os'),
+    ('missing', 'missing'),
+]
+
+## id 31
+# Условия для группировки браузеров
+ID_31_RULES = [
+    ('chrome|crm', 'chrome'),
+    ('safari|mobile safari', 'safari'),
+    ('firefox|fxios', 'firefox'),
+    ('edge|edg', 'edge'),
+    ('ie|internet explorer|trident', 'ie'),
+    ('samsung|samsung browser', 'samsung'),
+    ('opera|opr', 'opera'),
+    ('android webview', 'android_webview'),
+    ('missing', 'missing'),
+]
+
+## DeviceInfo
+# Условия для определения бренда (без учета регистра)
+DEVICE_INFO_RULES = [
+    ('ilium', 'ilium'),
+    ('pixel', 'pixel'),
+    ('khisense|hisense', 'hisense'),
+    ('kffowi|kfdowi|kfgiwi|kindle|fire', 'amazon'),
+    ('trident|trident-', 'trident'),
+    ('rv|rv:|rv-', 'rv'),
+    ('nexus|nex-', 'nexus'),
+    ('redmi|red-', 'redmi'),
+    ('asus', 'asus'),
+    ('samsung|sm-|gt-', 'samsung'),
+    ('iphone|ipad|ipod|ios|android', 'mobile_t'),
+    ('lg|lg-|vs5012|vs995|vs988|vs425pp|vs987', 'lg'),
+    ('moto|motorola|xt|mot-', 'motorola'),
+    ('huawei|cam-|hi6210sft', 'huawei'),
+    ('lenovo', 'lenovo'),
+    ('sony|lt|f3213|f3113|f5121|f3313|f3213|f3113|f3111|g3313|g3223|f8331|f5321|e6603|e5506|e2306|d6603|e5823|c6906', 'sony'),
+    ('htc', 'htc'),
+    ('blade|zte|m4 ss4456|m4 ss|z981|z835', 'zte'),
+    ('alcatel|5080a|5010g|8050g|5025g|5015a|5056a|5012g|5011a', 'alcatel'),
+    ('windows nt|windows|macos|linux', 'desktop_os'),
+    ('missing', 'missing'),
+]
+
+
+## id_33
+def get_ratio(res):
+    """Соотношение сторон экрана по разрешению WxH"""
+    if isinstance(res, str) and res == 'missing':
+        return 'missing'
+
+    try:
+        w, h = map(int, str(res).split('x'))
+        ratio = round(w / h, 2)
+
+        if ratio == 1.33 or ratio == 1.34:
+            return '4:3'
+        elif ratio == 1.25:
+            return '5:4'
+        elif ratio == 1.6:
+            return '16:10'
+        elif ratio == 1.78:
+            return '16:9'
+        elif ratio == 2.0:
+            return '2:1'
+        elif ratio > 2.0:
+            return 'ultrawide'
+        else:
             return 'other'
+    except:
+        return 'other'
 
-    #
-    data['id_33_ratio'] = data['id_33_new'].apply(get_ratio)
-    
-    
-    ## DeviceInfo
-
-    # Условия для определения бренда
-    conditions = [
-        data['DeviceInfo_new'].str.contains('ilium', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('pixel', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('khisense|hisense', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('kffowi|kfdowi|kfgiwi|kindle|fire', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('trident|trident-', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('rv|rv:|rv-', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('nexus|nex-', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('redmi|red-', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('asus', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('samsung|sm-|gt-', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('iphone|ipad|ipod|ios|android', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('lg|lg-|vs5012|vs995|vs988|vs425pp|vs987', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('moto|motorola|xt|mot-', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('huawei|cam-|hi6210sft', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('lenovo', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('sony|lt|f3213|f3113|f5121|f3313|f3213|f3113|f3111|g3313|g3223|f8331|f5321|e6603|e5506|e2306|d6603|e5823|c6906', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('htc', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('blade|zte|m4 ss4456|m4 ss|z981|z835', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('alcatel|5080a|5010g|8050g|5025g|5015a|5056a|5012g|5011a', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('windows nt|windows|macos|linux', case=False, na=False),
-        data['DeviceInfo_new'].str.contains('missing', case=False, na=False),
-        ]
-
-    choices = ['ilium', 'pixel', 'hisense', 'amazon', 'trident', 'rv', 'nexus', 'redmi',
-               'asus', 'samsung', 'mobile_t', 'lg', 'motorola', 'huawei',
-               'lenovo', 'sony', 'htc', 'zte', 'alcatel', 'desktop_os', 'missing']
-
-    data['DeviceInfo_brand'] = np.select(conditions, choices, default='other')
-    
-    
-    return data
+
+class RuleMapper:
+    """
+    Отображение значения категории в группу с запоминанием результата
+
+    На столбце правило вычисляется один раз на уникальное значение (а между вызовами -
+    один раз на значение вообще), результат раскладывается по строкам через коды factorize.
+    Один и тот же объект используется и для одной транзакции онлайн: mapper(value)
+
+    Args:
+        func: правило для одного значения
+        max_cache: сколько значений запоминать (при переполнении память очищается)
+    """
+
+    def __init__(self, func, max_cache=100_000):
+        self.func = func
+        self.max_cache = max_cache
+        self._cache = {}
+
+    @classmethod
+    def from_patterns(cls, rules, default='other', case=True, **kwargs):
+        """Первый шаблон из rules, найденный в строке (re.search, как str.contains(na=False))"""
+        flags = 0 if case else re.IGNORECASE
+        compiled = [(re.compile(pattern, flags), label) for pattern, label in rules]
+
+        def func(value):
+            if isinstance(value, str):
+                for regex, label in compiled:
+                    if regex.search(value):
+                        return label
+            return default
+
+        return cls(func, **kwargs)
+
+    @classmethod
+    def from_dict(cls, mapping, default='other', **kwargs):
+        """Значение по словарю, как map(mapping).fillna(default)"""
+        def func(value):
+            label = mapping.get(value)
+            return default if label is None else label
+
+        return cls(func, **kwargs)
+
+    def __call__(self, value):
+        # пропуски не запоминаем: разные объекты NaN не равны друг другу,
+        # а pd.NA (столбцы string и nullable) нельзя сравнивать через value != value
+        if pd.api.types.is_scalar(value) and pd.isna(value):
+            return self.func(value)
+        try:
+            return self._cache[value]
+        except KeyError:
+            pass
+        except TypeError:
+            return self.func(value)
+
+        label = self.func(value)
+        if len(self._cache) >= self.max_cache:
+            self._cache.clear()
+        self._cache[value] = label
+        return label
+
+    def map_series(self, series):
+        """
+        Группы для столбца: правило применяется только к уникальным значениям
+
+        Для столбца category результат - тоже category (правило - по списку категорий)
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes = series.cat.codes.to_numpy()
+            labels = [self(value) for value in series.cat.categories]
+            if (codes < 0).any():
+                labels.append(self(np.nan))
+                codes = np.where(codes < 0, len(labels) - 1, codes)
+            label_codes, groups = pd.factorize(np.array(labels, dtype=object))
+            return pd.Series(pd.Categorical.from_codes(label_codes[codes], groups), index=series.index)
+
+        codes, uniques = pd.factorize(series, use_na_sentinel=False)
+        labels = np.array([self(value) for value in uniques], dtype=object)
+        return pd.Series(labels[codes], index=series.index)
 
 
+EMAIL_MAPPER = RuleMapper.from_dict(EMAIL_MAPPING)
+ID_30_MAPPER = RuleMapper.from_patterns(ID_30_RULES)
+ID_31_MAPPER = RuleMapper.from_patterns(ID_31_RULES)
+ID_33_MAPPER = RuleMapper(get_ratio)
+DEVICE_INFO_MAPPER = RuleMapper.from_patterns(DEVICE_INFO_RULES, case=False)
+
+# исходный столбец -> (новый столбец, правило)
+GROUPED_COLS = {
+    'P_emaildomain_new': ('P_emaildomain_grouped', EMAIL_MAPPER),
+    'R_emaildomain_new': ('R_emaildomain_grouped', EMAIL_MAPPER),
+    'id_30_new': ('id_30_grouped', ID_30_MAPPER),
+    'id_31_new': ('id_31_grouped', ID_31_MAPPER),
+    'id_33_new': ('id_33_ratio', ID_33_MAPPER),
+    'DeviceInfo_new': ('DeviceInfo_brand', DEVICE_INFO_MAPPER),
+}
+
+
+def _fill_missing(series):
+    """fillna('missing'), для столбца category - с добавлением категории missing"""
+    if isinstance(series.dtype, pd.CategoricalDtype) and MISSING_CATEGORY not in series.cat.categories:
+        series = series.cat.add_categories(MISSING_CATEGORY)
+    return series.fillna(MISSING_CATEGORY)
+
+
+def preparing_cat_features(data: pd.DataFrame, features=None) -> pd.DataFrame:
+    """
+    Функция для преобразрвания категориальных признаков
+
+    Правила группировки (EMAIL_MAPPING, ID_30_RULES, ...) применяются к уникальным значениям
+    столбцов через RuleMapper. Столбцы category остаются category (utils/dtype_utils.py).
+    features - какие столбцы добавить (None - все)
+    """
+    columns = None if features is None else set(features)
+
+    # fillna 'missing'
+    for col in FILL_CAT_COLS:
+        if columns is None or f'{col}_new' in columns:
+            data[f'{col}_new'] = _fill_missing(data[col])
+
+    # email домены, id_30 (ОС), id_31 (браузер), id_33 (соотношение сторон экрана), DeviceInfo (бренд)
+    for col, (new_col, mapper) in GROUPED_COLS.items():
+        if columns is None or new_col in columns:
+            source = data[col] if col in data.columns else _fill_missing(data[col[:-len('_new')]])
+            data[new_col] = mapper.map_series(source)
+
+    return data
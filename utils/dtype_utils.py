@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import yaml
+
+# Компактные типы столбцов
+# Реестр - словарь столбец -> тип ('float32', 'int16', 'category', ...).
+# Типы подбираются без потери значений:
+# - float64 -> float32, если каждое значение (кроме пропусков) представимо в float32 точно
+# - целые -> самый узкий int (дробные в целые не переводятся: меняется их строковый вид,
+#   например в card_addr2_pair '45.0' стало бы '45')
+# - целые с пропусками в Parquet -> самый узкий nullable Int ('Int16', ...): pandas читает такие
+#   пачки как float64, поэтому диапазон и пропуски берутся из столбца Arrow, а не из пачки pandas
+# - строки с небольшим числом уникальных значений -> category (в Parquet - словарное кодирование)
+# Реестр применяется при чтении Parquet (read_features_parquet) по пачкам,
+# поэтому таблица в float64 / object целиком в памяти не появляется
+
+CATEGORY = 'category'
+
+INT_DTYPES = ['int8', 'int16', 'int32', 'int64']
+NULLABLE_INT_DTYPES = {dtype: dtype.capitalize() for dtype in INT_DTYPES}
+
+# целые, которые float32 хранит точно
+FLOAT32_EXACT_INT = 2 ** 24
+
+ARROW_TYPES = {
+    'float32': pa.float32(),
+    'float64': pa.float64(),
+    'int8': pa.int8(),
+    'int16': pa.int16(),
+    'int32': pa.int32(),
+    'int64': pa.int64(),
+    **{nullable: pa.type_for_alias(dtype) for dtype, nullable in NULLABLE_INT_DTYPES.items()},
+    'bool': pa.bool_(),
+}
+
+
+def _int_dtype(min_value, max_value):
+    """Самый узкий целый тип для диапазона [min_value, max_value]"""
+    for dtype in INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return dtype
+    return None
+
+
+class _ColumnStats:
+    """Статистики столбца для выбора типа, накапливаются по пачкам"""
+
+    def __init__(self, max_categories):
+        self.max_categories = max_categories
+        self.kind = None
+        self.rows = 0
+        self.float32_lossless = True
+        self.min = np.inf
+        self.max = -np.inf
+        self.has_nulls = False
+        self.values = set()
+
+    def update(self, series):
+        self.rows += len(series)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            self.kind = self.kind or CATEGORY
+            self._update_values(series.cat.categories)
+        elif pd.api.types.is_bool_dtype(series):
+            self.kind = self.kind or 'bool'
+        elif pd.api.types.is_integer_dtype(series):
+            self.kind = self.kind or 'int'
+            self._update_range(series.to_numpy())
+        elif pd.api.types.is_float_dtype(series):
+            # целые пачки уже были: float32 подходит, только если их диапазон в нем точен
+            if self.kind == 'int' and self.min <= self.max:
+                self.float32_lossless &= -FLOAT32_EXACT_INT <= self.min and self.max <= FLOAT32_EXACT_INT
+            self.kind = 'float'
+            self._update_float(series.to_numpy(dtype=np.float64))
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            self.kind = self.kind or 'object'
+            self._update_values(series.dropna().unique())
+        else:
+            self.kind = 'other'
+
+    def update_arrow_int(self, array):
+        """Целый столбец Arrow: диапазон и пропуски без перевода в pandas (там пачка с пропуском - float64)"""
+        self.rows += len(array)
+        self.kind = 'int'
+        self.has_nulls = self.has_nulls or array.null_count > 0
+        if array.null_count < len(array):
+            min_max = pc.min_max(array)
+            self.min = min(self.min, min_max['min'].as_py())
+            self.max = max(self.max, min_max['max'].as_py())
+
+    def _update_range(self, values):
+        if len(values):
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+
+    def _update_float(self, values):
+        if self.float32_lossless:
+            values = values[~np.isnan(values)]
+            self.float32_lossless = np.array_equal(values.astype(np.float32).astype(np.float64), values)
+
+    def _update_values(self, values):
+        if len(self.values) <= self.max_categories:
+            self.values.update(values)
+
+    def dtype(self, original, max_category_share):
+        if self.kind == 'int':
+            dtype = _int_dtype(self.min, self.max) if self.min <= self.max else None
+            if dtype is None:
+                return original
+            return NULLABLE_INT_DTYPES[dtype] if self.has_nulls else dtype
+        if self.kind == 'float':
+            return 'float32' if self.float32_lossless else 'float64'
+        if self.kind == CATEGORY:
+            return CATEGORY
+        if self.kind == 'object':
+            n_values = len(self.values)
+            if n_values <= self.max_categories and n_values <= max_category_share * max(self.rows, 1):
+                return CATEGORY
+        return original
+
+
+def infer_dtypes(data, max_category_share=0.5, max_categories=100_000):
+    """
+    Реестр компактных типов для таблицы в памяти
+
+    Args:
+        data: таблица
+        max_category_share: строковый столбец становится category, если уникальных значений
+            не больше этой доли строк
+        max_categories: и не больше этого количества
+    """
+    dtypes = {}
+    for col in data.columns:
+        stats = _ColumnStats(max_categories)
+        stats.update(data[col])
+        dtypes[col] = stats.dtype(str(data[col].dtype), max_category_share)
+    return dtypes
+
+
+def infer_parquet_dtypes(path, columns=None, batch_rows=200_000, max_category_share=0.5, max_categories=100_000):
+    """Реестр компактных типов для Parquet файла: один проход по пачкам, весь файл в память не читается"""
+    parquet_file = pq.ParquetFile(path)
+    stats = {}
+    originals = {}
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=columns):
+        frame = batch.to_pandas()
+        for col in frame.columns:
+            if col not in stats:
+                stats[col] = _ColumnStats(max_categories)
+                originals[col] = str(frame[col].dtype)
+            if col in batch.schema.names and pa.types.is_integer(batch.schema.field(col).type):
+                stats[col].update_arrow_int(batch.column(col))
+            else:
+                stats[col].update(frame[col])
+
+    return {col: stats[col].dtype(originals[col], max_category_share) for col in stats}
+
+
+def apply_dtypes(data, dtypes):
+    """
+    Привести столбцы data к типам реестра (на месте, по одному столбцу)
+
+    Столбцы, которых нет в реестре, не меняются
+    """
+    for col, dtype in dtypes.items():
+        if col in data.columns and str(data[col].dtype) != dtype:
+            data[col] = data[col].astype(dtype)
+    return data
+
+
+def _arrow_type(field, dtype):
+    if dtype == CATEGORY:
+        if pa.types.is_dictionary(field.type):
+            return field.type
+        return pa.dictionary(pa.int32(), field.type)
+    return ARROW_TYPES.get(dtype, field.type)
+
+
+def read_features_parquet(path, dtypes=None, columns=None, batch_rows=200_000):
+    """
+    Прочитать Parquet файл сразу в компактных типах
+
+    Каждая пачка приводится к типам реестра до объединения, поэтому в памяти одновременно
+    не больше одной пачки в исходных типах. Столбцы category приходят словарями Arrow и
+    становятся pd.Categorical с общим списком категорий на весь столбец, nullable Int -
+    переводятся отдельно, без промежуточного float64
+
+    Args:
+        path: путь к Parquet файлу
+        dtypes: реестр типов (None - подобрать по файлу через infer_parquet_dtypes)
+        columns: какие столбцы читать (None - все)
+        batch_rows: размер пачки
+    """
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    if dtypes is None:
+        dtypes = infer_parquet_dtypes(path, columns, batch_rows)
+
+    # индекс pandas хранится отдельными столбцами, читаем их всегда, как pd.read_parquet
+    if columns is not None:
+        index_cols = [col for col in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(col, str)]
+        columns = list(columns) + [col for col in index_cols if col not in columns]
+
+    fields = [schema.field(name) for name in (columns if columns is not None else schema.names)]
+    target = pa.schema(
+        [pa.field(field.name, _arrow_type(field, dtypes.get(field.name))) for field in fields],
+        metadata=schema.metadata,
+    )
+
+    batches = [
+        pa.Table.from_batches([batch]).select(target.names).cast(target)
+        for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=columns)
+    ]
+    table = pa.concat_tables(batches) if batches else target.empty_table()
+    del batches
+
+    nullable = {
+        name: pd.api.types.pandas_dtype(dtypes[name]) for name in target.names
+        if dtypes.get(name) in NULLABLE_INT_DTYPES.values()
+    }
+    extension = {name: table.column(name) for name in nullable}
+    data = table.drop_columns(list(nullable)).to_pandas(split_blocks=True, self_destruct=True)
+    del table
+
+    names = [name for name in target.names if name in data.columns or name in extension]
+    for name, column in extension.items():
+        values = column.to_pandas(types_mapper={column.type: nullable[name]}.get)
+        data.insert(names.index(name), name, values.array)
+    return data
+
+
+def save_dtypes(dtypes, path):
+    with open(path, 'w') as stream:
+        yaml.safe_dump(dict(dtypes), stream, sort_keys=False, allow_unicode=True)
+
+
+def load_dtypes(path):
+    with open(path) as stream:
+        return yaml.safe_load(stream)
+
+
+def memory_usage_mb(data):
+    """Память таблицы в МБ (строки и категории учитываются полностью)"""
+    return data.memory_usage(deep=True).sum() / 2 ** 20
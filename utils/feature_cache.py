@@ -0,0 +1,225 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.card_features_utils import CARD_FEATURE_INPUTS, make_card_features
+from utils.cat_features_utils import FILL_CAT_COLS, GROUPED_COLS, preparing_cat_features
+from utils.time_features_utils import WINDOWS, make_time_window_features, time_window_columns
+
+logger = logging.getLogger(__name__)
+
+# Кэш результатов построителей признаков
+# Ключ - хеш входных столбцов (значения, порядок строк, dtype), параметров построителя
+# и исходного кода его модуля (и модулей utils, из которых он импортирует).
+# В файле cache_dir/<ключ>.parquet хранятся только построенные столбцы и, если построитель
+# меняет порядок строк, номера исходных строк (__row__).
+# Размер каталога ограничен max_bytes: при переполнении удаляются файлы, к которым
+# дольше всего не обращались (время обращения - mtime файла)
+
+ROW_COLUMN = '__row__'
+METADATA_KEY = b'feature_cache'
+
+
+def _cat_columns(data, params):
+    features = params.get('features')
+    outputs = [f'{col}_new' for col in FILL_CAT_COLS]
+    outputs += [new_col for new_col, _ in GROUPED_COLS.values()]
+    if features is not None:
+        outputs = [col for col in outputs if col in set(features)]
+    inputs = [col for col in FILL_CAT_COLS + list(GROUPED_COLS) if col in data.columns]
+    return inputs, outputs
+
+
+def _time_columns(data, params):
+    features = params.get('features')
+    outputs = [col for w in WINDOWS for col in time_window_columns(w)]
+    if features is not None:
+        outputs = [col for col in outputs if col in set(features)]
+    return [params.get('group_col', 'card1'), 'TransactionDT', 'TransactionAmt'], outputs
+
+
+def _card_columns(data, params):
+    features = params.get('features')
+    outputs = [col for col in CARD_FEATURE_INPUTS if features is None or col in set(features)]
+    inputs = [params.get('group_col', 'card1')]
+    if params.get('point_in_time'):
+        inputs.append('TransactionDT')
+    for col in outputs:
+        inputs += [dep for dep in CARD_FEATURE_INPUTS[col] if dep in data.columns and dep not in inputs]
+    return inputs, outputs
+
+
+# построитель -> функция (data, params) -> (входные столбцы, выходные столбцы)
+BUILDER_COLUMNS = {
+    preparing_cat_features: _cat_columns,
+    make_time_window_features: _time_columns,
+    make_card_features: _card_columns,
+}
+
+
+def _hash_columns(data, columns):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(len(data)).encode())
+    for col in columns:
+        series = data[col]
+        digest.update(f'{col}:{series.dtype}'.encode())
+        digest.update(pd.util.hash_pandas_object(series, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def source_version(func):
+    """Хеш исходного кода модуля func и модулей utils, из которых он что-то импортирует"""
+    module = sys.modules[func.__module__]
+    modules = {module.__name__}
+    for value in vars(module).values():
+        name = getattr(value, '__module__', None) or ''
+        if name.startswith('utils.') or name == 'utils':
+            modules.add(name)
+
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(modules):
+        digest.update(inspect.getsource(sys.modules[name]).encode())
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Кэш построителей признаков на диске
+
+    Пример:
+        cache = FeatureCache('./data/feature_cache')
+        data = cache.build(preparing_cat_features, data)
+        data = cache.build(make_time_window_features, data)
+        data = cache.build(make_card_features, data, point_in_time=True)
+
+    Повторный запуск с теми же входными столбцами, параметрами и кодом построителя
+    читает результат с диска. В отличие от самих построителей, build не меняет data
+    на месте - используется возвращаемая таблица
+
+    Args:
+        cache_dir: каталог кэша
+        max_bytes: максимальный размер каталога
+    """
+
+    def __init__(self, cache_dir='./data/feature_cache', max_bytes=5 * 2 ** 30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, builder, data, **params):
+        """Ключ кэша для builder(data, **params)"""
+        inputs, _ = BUILDER_COLUMNS[builder](data, params)
+        payload = {
+            'builder': f'{builder.__module__}.{builder.__name__}',
+            'source': source_version(builder),
+            'params': {name: sorted(value) if isinstance(value, (set, frozenset)) else value
+                       for name, value in params.items()},
+            'inputs': _hash_columns(data, inputs),
+        }
+        text = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f'{key}.parquet'
+
+    def build(self, builder, data, **params):
+        """
+        builder(data, **params) с кэшем
+
+        builder - один из BUILDER_COLUMNS: по нему определяется, какие столбцы
+        входят в ключ и какие сохраняются
+        """
+        key = self.key(builder, data, **params)
+        path = self._path(key)
+
+        if path.exists():
+            try:
+                result = self._load(path, data)
+            except (OSError, pa.ArrowException, KeyError, ValueError) as exc:
+                logger.warning('Не удалось прочитать кэш %s: %s', path.name, exc)
+            else:
+                os.utime(path)
+                logger.info('%s: из кэша %s', builder.__name__, key)
+                return result
+
+        started = time.perf_counter()
+        frame = data.copy(deep=False)
+        frame.index = pd.RangeIndex(len(frame))
+        result = builder(frame, **params)
+        logger.info('%s: %.1f с, сохранение в кэш %s', builder.__name__, time.perf_counter() - started, key)
+
+        self._save(path, builder, data, result, params)
+        self.evict()
+
+        rows = result.index.to_numpy()
+        result.index = data.index[rows]
+        return result
+
+    def _save(self, path, builder, data, result, params):
+        _, outputs = BUILDER_COLUMNS[builder](data, params)
+        outputs = set(outputs)
+        columns = [col for col in result.columns if col in outputs or col not in data.columns]
+
+        stored = result[columns].reset_index(drop=True)
+        rows = result.index.to_numpy()
+        if not np.array_equal(rows, np.arange(len(rows))):
+            stored[ROW_COLUMN] = rows
+
+        table = pa.Table.from_pandas(stored, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[METADATA_KEY] = json.dumps({'columns': list(result.columns)}).encode()
+        table = table.replace_schema_metadata(metadata)
+
+        tmp_path = path.with_suffix('.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _load(self, path, data):
+        table = pq.read_table(path)
+        columns = json.loads(table.schema.metadata[METADATA_KEY])['columns']
+        stored = table.to_pandas(split_blocks=True, self_destruct=True)
+
+        if ROW_COLUMN in stored.columns:
+            result = data.take(stored.pop(ROW_COLUMN).to_numpy())
+        else:
+            result = data.copy(deep=False)
+        stored.index = result.index
+
+        result = pd.concat([result.drop(columns=[col for col in stored.columns if col in result.columns]), stored],
+                           axis=1, copy=False)
+        if list(result.columns) != columns:
+            result = result.reindex(columns=columns, copy=False)
+        return result
+
+    def size(self):
+        """Размер кэша в байтах"""
+        return sum(path.stat().st_size for path in self.cache_dir.glob('*.parquet'))
+
+    def evict(self):
+        """
+        Удалить давно не использованные файлы, пока кэш больше max_bytes
+
+        Последний использованный файл не удаляется, даже если он один больше max_bytes
+        """
+        files = sorted(self.cache_dir.glob('*.parquet'), key=lambda path: path.stat().st_mtime)
+        total = sum(path.stat().st_size for path in files)
+        for path in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+            logger.info('Кэш: удален %s', path.name)
+
+    def clear(self):
+        for path in self.cache_dir.glob('*.parquet'):
+            path.unlink(missing_ok=True)
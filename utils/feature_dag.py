@@ -0,0 +1,203 @@
+import time
+from dataclasses import dataclass
+
+import pandas as pd
+
+from utils.card_features_utils import CARD_FEATURE_INPUTS, make_card_features
+from utils.cat_features_utils import FILL_CAT_COLS, GROUPED_COLS, preparing_cat_features
+from utils.config_utils import read_yaml
+from utils.time_features_utils import WINDOWS, time_window_columns, time_window_context, time_window_features
+
+
+@dataclass
+class FeatureNode:
+    """
+    Вершина графа признаков
+
+    name - имя вершины (в отчете о времени)
+    inputs - выход вершины -> столбцы и промежуточные значения, от которых он зависит
+    func - func(context, outputs) строит нужные выходы: столбцы добавляет в context.data,
+           промежуточные значения (intermediate=True) возвращает словарем
+    """
+    name: str
+    inputs: dict
+    func: object
+    intermediate: bool = False
+
+    @property
+    def outputs(self):
+        return list(self.inputs)
+
+
+class FeatureContext:
+    """Таблица, в которую добавляются признаки, и общие промежуточные значения вершин"""
+
+    def __init__(self, data):
+        self.data = data
+        self.values = {}
+
+
+class FeatureGraph:
+    """
+    Граф построения признаков: по списку нужных признаков выполняются только
+    вершины, от которых они зависят, и только с нужными выходами
+
+    sort_by - по каким столбцам один раз отсортировать таблицу перед расчетом
+    """
+
+    def __init__(self, nodes=(), sort_by=None):
+        self.sort_by = sort_by
+        self.nodes = []
+        self._producers = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for output in node.outputs:
+            if output in self._producers:
+                raise ValueError(f'{output} уже строит вершина {self._producers[output].name}')
+            self._producers[output] = node
+        self.nodes.append(node)
+
+    def plan(self, targets, available=()):
+        """
+        Какие вершины выполнить для targets: [(вершина, выходы)] в порядке выполнения
+
+        Столбцы без вершины берутся из таблицы (available), иначе - KeyError
+        """
+        available = set(available)
+        needed = {}
+        state = {}
+
+        # нужные выходы каждой вершины
+        def visit(name):
+            node = self._producers.get(name)
+            if node is None:
+                if name not in available:
+                    raise KeyError(f'Нет ни столбца, ни вершины для {name}')
+                return
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError(f'Цикл в графе признаков на {name}')
+
+            state[name] = 'visiting'
+            for dependency in node.inputs[name]:
+                visit(dependency)
+            state[name] = 'done'
+            needed.setdefault(node.name, []).append(name)
+
+        for target in targets:
+            visit(target)
+
+        # порядок вершин: вершина после всех вершин, выходы которых ей нужны
+        nodes = {node.name: node for node in self.nodes}
+        order = []
+        placed = set()
+
+        def place(node_name, path=()):
+            if node_name in placed:
+                return
+            if node_name in path:
+                raise ValueError(f'Цикл между вершинами: {" -> ".join(path + (node_name,))}')
+            node = nodes[node_name]
+            for output in needed[node_name]:
+                for dependency in node.inputs[output]:
+                    producer = self._producers.get(dependency)
+                    if producer is not None and producer.name != node_name:
+                        place(producer.name, path + (node_name,))
+            placed.add(node_name)
+            order.append((node, [output for output in node.outputs if output in needed[node_name]]))
+
+        for node in self.nodes:
+            if node.name in needed:
+                place(node.name)
+
+        return order
+
+    def build(self, data, targets):
+        """
+        Построить признаки targets
+
+        Returns:
+            таблица с исходными и построенными столбцами,
+            отчет о времени по вершинам (node, outputs, seconds)
+        """
+        timings = []
+
+        started = time.perf_counter()
+        if self.sort_by:
+            data = data.sort_values(self.sort_by)
+        else:
+            # столбцы добавляются в копию, исходные массивы общие
+            data = data.copy(deep=False)
+        timings.append({'node': 'sort', 'outputs': 0, 'seconds': time.perf_counter() - started})
+
+        context = FeatureContext(data)
+        for node, outputs in self.plan(targets, available=data.columns):
+            started = time.perf_counter()
+            values = node.func(context, outputs)
+            if node.intermediate:
+                context.values.update(values)
+            timings.append({'node': node.name, 'outputs': len(outputs), 'seconds': time.perf_counter() - started})
+
+        return context.data, pd.DataFrame(timings)
+
+
+def _cat_node(context, outputs):
+    preparing_cat_features(context.data, outputs)
+
+
+def _card_node(point_in_time):
+    def func(context, outputs):
+        make_card_features(context.data, point_in_time=point_in_time, features=outputs)
+    return func
+
+
+def _time_context_node(context, outputs):
+    return {'_time_context': time_window_context(context.data)}
+
+
+def _time_window_node(w):
+    def func(context, outputs):
+        features = time_window_features(context.values['_time_context'], w, set(outputs))
+        for col, values in features.items():
+            context.data[col] = values
+    return func
+
+
+def default_feature_graph(point_in_time=False):
+    """
+    Граф для preparing_cat_features, make_time_window_features и make_card_features
+
+    Таблица сортируется по (card1, TransactionDT), как после make_time_window_features,
+    поэтому значения совпадают с последовательным запуском построителей
+    """
+    card_inputs = ['card1', 'TransactionDT'] if point_in_time else ['card1']
+
+    nodes = [
+        FeatureNode('cat_missing', {f'{col}_new': [col] for col in FILL_CAT_COLS}, _cat_node),
+        FeatureNode('cat_grouped', {new_col: [col] for col, (new_col, _) in GROUPED_COLS.items()}, _cat_node),
+        FeatureNode('time_context', {'_time_context': ['card1', 'TransactionDT', 'TransactionAmt']},
+                    _time_context_node, intermediate=True),
+    ]
+    for w in WINDOWS:
+        nodes.append(FeatureNode(f'time_{w}h', {col: ['_time_context'] for col in time_window_columns(w)},
+                                 _time_window_node(w)))
+    nodes.append(FeatureNode('card', {col: card_inputs + inputs for col, inputs in CARD_FEATURE_INPUTS.items()},
+                             _card_node(point_in_time)))
+
+    return FeatureGraph(nodes, sort_by=['card1', 'TransactionDT'])
+
+
+def load_target_features(*paths):
+    """Признаки модели из yaml: FINAL_FEATURES (features.yaml) или список (eng_features.yaml)"""
+    features = []
+    for path in paths:
+        config = read_yaml(path)
+        if isinstance(config, dict):
+            config = config.get('FINAL_FEATURES', [])
+        for feature in config or []:
+            if feature not in features:
+                features.append(feature)
+    return features
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.dtype_utils import read_features_parquet
+from utils.feature_dag import default_feature_graph
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def partition_ids(keys, n_partitions):
+    """
+    Номер партиции для каждого значения ключа (карты)
+
+    Числовые ключи хешируются как float64, поэтому 123 и 123.0 попадают в одну партицию,
+    все пропуски - в одну общую
+    """
+    keys = pd.Series(keys)
+    if pd.api.types.is_numeric_dtype(keys):
+        values = keys.to_numpy(dtype=float)
+    else:
+        values = keys.astype(str).to_numpy(dtype=object)
+    return (pd.util.hash_array(values) % np.uint64(n_partitions)).astype(np.int64)
+
+
+def _partition_path(directory, partition):
+    return Path(directory) / f'part={partition:04d}.parquet'
+
+
+def partition_transactions(source, partitions_dir, n_partitions, key='card1', batch_rows=200_000, columns=None):
+    """
+    Разбить Parquet файл транзакций на n_partitions файлов по хешу key
+
+    Файл читается пачками по batch_rows строк, поэтому в памяти одновременно
+    не больше одной пачки; все транзакции одной карты попадают в одну партицию
+
+    Returns:
+        количество строк в каждой партиции
+    """
+    partitions_dir = Path(partitions_dir)
+    partitions_dir.mkdir(parents=True, exist_ok=True)
+
+    source_file = pq.ParquetFile(source)
+    writers = {}
+    rows = np.zeros(n_partitions, dtype=np.int64)
+    try:
+        for batch in source_file.iter_batches(batch_size=batch_rows, columns=columns):
+            table = pa.Table.from_batches([batch])
+            ids = partition_ids(table.column(key).to_pandas(), n_partitions)
+
+            # одна перестановка на пачку, дальше - срезы по партициям
+            order = np.argsort(ids, kind='stable')
+            table = table.take(pa.array(order))
+            counts = np.bincount(ids, minlength=n_partitions)
+
+            offset = 0
+            for partition in np.flatnonzero(counts):
+                if partition not in writers:
+                    writers[partition] = pq.ParquetWriter(_partition_path(partitions_dir, partition), table.schema)
+                writers[partition].write_table(table.slice(offset, counts[partition]))
+                offset += counts[partition]
+            rows += counts
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return rows
+
+
+def process_partition(input_path, output_path, targets, point_in_time=False, dtypes=None):
+    """
+    Построить признаки targets для одной партиции и записать результат
+
+    Файл пишется во временный и переименовывается, поэтому незавершенная
+    партиция не выглядит готовой. dtypes - реестр типов (utils/dtype_utils.py),
+    в которых читается партиция
+
+    Returns:
+        количество строк, время обработки и отчет о времени по вершинам графа
+    """
+    started = time.perf_counter()
+    data = pd.read_parquet(input_path) if dtypes is None else read_features_parquet(input_path, dtypes)
+    graph = default_feature_graph(point_in_time=point_in_time)
+    data, timings = graph.build(data, targets)
+
+    output_path = Path(output_path)
+    tmp_path = output_path.with_suffix('.tmp')
+    data.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+
+    return len(data), time.perf_counter() - started, timings.to_dict('records')
+
+
+def all_features(point_in_time=False):
+    """Все признаки, которые строит граф (без промежуточных значений)"""
+    graph = default_feature_graph(point_in_time=point_in_time)
+    return [output for node in graph.nodes if not node.intermediate for output in node.outputs]
+
+
+def _read_manifest(path):
+    if path.exists():
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    return None
+
+
+def _write_manifest(path, manifest):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_partitioned_pipeline(source, work_dir, targets=None, n_partitions=64, n_workers=None,
+                             key='card1', batch_rows=200_000, columns=None, point_in_time=False, dtypes=None):
+    """
+    Построение признаков для данных, которые не помещаются в память
+
+    1. source (Parquet) разбивается по хешу card1 на n_partitions файлов: work_dir/partitions
+    2. Каждая партиция обрабатывается графом признаков (utils/feature_dag.py) в отдельном
+       процессе; в памяти процесса - только его партиция
+    3. Результат - набор Parquet файлов work_dir/features/part=NNNN.parquet
+       (читается целиком через pyarrow.dataset или pd.read_parquet(work_dir / 'features'))
+
+    Прогресс хранится в work_dir/manifest.json: повторный запуск с теми же параметрами
+    пропускает разбиение, если оно завершено, и уже обработанные партиции
+
+    Args:
+        source: путь к Parquet файлу транзакций
+        work_dir: каталог для партиций, результата и манифеста
+        targets: какие признаки строить (None - все)
+        n_partitions: на сколько частей разбить данные (больше частей - меньше памяти на процесс)
+        n_workers: сколько процессов (None - по числу ядер)
+        key: ключ разбиения; агрегаты по карте требуют, чтобы вся карта была в одной партиции
+        batch_rows: размер пачки при разбиении
+        columns: какие столбцы source читать (None - все)
+        point_in_time: агрегаты по карте только по более ранним транзакциям
+        dtypes: реестр компактных типов для чтения партиций (None - типы source)
+
+    Returns:
+        pd.DataFrame: отчет по партициям (partition, rows, seconds) и времени вершин графа
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = work_dir / MANIFEST_NAME
+    partitions_dir = work_dir / 'partitions'
+    features_dir = work_dir / 'features'
+
+    targets = list(targets) if targets is not None else all_features(point_in_time)
+    params = {
+        'source': str(Path(source).resolve()),
+        'n_partitions': n_partitions,
+        'key': key,
+        'columns': columns,
+        'targets': targets,
+        'point_in_time': point_in_time,
+        'dtypes': dtypes,
+    }
+
+    manifest = _read_manifest(manifest_path)
+    if manifest is not None and manifest['params'] != params:
+        raise ValueError(f'{work_dir} уже используется с другими параметрами, укажите другой каталог')
+    if manifest is None:
+        manifest = {'params': params, 'partitioned': False, 'rows': None, 'done': {}}
+
+    # 1. разбиение
+    if not manifest['partitioned']:
+        started = time.perf_counter()
+        shutil.rmtree(partitions_dir, ignore_errors=True)
+        rows = partition_transactions(source, partitions_dir, n_partitions, key, batch_rows, columns)
+        manifest.update(partitioned=True, rows=rows.tolist(), done={})
+        _write_manifest(manifest_path, manifest)
+        logger.info('Разбиение на %s партиций: %.1f с', n_partitions, time.perf_counter() - started)
+
+    # 2. партиции, которые еще не обработаны
+    features_dir.mkdir(parents=True, exist_ok=True)
+    pending = [
+        partition for partition in range(n_partitions)
+        if manifest['rows'][partition] and str(partition) not in manifest['done']
+    ]
+    logger.info('Партиций к обработке: %s из %s', len(pending), n_partitions)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(
+                process_partition,
+                _partition_path(partitions_dir, partition),
+                _partition_path(features_dir, partition),
+                targets,
+                point_in_time,
+                dtypes,
+            ): partition
+            for partition in pending
+        }
+        for future in as_completed(futures):
+            partition = futures[future]
+            rows, seconds, timings = future.result()
+            manifest['done'][str(partition)] = {
+                'rows': rows,
+                'seconds': seconds,
+                'timings': timings,
+            }
+            _write_manifest(manifest_path, manifest)
+            logger.info('Партиция %s: %s строк', partition, rows)
+
+    report = [
+        {'partition': int(partition), 'rows': info['rows'], 'seconds': info['seconds'],
+         **{f"{timing['node']}_seconds": timing['seconds'] for timing in info['timings']}}
+        for partition, info in manifest['done'].items()
+    ]
+    if not report:
+        return pd.DataFrame(columns=['partition', 'rows', 'seconds'])
+    return pd.DataFrame(report).sort_values('partition', ignore_index=True)
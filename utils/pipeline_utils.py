@@ -16,15 +16,18 @@ class CustomPreprocessor(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X):
-        X = X.copy()
+        # неглубокая копия: заменяемые столбцы присваиваются целиком, остальные массивы общие с X
+        X = X.copy(deep=False)
         for col in self.cat_features:
             if col in X.columns:
-                if X[col].dtype == "object":  # or X[col].nunique() == 2:
-                    X[col] = X[col].astype("category")
-
-                if X[col].dtype == "category":
-                    X[col] = X[col].cat.add_categories("MISSING")
-                    X[col] = X[col].fillna("MISSING")
+                values = X[col]
+                if values.dtype == "object":  # or X[col].nunique() == 2:
+                    values = values.astype("category")
+
+                if values.dtype == "category":
+                    if "MISSING" not in values.cat.categories:
+                        values = values.cat.add_categories("MISSING")
+                    X[col] = values.fillna("MISSING")
 
         return X
 
@@ -1 +1,2 @@
 from .stability import StabilityIndexCalculator, psi_plot
+from .monitor import PSIMonitor
@@ -0,0 +1,234 @@
+import pickle
+
+import pandas as pd
+import numpy as np
+
+import logging
+
+from .stability import StabilityIndexCalculator
+
+logger = logging.getLogger(__name__)
+
+
+class PSIMonitor:
+	"""Streaming PSI on fitted variables.
+	Batches of rows (scored transactions, prediction history, feature store rows) are binned
+	with saved fit (StabilityIndexCalculator.save_fit) and only bin counts per period are kept,
+	raw values are not stored. PSI of period or sliding window is calculated from counts - O(bins).
+
+	Memory is bounded by max_periods: when new period appears and there are more periods,
+	the oldest are dropped. Rows of dropped periods that come later are skipped.
+
+	Example
+	------------
+	monitor = PSIMonitor.from_fit("psi_fit.pkl", max_periods=90)
+	monitor.update(batch, period_col="date")
+	monitor.psi()              # periods x variables
+	monitor.window_psi(7)      # variables, last 7 periods together
+
+	Init params
+	------------
+	fit_data: dict
+		StabilityIndexCalculator.fit_data (after fit/calculate or load_fit)
+
+	var_names: list, default None
+		Variables to monitor. None - all fitted variables.
+
+	max_periods: int, default 90
+		Number of last periods to keep counts for.
+	"""
+
+	def __init__(self, fit_data, var_names=None, max_periods=90):
+		self.calculator = StabilityIndexCalculator()
+		self.calculator.fit_data = fit_data
+		fitted = [key for key, value in fit_data.items() if isinstance(value, dict) and "var_cnt_exp" in value]
+		self.var_names = fitted if var_names is None else list(var_names)
+		missing = [var for var in self.var_names if var not in fitted]
+		if missing:
+			raise ValueError(f"Variables were not fitted: {missing}")
+		self.max_periods = max_periods
+
+		# counts[var][period] - array of bin counts (bins + missing + out of interval), as var_cnt_exp
+		self.counts = {var: {} for var in self.var_names}
+		self.periods = []
+		self.dropped_before = None
+		self.n_skipped = 0
+
+	@classmethod
+	def from_fit(cls, path, var_names=None, max_periods=90):
+		"""Monitor on fit saved by StabilityIndexCalculator.save_fit"""
+		calculator = StabilityIndexCalculator()
+		calculator.load_fit(path)
+		return cls(calculator.fit_data, var_names=var_names, max_periods=max_periods)
+
+	def update(self, batch: pd.DataFrame, period_col=None, period=None):
+		"""
+		Add batch of rows to counts.
+
+		Parameters
+		----------
+		batch: pd.DataFrame
+			Rows with monitored variables (variables absent in batch are skipped).
+
+		period_col: str, default None
+			Column with period of every row (date, month, etc. - any sortable values).
+
+		period: default None
+			Period of the whole batch, if period_col is not given.
+		"""
+		if period_col is None:
+			if period is None:
+				raise ValueError("period_col or period must be given")
+			period_codes = np.zeros(len(batch), dtype=np.int64)
+			batch_periods = [period]
+		else:
+			period_codes, batch_periods = pd.factorize(batch[period_col], sort=True)
+			batch_periods = list(batch_periods)
+
+		# rows of periods that were already dropped
+		if self.dropped_before is not None:
+			old = np.array([p <= self.dropped_before for p in batch_periods], dtype=bool)
+			if old.any():
+				skip = (period_codes >= 0) & old[np.maximum(period_codes, 0)]
+				self.n_skipped += int(skip.sum())
+				logger.warning(f"{int(skip.sum())} rows of dropped periods were skipped")
+				period_codes = np.where(skip, -1, period_codes)
+
+		valid = period_codes >= 0
+		n_periods = len(batch_periods)
+		for _var in self.var_names:
+			if _var not in batch.columns:
+				continue
+			bin_codes, n_cols = self._bin_codes(batch[_var], _var)
+			counts = np.bincount(
+				period_codes[valid] * n_cols + bin_codes[valid], minlength=n_periods * n_cols
+			).reshape(n_periods, n_cols)
+			var_counts = self.counts[_var]
+			for i, _period in enumerate(batch_periods):
+				if counts[i].any():
+					if _period in var_counts:
+						var_counts[_period] += counts[i]
+					else:
+						var_counts[_period] = counts[i]
+
+		present = np.bincount(period_codes[valid], minlength=n_periods) > 0
+		known = set(self.periods)
+		new_periods = [p for i, p in enumerate(batch_periods) if present[i] and p not in known]
+		if new_periods:
+			self.periods = sorted(self.periods + new_periods)
+			self._drop_old_periods()
+
+		return self
+
+	def _bin_codes(self, variable: pd.Series, var_name):
+		"""Bin of every value as in predict: 0..n-1 - bins, n - missing, n + 1 - out of interval"""
+		calc = self.calculator
+		fit_data = calc.fit_data[var_name]
+		n_cols = len(fit_data["var_cnt_exp"])
+
+		# numerical fit, values could come as strings/objects (json records)
+		if np.asarray(fit_data["bins"]).dtype.kind in "fiu" and variable.dtype == object:
+			variable = pd.to_numeric(variable, errors="coerce")
+
+		binned = calc._bin_codes(variable, var_name)
+		if binned is not None:
+			return binned[0], n_cols
+
+		# not supported by fast binning - same binning as predict, categories are in var_cnt_exp order
+		calc._vn = var_name
+		bin_var, _ = calc.bin_variable(variable, bins=fit_data["bins"], n_bins=fit_data["n_bins"])
+		return bin_var.cat.codes.to_numpy().astype(np.int64), n_cols
+
+	def _drop_old_periods(self):
+		if len(self.periods) <= self.max_periods:
+			return
+		dropped = self.periods[:-self.max_periods]
+		self.periods = self.periods[-self.max_periods:]
+		for var_counts in self.counts.values():
+			for _period in dropped:
+				var_counts.pop(_period, None)
+		self.dropped_before = dropped[-1]
+
+	def _psi(self, var_name, counts):
+		"""PSI per row of counts matrix (rows x bins)"""
+		fit_data = self.calculator.fit_data[var_name]
+		n = len(fit_data["var_cnt_exp"]) - 2
+		totals = counts.sum(axis=1, keepdims=True)
+		shares = np.divide(counts, totals, out=np.zeros(counts.shape), where=totals > 0)
+		psi = self.calculator._psi_from_shares(fit_data, shares, n)
+		psi[totals[:, 0] == 0] = np.nan
+		return psi
+
+	def _counts_matrix(self, var_name, periods):
+		n_cols = len(self.calculator.fit_data[var_name]["var_cnt_exp"])
+		var_counts = self.counts[var_name]
+		counts = np.zeros((len(periods), n_cols), dtype=np.int64)
+		for i, _period in enumerate(periods):
+			if _period in var_counts:
+				counts[i] = var_counts[_period]
+		return counts
+
+	def psi(self, var_names=None, periods=None):
+		"""PSI per period (rows) and variable (columns). NaN - no rows of variable in period"""
+		var_names = self.var_names if var_names is None else var_names
+		periods = self.periods if periods is None else list(periods)
+		res = {_var: self._psi(_var, self._counts_matrix(_var, periods)) for _var in var_names}
+		return pd.DataFrame(res, index=pd.Index(periods, name="period"), columns=var_names)
+
+	def window_psi(self, n_periods=None, start=None, end=None, var_names=None):
+		"""
+		PSI of several periods together (counts are summed), per variable.
+		n_periods - last n periods, or periods between start and end (inclusive).
+		"""
+		var_names = self.var_names if var_names is None else var_names
+		periods = self.periods
+		if start is not None:
+			periods = [p for p in periods if p >= start]
+		if end is not None:
+			periods = [p for p in periods if p <= end]
+		if n_periods is not None:
+			periods = periods[-n_periods:]
+
+		res = {}
+		for _var in var_names:
+			counts = self._counts_matrix(_var, periods).sum(axis=0, keepdims=True)
+			res[_var] = self._psi(_var, counts)[0]
+		return pd.Series(res, name=self.calculator.psi_str, dtype=float)
+
+	def bin_counts(self, var_name, periods=None):
+		"""Bin counts of variable: rows - bins as in var_cnt_exp, columns - periods"""
+		periods = self.periods if periods is None else list(periods)
+		counts = self._counts_matrix(var_name, periods)
+		index = self.calculator.fit_data[var_name]["var_cnt_exp"].index
+		return pd.DataFrame(counts.T, index=index, columns=pd.Index(periods, name="period"))
+
+	def n_obs(self, periods=None):
+		"""Number of rows per period (rows) and variable (columns)"""
+		periods = self.periods if periods is None else list(periods)
+		res = {_var: self._counts_matrix(_var, periods).sum(axis=1) for _var in self.var_names}
+		return pd.DataFrame(res, index=pd.Index(periods, name="period"), columns=self.var_names)
+
+	############# saving / loading  ###################
+
+	def save_state(self, path):
+		"""Save counts to continue monitoring after restart"""
+		state = {
+			"var_names": self.var_names,
+			"max_periods": self.max_periods,
+			"counts": self.counts,
+			"periods": self.periods,
+			"dropped_before": self.dropped_before,
+			"n_skipped": self.n_skipped,
+		}
+		with open(path, "wb") as f:
+			pickle.dump(state, f)
+
+	def load_state(self, path):
+		with open(path, "rb") as f:
+			state = pickle.load(f)
+		missing = [var for var in state["var_names"] if var not in self.calculator.fit_data]
+		if missing:
+			raise ValueError(f"Saved counts of variables that are not in fit: {missing}")
+		for key, value in state.items():
+			setattr(self, key, value)
+		return self
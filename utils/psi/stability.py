@@ -2,6 +2,12 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
 import pickle
+import copy
+import gc
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing.shared_memory import SharedMemory
 
 from math import isinf
 import pandas as pd
@@ -74,8 +80,9 @@ class StabilityIndexCalculator:
 		variable_n_bins={},
 		return_bin_counts=False,
 		verbose=False,
-		from_sql=None,  # Experimental TODO
+		from_sql=None,
 		distrib_targ=None,
+		n_jobs=None,
 	):
 		"""
 		Calculate PSI for a variable on pandas dataframe.
@@ -86,7 +93,7 @@ class StabilityIndexCalculator:
 		Parameters
 		----------
 		df: pd.DataFrame
-			Data
+			Data. Not used (could be None) with from_sql.
 
 		var_names: list
 			Names of columns in dataframe
@@ -131,6 +138,18 @@ class StabilityIndexCalculator:
 			Special parameter to calculate not normalised distribution of observation counts over some binned variable bins,
 			but to calculate normalised mean of some other target variable over this bins and normalization happens by expected variable sum.
 			This could answer questions like - Is the mean target of bins of this variable changed?
+
+		n_jobs: int, default None
+			Number of processes to fit and bin variables in parallel (-1 - all cores, None or 1 - no parallelism).
+			Group codes and variable columns are passed to workers through shared memory,
+			workers return fit data and (group, bin) counts. Used only in PSI mode without from_sql.
+
+		from_sql: dict, default None
+			Calculate on SQL table instead of df: {"sql_table": table name, "connection": connection for pd.read_sql,
+			"vars_per_query": number of variables in one counts query, default 50}.
+			Only rows of initial group are read for fit (none if fit=False). Fitted bins are compiled into
+			CASE WHEN expressions and database returns only (variable, group, bin, count) rows.
+			PSI mode only, fit_mask is not supported.
 		"""
 
 		group_col_counts = self._calc_group_col_counts(df, group_col, from_sql)
@@ -159,6 +178,12 @@ class StabilityIndexCalculator:
 			else:
 				expected_len = group_col_counts["counts"].mean()
 
+		if from_sql is not None:
+			return self._calculate_sql(
+				from_sql, var_names, group_col, group_col_counts, fit, fit_mask, expected_len, n_bins, variable_n_bins,
+				distrib_targ, exclude_miss, exclude_out_int, bin_edge_std, variable_bins, return_bin_counts, verbose,
+			)
+
 		if df[group_col].isna().any():
 			logger.info(
 				"[INFO] Found empty values in grouping column. Values will be ingnored"
@@ -166,18 +191,51 @@ class StabilityIndexCalculator:
 
 		result_stats = {}
 
-		for _var in var_names:
-			if verbose:
-				print(f"Calculating {_var}")
+		# PSI mode: groups are found once and shared by all variables
+		group_index = self._group_index(df, group_col) if distrib_targ is None else None
+		psi_tab_args = None
 
-			_fit_s = self._fit_calc_routine(df, fit, fit_mask, _var, group_col, expected_len, n_bins, variable_n_bins,
-					from_sql, distrib_targ, exclude_miss, exclude_out_int, bin_edge_std, variable_bins)
+		# variables fitted and binned in worker processes
+		parallel = (n_jobs not in (None, 1)) and (group_index is not None) and (from_sql is None)
+		if parallel:
+			if fit and fit_mask is None:
+				fit_mask = df[group_col] == self.initial_val
+			remote = _ParallelBinCounts(
+				self, df, var_names, *group_index, fit, fit_mask, n_jobs,
+				dict(expected_len=expected_len, n_bins=n_bins, variable_n_bins=variable_n_bins, exclude_miss=exclude_miss,
+					exclude_out_int=exclude_out_int, bin_edge_std=bin_edge_std, variable_bins=variable_bins),
+			)
+		else:
+			remote = nullcontext({})
+
+		with remote as remote:
+			for _var in var_names:
+				if verbose:
+					print(f"Calculating {_var}")
+
+				bin_counts = None
+				if _var in remote:
+					_fit_s, bin_counts = remote.get(_var)
+				else:
+					_fit_s = self._fit_calc_routine(df, fit, fit_mask, _var, group_col, expected_len, n_bins, variable_n_bins,
+							from_sql, distrib_targ, exclude_miss, exclude_out_int, bin_edge_std, variable_bins)
 
-			# check if fit were successfull
-			if not (isinstance(_fit_s, str) and _fit_s == "error"):
-				df_stats = self._stats_calc_routine(df, _var, group_col, distrib_targ)
+				# check if fit were successfull
+				if not (isinstance(_fit_s, str) and _fit_s == "error"):
+					if bin_counts is None and group_index is not None and _var not in remote:
+						bin_counts = self._count_bins(df[_var], _var, group_index[1], len(group_index[0]))
 
-				result_stats[_var] = df_stats
+					if bin_counts is None:
+						df_stats = self._stats_calc_routine(df, _var, group_col, distrib_targ)
+						psi_tab_args = None
+					else:
+						df_stats, psi_tab_args = self._stats_from_counts(_var, group_index[0], *bin_counts)
+
+					result_stats[_var] = df_stats
+
+		# psi table of the last predicted group, as left by predict
+		if psi_tab_args is not None:
+			self.psi_tab = self._make_psi_table(*psi_tab_args)
 
 		if return_bin_counts:
 			return result_stats, self.calc_bins_counts.copy()
@@ -189,7 +247,11 @@ class StabilityIndexCalculator:
 		if from_sql is not None:
 			sql_table = from_sql["sql_table"]
 			connection = from_sql["connection"]
-			counts_script = f"SELECT {group_col}, COUNT(*) AS COUNTS FROM {sql_table} GROUP BY {group_col} ORDER BY {group_col}"
+			counts_script = f"""SELECT {group_col}, COUNT(*) AS counts
+						FROM {sql_table}
+						WHERE {group_col} IS NOT NULL
+						GROUP BY {group_col}
+						ORDER BY {group_col}"""
 			group_col_counts = pd.read_sql(counts_script, con=connection)
 		else:
 			group_col_counts = (
@@ -204,14 +266,6 @@ class StabilityIndexCalculator:
 
 	def _fit_calc_routine(self, df, fit, fit_mask, _var, group_col, expected_len, n_bins, variable_n_bins,
 			from_sql, distrib_targ, exclude_miss, exclude_out_int, bin_edge_std, variable_bins):
-		if from_sql is not None:
-			sql_table = from_sql["sql_table"]
-			connection = from_sql["connection"]
-			var_script = f"""SELECT {_var}, {group_col}
-						FROM {sql_table}
-						"""
-			df = pd.read_sql(var_script, con=connection)
-
 		if fit:
 			# check n_bins
 			_var_n_bins = variable_n_bins.get(_var, n_bins)
@@ -284,6 +338,332 @@ class StabilityIndexCalculator:
 		return df_stats
 
 
+	def _group_index(self, df, group_col):
+		"""Groups as in df.groupby(group_col, observed=False) and group number of each row (-1 - empty key)"""
+		n_obs = df.groupby(group_col, observed=False)[group_col].count()
+		group_codes = n_obs.index.get_indexer(df[group_col])
+
+		return n_obs, group_codes
+
+	def _count_bins(self, variable: pd.Series, var_name, group_codes, n_groups):
+		"""
+		Same result as predict on every group, but without predict call per group:
+		every value is mapped to its fitted bin once and (group, bin) pairs are counted with one bincount.
+		Compact result of binning variable by groups:
+		counts[group, bin] (bins: 0..n-1 - fitted bins, n - missing, n + 1 - out of interval), n,
+		variable mean per group (None for not numeric) and index of predict counts.
+		None if variable can't be binned by _bin_codes.
+		"""
+		binned = self._bin_codes(variable, var_name)
+		if binned is None:
+			return None
+		bin_codes, n = binned
+		n_cols = n + 2
+
+		valid = group_codes >= 0
+		counts = np.bincount(
+			group_codes[valid] * n_cols + bin_codes[valid], minlength=n_groups * n_cols
+		).reshape(n_groups, n_cols)
+
+		# var mean, same as groupby(group_col).mean()
+		var_mean = None
+		if pd.api.types.is_numeric_dtype(variable):
+			var_mean = variable.groupby(group_codes).mean().reindex(np.arange(n_groups)).to_numpy()
+
+		# index of predict counts is needed only for groups with values
+		has_values = (counts.sum(axis=1) - counts[:, n]) > 0
+		obs_index = self._bins_index(variable, self.fit_data[var_name]) if has_values.any() else None
+
+		return counts, n, var_mean, obs_index
+
+	def _stats_from_counts(self, _var, n_obs, counts, n, var_mean, obs_index):
+		"""
+		Stats table and PSI per group from _count_bins result, same as _stats_calc_routine in PSI mode.
+		PSI of all groups is calculated on the counts matrix.
+		Updates calc_bins_counts / calc_bins_nobs as predict on every group would do.
+		Returns stats and arguments of _make_psi_table for the last group (predict keeps its table in self.psi_tab).
+		"""
+		fit_data = self.fit_data[_var]
+		n_groups = len(n_obs)
+		totals = counts.sum(axis=1)
+
+		# groups without values: predict puts whole share to missing
+		empty = (totals - counts[:, n]) == 0
+		var_cnt_obs = np.zeros(counts.shape)
+		np.divide(counts, totals[:, None], out=var_cnt_obs, where=~empty[:, None])
+		var_cnt_obs[empty, n] = 1
+
+		psi = self._psi_from_shares(fit_data, var_cnt_obs, n)
+
+		# side effects of predict: counts tables (one column per group) and data for the last psi table
+		self._vn = _var
+		exp_index = fit_data["var_cnt_exp"].index
+		groups = list(n_obs.index)
+		nobs = [var_cnt_obs[i] if empty[i] else counts[i] for i in range(n_groups)]
+		if n_groups:
+			# value_counts names index by the group
+			first_index = exp_index if empty[0] else obs_index.rename(groups[0])
+			self._update_calc_counts_block(self.calc_bins_counts, _var, groups, list(var_cnt_obs), first_index)
+			self._update_calc_counts_block(self.calc_bins_nobs, _var, groups, nobs, first_index)
+
+			last_index = exp_index if empty[-1] else obs_index.rename(groups[-1])
+			psi_tab_args = (
+				fit_data["var_cnt_exp"],
+				pd.Series(var_cnt_obs[-1], index=last_index, name=groups[-1]),
+				False,
+				pd.Series(nobs[-1], index=last_index, name=groups[-1]),
+			)
+		else:
+			psi_tab_args = None
+
+		df_stats = pd.DataFrame()
+		df_stats["n_obs"] = n_obs
+		df_stats["n_nans"] = pd.Series(counts[:, n], index=n_obs.index)
+
+		df_stats["hitrate"] = (
+			df_stats["n_obs"] - df_stats["n_nans"]
+		) / df_stats["n_obs"]
+
+		# var mean
+		if var_mean is not None:
+			df_stats['var_mean'] = pd.Series(var_mean, index=n_obs.index)
+		else:
+			df_stats['var_mean'] = np.nan
+
+		df_stats[self.psi_str] = pd.Series(psi, index=n_obs.index, name=_var)
+
+		return df_stats, psi_tab_args
+
+	def _bin_codes(self, variable: pd.Series, var_name):
+		"""
+		Fitted bin of every value as in predict: 0..n-1 - bins, n - missing, n + 1 - out of interval.
+		Numerical - searchsorted on bin edges (same as pd.cut with right=True), categorical - lookup of category codes.
+		Returns (codes, n) or None if variable is not supported.
+		"""
+		fit_data = self.fit_data.get(var_name)
+		if fit_data is None:
+			return None
+		bins = fit_data["bins"]
+
+		if pd.api.types.is_bool_dtype(variable):
+			return None
+
+		if pd.api.types.is_numeric_dtype(variable):
+			edges = np.asarray(bins, dtype=float)
+			if edges.ndim != 1 or len(edges) < 2 or not (np.diff(edges) > 0).all():
+				return None
+			n = len(edges) - 1
+			values = variable.to_numpy(dtype=float, na_value=np.nan)
+			# bin i is (edges[i], edges[i + 1]]
+			codes = np.searchsorted(edges, values, side="left") - 1
+			codes[(codes < 0) | (codes >= n)] = n + 1
+			codes[np.isnan(values)] = n
+		else:
+			bins = np.array(bins)
+			categories = pd.Index(bins[~pd.isnull(bins)])
+			if not categories.is_unique:
+				return None
+			n = len(categories)
+			value_codes, uniques = pd.factorize(variable)
+			lookup = categories.get_indexer(uniques)
+			lookup[lookup < 0] = n + 1
+			# factorize code -1 (missing) takes the last element
+			codes = np.append(lookup, n)[value_codes]
+
+		if n + 2 != len(fit_data["var_cnt_exp"]):
+			return None
+
+		return codes.astype(np.int64), n
+
+	def _bins_index(self, variable: pd.Series, fit_data):
+		"""Index of predict counts (bins + missing + out of interval), made on empty variable"""
+		bin_var, _ = self.bin_variable(variable.iloc[:0], bins=fit_data["bins"], n_bins=fit_data["n_bins"])
+		return self._normalised_counts(bin_var)[0].index
+
+	def _psi_from_shares(self, fit_data, var_cnt_obs, n):
+		"""PSI per row of shares matrix (groups x bins), same operations as _make_psi_table + _calculate_total_psi"""
+		fill = 0.5 / fit_data["expected_len"]
+		var_exp = fit_data["var_cnt_exp"].to_numpy(dtype=float)
+		var_exp = np.where(var_exp == 0, fill, var_exp)
+		var_obs = np.where(var_cnt_obs == 0, fill, var_cnt_obs)
+
+		psi_bins = (var_obs - var_exp) * np.log(var_obs / var_exp)
+		if fit_data["exclude_miss"]:
+			psi_bins[:, n] = 0
+		if fit_data["exclude_out_int"]:
+			psi_bins[:, n + 1] = 0
+
+		return psi_bins.sum(axis=1)
+
+	############ SQL pushdown ##############################
+
+	def _calculate_sql(self, from_sql, var_names, group_col, group_col_counts, fit, fit_mask, expected_len, n_bins,
+			variable_n_bins, distrib_targ, exclude_miss, exclude_out_int, bin_edge_std, variable_bins, return_bin_counts,
+			verbose):
+		"""
+		calculate on SQL table. Database returns only counts per (variable, group, bin):
+		fitted bins of every variable are compiled into CASE WHEN bin expression (_sql_bin_expr)
+		and several variables are counted in one UNION ALL query.
+		Variables which bins can't be compiled are read row by row as before.
+		"""
+		if distrib_targ is not None:
+			raise ValueError("from_sql supports only PSI mode (distrib_targ=None)")
+		if fit_mask is not None:
+			raise ValueError("fit_mask is not supported with from_sql, use initial_val")
+
+		sql_table = from_sql["sql_table"]
+		connection = from_sql["connection"]
+		vars_per_query = from_sql.get("vars_per_query", 50)
+
+		n_obs = pd.Series(
+			group_col_counts["counts"].to_numpy(),
+			index=pd.Index(group_col_counts[group_col], name=group_col),
+			name=group_col,
+		)
+
+		# fit on rows of initial group only
+		if fit:
+			fit_script = f"""SELECT {', '.join(var_names)}
+						FROM {sql_table}
+						WHERE {group_col} = {_sql_literal(self.initial_val)}
+						"""
+			df_fit = pd.read_sql(fit_script, con=connection)
+			fit_mask = np.ones(len(df_fit), dtype=bool)
+			fitted = []
+			for _var in var_names:
+				_fit_s = self._fit_calc_routine(df_fit, fit, fit_mask, _var, group_col, expected_len, n_bins,
+						variable_n_bins, None, None, exclude_miss, exclude_out_int, bin_edge_std, variable_bins)
+				if not (isinstance(_fit_s, str) and _fit_s == "error"):
+					fitted.append(_var)
+			del df_fit
+		else:
+			fitted = [_var for _var in var_names if _var in self.fit_data]
+
+		bin_exprs = {_var: self._sql_bin_expr(_var) for _var in fitted}
+		pushdown = [_var for _var in fitted if bin_exprs[_var] is not None]
+		bin_counts = {}
+		for i in range(0, len(pushdown), vars_per_query):
+			chunk = pushdown[i:i + vars_per_query]
+			bin_counts.update(self._sql_bin_counts(chunk, bin_exprs, group_col, sql_table, connection, n_obs.index))
+
+		result_stats = {}
+		psi_tab_args = None
+		for _var in fitted:
+			if verbose:
+				print(f"Calculating {_var}")
+			if _var in bin_counts:
+				df_stats, psi_tab_args = self._stats_from_counts(_var, n_obs, *bin_counts[_var])
+			else:
+				var_script = f"""SELECT {_var}, {group_col}
+							FROM {sql_table}
+							"""
+				df = pd.read_sql(var_script, con=connection)
+				df_stats = self._stats_calc_routine(df, _var, group_col, None)
+				psi_tab_args = None
+			result_stats[_var] = df_stats
+
+		if psi_tab_args is not None:
+			self.psi_tab = self._make_psi_table(*psi_tab_args)
+
+		if return_bin_counts:
+			return result_stats, self.calc_bins_counts.copy()
+
+		return result_stats
+
+	def _sql_bin_expr(self, var_name):
+		"""
+		CASE WHEN expression with bin code of fitted variable, as _bin_codes:
+		0..n-1 - bins, n - missing, n + 1 - out of interval.
+		Returns (expression, n, numeric) or None if bins can't be compiled.
+		"""
+		fit_data = self.fit_data[var_name]
+		bins = np.array(fit_data["bins"])
+		n_cols = len(fit_data["var_cnt_exp"])
+
+		if bins.dtype.kind in "fiu":
+			edges = bins.astype(float)
+			if edges.ndim != 1 or len(edges) < 2 or np.isnan(edges).any() or not (np.diff(edges) > 0).all():
+				return None
+			n = len(edges) - 1
+			# bin i is (edges[i], edges[i + 1]]
+			whens = [f"WHEN {var_name} IS NULL THEN {n}"]
+			if np.isinf(edges[0]):
+				# only -inf is <= -inf, infinity literals are not portable
+				whens.append(f"WHEN {var_name} < {_sql_literal(-np.finfo(float).max)} THEN {n + 1}")
+			else:
+				whens.append(f"WHEN {var_name} <= {_sql_literal(edges[0])} THEN {n + 1}")
+			for i, edge in enumerate(edges[1:]):
+				if np.isinf(edge):
+					whens.append(f"WHEN {var_name} IS NOT NULL THEN {i}")
+				else:
+					whens.append(f"WHEN {var_name} <= {_sql_literal(edge)} THEN {i}")
+			numeric = True
+		else:
+			categories = pd.Index(bins[~pd.isnull(bins)])
+			if not categories.is_unique:
+				return None
+			n = len(categories)
+			whens = [f"WHEN {var_name} IS NULL THEN {n}"]
+			whens += [f"WHEN {var_name} = {_sql_literal(cat)} THEN {i}" for i, cat in enumerate(categories)]
+			numeric = False
+
+		if n + 2 != n_cols:
+			return None
+
+		return f"CASE {' '.join(whens)} ELSE {n + 1} END", n, numeric
+
+	def _sql_bin_counts(self, var_names, bin_exprs, group_col, sql_table, connection, groups):
+		"""
+		One UNION ALL query with (group, bin) counts of variables.
+		Returns {variable: _count_bins result}, groups - index of groups as in n_obs.
+		"""
+		selects = []
+		for _var in var_names:
+			expr, n, numeric = bin_exprs[_var]
+			var_sum = f"SUM({_var})" if numeric else "NULL"
+			selects.append(
+				f"""SELECT {_sql_literal(_var)} AS var_name, {group_col} AS group_val, {expr} AS bin,
+						COUNT(*) AS counts, {var_sum} AS var_sum
+					FROM {sql_table}
+					WHERE {group_col} IS NOT NULL
+					GROUP BY {group_col}, {expr}"""
+			)
+		res = pd.read_sql("\nUNION ALL\n".join(selects), con=connection)
+
+		n_groups = len(groups)
+		bin_counts = {}
+		for _var, rows in res.groupby("var_name", sort=False):
+			_, n, numeric = bin_exprs[_var]
+			group_codes = groups.get_indexer(rows["group_val"])
+			bins = rows["bin"].to_numpy(dtype=np.int64)
+			valid = group_codes >= 0
+			counts = np.zeros((n_groups, n + 2), dtype=np.int64)
+			np.add.at(counts, (group_codes[valid], bins[valid]), rows["counts"].to_numpy(dtype=np.int64)[valid])
+
+			var_mean = None
+			if numeric:
+				var_sum = np.zeros(n_groups)
+				np.add.at(var_sum, group_codes[valid], rows["var_sum"].to_numpy(dtype=float, na_value=0)[valid])
+				n_values = counts.sum(axis=1) - counts[:, n]
+				var_mean = np.full(n_groups, np.nan)
+				np.divide(var_sum, n_values, out=var_mean, where=n_values > 0)
+
+			has_values = (counts.sum(axis=1) - counts[:, n]) > 0
+			obs_index = None
+			if has_values.any():
+				empty_var = pd.Series([], dtype=float if numeric else object, name=_var)
+				obs_index = self._bins_index(empty_var, self.fit_data[_var])
+
+			bin_counts[_var] = (counts, n, var_mean, obs_index)
+
+		# variables without rows in groups
+		for _var in var_names:
+			if _var not in bin_counts:
+				_, n, _ = bin_exprs[_var]
+				bin_counts[_var] = (np.zeros((n_groups, n + 2), dtype=np.int64), n, None, None)
+
+		return bin_counts
+
 	def fit(
 		self,
 		var_exp: pd.Series,
@@ -836,11 +1216,13 @@ class StabilityIndexCalculator:
 		"""variable n_unique should be higher than q"""
 		min_bucket_size = (len(variable) / q) * self.min_bin_coeff
 
-		bins, bucket_sizes = find_adaptive_qcut_bins(variable, q, self.left_minv)
+		# sorting and counting once for all q
+		unique_counts = sorted_unique_counts(variable)
+		bins, bucket_sizes = find_adaptive_qcut_bins(variable, q, self.left_minv, unique_counts)
 
 		while (bucket_sizes.min() < min_bucket_size) & (q > 1):
 			q = q - 1
-			bins, bucket_sizes = find_adaptive_qcut_bins(variable, q)
+			bins, bucket_sizes = find_adaptive_qcut_bins(variable, q, unique_counts=unique_counts)
 
 		return bins
 
@@ -867,6 +1249,33 @@ class StabilityIndexCalculator:
 		else:
 			self.calc_bins_nobs[var_name][base_counts.name] = base_counts.values
 
+	def _update_calc_counts_block(self, tabs, var_name, names, columns, index):
+		"""Same as _update_calc_counts_tab(fit=False) for each column in turn, but new columns are added at once"""
+		tab = tabs.get(var_name)
+		if tab is None:
+			tab = pd.DataFrame(index=index)
+
+		new_columns = {}
+		for name, values in zip(names, columns):
+			if name in tab.columns:
+				tab[name] = values
+			else:
+				new_columns[name] = values
+
+		if new_columns:
+			# column labels as after inserting columns one by one
+			labels = tab.columns
+			for name in new_columns:
+				labels = labels.insert(len(labels), name)
+			values = list(new_columns.values())
+			if len({_v.dtype for _v in values}) == 1:
+				block = pd.DataFrame(np.column_stack(values), index=tab.index)
+			else:
+				block = pd.DataFrame(dict(enumerate(values)), index=tab.index)
+			tab = pd.concat([tab, block], axis=1) if len(tab.columns) else block
+			tab.columns = labels
+		tabs[var_name] = tab
+
 	########### Output formatting utils ##################
 
 	def _beautify_index_bins(self, index, symbols=3):
@@ -940,8 +1349,239 @@ class StabilityIndexCalculator:
 		return filter_cols
 
 
+# SQL
+def _sql_literal(value):
+	"""Value as SQL literal (floats with repr - exact)"""
+	if value is None or (isinstance(value, float) and np.isnan(value)):
+		return "NULL"
+	if isinstance(value, (bool, np.bool_)):
+		return str(int(value))
+	if isinstance(value, (int, np.integer)):
+		return str(int(value))
+	if isinstance(value, (float, np.floating)):
+		return repr(float(value))
+	if isinstance(value, pd.Timestamp):
+		value = value.isoformat(sep=" ")
+	value = str(value).replace("'", "''")
+	return f"'{value}'"
+
+
+# PARALLEL CALCULATION
+def _shared_view(shm, spec):
+	offset, dtype, shape = spec
+	return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+
+
+class _SharedArrays:
+	"""numpy arrays in one shared memory block. specs - {key: (offset, dtype, shape)}"""
+
+	def __init__(self, arrays):
+		self.specs = {}
+		offset = 0
+		for key, values in arrays.items():
+			self.specs[key] = (offset, values.dtype.str, values.shape)
+			offset += -(-values.nbytes // 8) * 8
+		self.shm = SharedMemory(create=True, size=max(offset, 8))
+		self.name = self.shm.name
+		for key, values in arrays.items():
+			_shared_view(self.shm, self.specs[key])[...] = values
+
+	def close(self):
+		self.shm.close()
+		self.shm.unlink()
+
+
+def _encode_column(series):
+	"""Column -> (numpy array for shared memory, how to restore it), None if column can't be shared"""
+	dtype = series.dtype
+	if isinstance(dtype, pd.CategoricalDtype):
+		return series.cat.codes.to_numpy(), ("category", dtype)
+	if dtype == object:
+		codes, uniques = pd.factorize(series)
+		# code -1 (missing) takes the last element
+		return codes, ("object", np.append(np.asarray(uniques, dtype=object), np.nan))
+	if isinstance(dtype, np.dtype):
+		return series.to_numpy(), ("numpy", None)
+	return None
+
+
+def _decode_column(values, how, name):
+	kind, info = how
+	if kind == "category":
+		return pd.Series(pd.Categorical.from_codes(values, dtype=info), name=name)
+	if kind == "object":
+		return pd.Series(info[values], name=name)
+	return pd.Series(values, name=name, copy=False)
+
+
+def _count_bins_worker(task):
+	"""Fit (if needed) and _count_bins for a chunk of variables. Columns are read from shared memory"""
+	calculator = task["calculator"]
+	kw = task["fit_kwargs"]
+	common = SharedMemory(name=task["common"][0])
+	chunk = SharedMemory(name=task["chunk"][0])
+	results = {}
+	try:
+		group_codes = _shared_view(common, task["common"][1]["group_codes"])
+		fit_mask = _shared_view(common, task["common"][1]["fit_mask"]) if task["fit"] else None
+
+		for _var, how in task["columns"].items():
+			variable = _decode_column(_shared_view(chunk, task["chunk"][1][_var]), how, _var)
+
+			_fit_s = calculator._fit_calc_routine(
+				variable.to_frame(), task["fit"], fit_mask, _var, None, kw["expected_len"], kw["n_bins"],
+				kw["variable_n_bins"], None, None, kw["exclude_miss"], kw["exclude_out_int"], kw["bin_edge_std"],
+				kw["variable_bins"],
+			)
+			if isinstance(_fit_s, str) and _fit_s == "error":
+				results[_var] = (_fit_s, None, None)
+				continue
+
+			fit_res = None
+			if task["fit"]:
+				fit_res = (
+					calculator.fit_data[_var], calculator.calc_bins_counts[_var], calculator.calc_bins_nobs[_var]
+				)
+			bin_counts = calculator._count_bins(variable, _var, group_codes, task["n_groups"])
+			results[_var] = (_fit_s if task["fit"] else "loaded", fit_res, bin_counts)
+			del variable
+	finally:
+		group_codes = fit_mask = None
+		gc.collect()
+		for shm in (common, chunk):
+			try:
+				shm.close()
+			except BufferError:
+				pass
+
+	return results
+
+
+class _ParallelBinCounts:
+	"""
+	StabilityIndexCalculator.calculate helper: fit and _count_bins of variables in a process pool.
+	Group codes, fit mask and variable columns are put to shared memory once,
+	workers get only block names and small fit params, return fit data and counts per variable.
+	Variables that can't be put to shared memory (extension dtypes) are left to the parent process.
+	"""
+
+	def __init__(self, calculator, df, var_names, n_obs, group_codes, fit, fit_mask, n_jobs, fit_kwargs):
+		self.calculator = calculator
+		self.df = df
+		self.var_names = list(dict.fromkeys(var_names))
+		self.n_groups = len(n_obs)
+		self.group_codes = group_codes
+		self.fit = fit
+		self.fit_mask = None if fit_mask is None else np.asarray(fit_mask, dtype=bool)
+		self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+		self.fit_kwargs = fit_kwargs
+		self._blocks = []
+		self._futures = {}
+		self._results = {}
+
+	def __enter__(self):
+		try:
+			self._submit()
+		except BaseException:
+			self.__exit__(None, None, None)
+			raise
+		return self
+
+	def __exit__(self, _type, value, traceback):
+		if getattr(self, "_executor", None) is not None:
+			self._executor.shutdown(wait=True, cancel_futures=True)
+		for block in self._blocks:
+			block.close()
+		self._blocks = []
+
+	def __contains__(self, var_name):
+		return var_name in self._futures
+
+	def _submit(self):
+		encoded = {}
+		for _var in self.var_names:
+			if self.fit or _var in self.calculator.fit_data:
+				column = _encode_column(self.df[_var])
+				if column is not None:
+					encoded[_var] = column
+		if not encoded:
+			return
+
+		common = {"group_codes": np.asarray(self.group_codes, dtype=np.int64)}
+		if self.fit:
+			common["fit_mask"] = self.fit_mask
+		common = _SharedArrays(common)
+		self._blocks.append(common)
+
+		# template calculator for workers: same params, only fit data of its variables
+		template = copy.copy(self.calculator)
+		template.calc_bins_counts = {}
+		template.calc_bins_nobs = {}
+		template.__dict__.pop("psi_tab", None)
+		base_fit_data = {key: self.calculator.fit_data[key] for key in ("initial_val", "expected_len") if key in self.calculator.fit_data}
+
+		self._executor = ProcessPoolExecutor(max_workers=self.n_jobs)
+		n_chunks = min(len(encoded), self.n_jobs * 4)
+		for chunk_vars in np.array_split(np.array(list(encoded), dtype=object), n_chunks):
+			chunk_vars = list(chunk_vars)
+			block = _SharedArrays({_var: encoded[_var][0] for _var in chunk_vars})
+			self._blocks.append(block)
+
+			calculator = copy.copy(template)
+			calculator.fit_data = dict(base_fit_data, bins_dict={})
+			if not self.fit:
+				calculator.fit_data.update({_var: self.calculator.fit_data[_var] for _var in chunk_vars})
+
+			fit_kwargs = dict(self.fit_kwargs)
+			fit_kwargs["variable_bins"] = {_var: fit_kwargs["variable_bins"][_var] for _var in chunk_vars if _var in fit_kwargs["variable_bins"]}
+
+			future = self._executor.submit(_count_bins_worker, {
+				"calculator": calculator,
+				"fit": self.fit,
+				"fit_kwargs": fit_kwargs,
+				"n_groups": self.n_groups,
+				"common": (common.name, common.specs),
+				"chunk": (block.name, block.specs),
+				"columns": {_var: encoded[_var][1] for _var in chunk_vars},
+			})
+			for _var in chunk_vars:
+				self._futures[_var] = future
+
+	def get(self, var_name):
+		"""Fit result and _count_bins result of variable, fit data is merged to the calculator"""
+		future = self._futures[var_name]
+		if var_name not in self._results:
+			self._results.update(future.result())
+		_fit_s, fit_res, bin_counts = self._results[var_name]
+
+		if fit_res is not None:
+			fit_data, counts_tab, nobs_tab = fit_res
+			calc = self.calculator
+			calc._vn = var_name
+			calc.fit_data[var_name] = fit_data
+			calc.fit_data["initial_val"] = calc.initial_val
+			calc.fit_data["expected_len"] = fit_data["expected_len"]
+			calc.fit_data["bins_dict"][var_name] = fit_data["bins"]
+			calc.calc_bins_counts[var_name] = counts_tab
+			calc.calc_bins_nobs[var_name] = nobs_tab
+
+		return _fit_s, bin_counts
+
+
 # ADAPTIVE QCUT
-def find_adaptive_qcut_bins(variable, q, left_minv=0.0001):
+def sorted_unique_counts(variable):
+	"""Sorted unique values (without nans) and their counts cumulative sum (starts with 0)"""
+	var = np.array(variable)
+	# not working with nans, they will stay inplace
+	var_notna = var[~np.isnan(var)]
+
+	var_unique, var_counts = np.unique(var_notna, return_counts=True)
+	var_cnt_csum = np.append([0], var_counts).cumsum()
+
+	return var_unique, var_cnt_csum
+
+
+def find_adaptive_qcut_bins(variable, q, left_minv=0.0001, unique_counts=None):
 	"""
 	Algorithm for finding optimal quantile bins.
 	Made for cases when one value has more than q repetions in variable.
@@ -949,21 +1589,17 @@ def find_adaptive_qcut_bins(variable, q, left_minv=0.0001):
 
 	Algorithm first assignes bins to quantiles as pd.qcut, but then instead of dropping
 	duplicate bins moves them to better positions if possible
-	"""
-	var = np.array(variable)
-	# not working with nans, they will stay inplace
-	var_notna = var[~np.isnan(var)].copy()
-	var_sorted = np.sort(var_notna)
 
-	# get counts
-	var_unique, var_counts = np.unique(var_sorted, return_counts=1)
-	var_counts = np.append([0], var_counts)
+	unique_counts - sorted_unique_counts(variable), to not sort variable again for every q
+	"""
+	if unique_counts is None:
+		unique_counts = sorted_unique_counts(variable)
+	var_unique, var_cnt_csum = unique_counts
 	var_unique = np.append([var_unique[0] - left_minv], var_unique)
 
-	assert (var_unique == np.sort(var_unique)).all()
+	assert var_unique[0] <= var_unique[1]
 
-	var_cnt_csum = var_counts.cumsum()
-	expected_len = len(var_sorted) / q
+	expected_len = var_cnt_csum[-1] / q
 
 	# initiate bins (qcut on unique values)
 	bins_cs_idxs = initiate_bins(q, var_cnt_csum, var_unique, expected_len)
@@ -980,14 +1616,11 @@ def find_adaptive_qcut_bins(variable, q, left_minv=0.0001):
 def initiate_bins(q, var_cnt_csum, var_unique, expected_len):
 	norm_cnt_csum = var_cnt_csum / expected_len
 	# look for closest value to expected_len
-	bins_cs_idxs = [0]
-	for i in range(1, q):
-		_idx = (norm_cnt_csum < i).sum()
-		if abs(norm_cnt_csum[_idx - 1] - i) > abs(norm_cnt_csum[_idx] - i):
-				bins_cs_idxs.append(_idx)
-		else:
-			bins_cs_idxs.append(_idx - 1)
-	bins_cs_idxs.append(len(var_unique) - 1)
+	# cumulative sum is sorted: number of values < i is searchsorted
+	quantiles = np.arange(1, q)
+	_idxs = np.searchsorted(norm_cnt_csum, quantiles, side="left")
+	right_closer = np.abs(norm_cnt_csum[_idxs - 1] - quantiles) > np.abs(norm_cnt_csum[_idxs] - quantiles)
+	bins_cs_idxs = [0] + list(np.where(right_closer, _idxs, _idxs - 1)) + [len(var_unique) - 1]
 	# or_bins = np.sort(np.unique(var_unique[bins_cs_idxs]))
 
 	# if qcut failed with duplicate edges, use unique elements
@@ -1023,7 +1656,6 @@ def initiate_bins(q, var_cnt_csum, var_unique, expected_len):
 def qcut_correction(q, bins_cs_idxs, var_cnt_csum):
 	bins_ids = np.arange(q + 1)
 	forbid_move_bins = np.array([])
-	metr_bucket_sizes = []
 	counter = 0
 	# while all bins expect edges are not forbidden to move
 	while (counter < q * 10) & (len(forbid_move_bins) != len(bins_ids) - 2):
@@ -1033,8 +1665,6 @@ def qcut_correction(q, bins_cs_idxs, var_cnt_csum):
 		)
 		bucket_sizes_diff = np.abs(bucket_sizes[:-1] - bucket_sizes[1:])
 
-		metr_bucket_sizes.append(np.std(bucket_sizes))
-
 		# reindex bin ids for bucket_sizes
 		forbid_buckets_idxs = np.unique(
 			np.clip(forbid_move_bins - 1, 0, max(bins_ids) - 1)
@@ -1059,7 +1689,7 @@ def qcut_correction(q, bins_cs_idxs, var_cnt_csum):
 			].sum()
 			/ 2
 		)
-		new_pos_idx = np.abs(var_cnt_csum - middle_cs_val).argmin()
+		new_pos_idx = closest_index(var_cnt_csum, middle_cs_val)
 
 		# if moved then releasing neighboors from forbid_move_bins
 		if prev_pos_idx != new_pos_idx:
@@ -1076,6 +1706,17 @@ def qcut_correction(q, bins_cs_idxs, var_cnt_csum):
 	return bins_cs_idxs
 
 
+def closest_index(sorted_arr, value):
+	"""np.abs(sorted_arr - value).argmin() for sorted array: binary search, ties to the lower index"""
+	_idx = np.searchsorted(sorted_arr, value, side="left")
+	if _idx == 0:
+		return 0
+	if _idx == len(sorted_arr):
+		return len(sorted_arr) - 1
+	if abs(sorted_arr[_idx - 1] - value) <= abs(sorted_arr[_idx] - value):
+		return _idx - 1
+	return _idx
+
 
 def psi_plot(psi_res: dict, n_cols=5, figsize=(24, 4), save_path=None):
 
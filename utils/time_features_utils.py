@@ -1,91 +1,187 @@
 import pandas as pd
 import numpy as np
+from pandas.api.indexers import BaseIndexer
 
 
 import warnings
 warnings.filterwarnings('ignore')
 
-def make_time_window_features(data, group_col='card1'):
+# окна в часах
+WINDOWS = [1, 6, 24, 72, 168]
+
+
+class TimeWindowIndexer(BaseIndexer):
+    """
+    Границы окон для rolling по всей таблице сразу
+
+    Окно строки i - строки [start[i], end[i]), то есть транзакции той же карты
+    с TransactionDT в (t_i - w, t_i], не позже самой строки
+    """
+
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None, closed=None, step=None):
+        return self.start, self.end
+
+
+def time_window_bounds(group_codes, times, w_sec):
+    """
+    Границы окон длиной w_sec секунд для данных, отсортированных по (карта, время)
+
+    Карта и время объединяются в один возрастающий ключ, поэтому левая граница
+    всех окон находится одним searchsorted и не выходит за пределы своей карты.
+    Строки без карты (код -1) получают пустое окно
+    """
+    n = len(times)
+    end = np.arange(1, n + 1, dtype=np.int64)
+    valid = group_codes >= 0
+    if not valid.any():
+        return end.copy(), end
+
+    # шаг между картами больше любого окна, поэтому окна разных карт не пересекаются
+    t_min = times[valid].min()
+    span = times[valid].max() - t_min + w_sec + 1
+    keys = np.where(valid, group_codes * span + (times - t_min), np.inf)
+
+    start = np.searchsorted(keys, keys - w_sec, side='right').astype(np.int64)
+    start[~valid] = end[~valid]
+    return start, end
+
+
+# признаки окна в порядке столбцов: f'{stat}_{w}h'
+WINDOW_STATS = ['count', 'amt_mean', 'amt_median', 'amt_min', 'amt_max', 'amt_sum', 'amt_std',
+                'amt_ratio_to_mean', 'amt_ratio_to_median', 'time_since_last', 'log_time_since_last',
+                'mean_gap', 'min_gap', 'max_gap']
+
+
+def time_window_columns(w):
+    """Столбцы, которые make_time_window_features строит для окна w часов"""
+    return [f'{stat}_{w}h' for stat in WINDOW_STATS]
+
+
+def time_window_context(data, group_col='card1'):
+    """
+    Общие для всех окон массивы по данным, отсортированным по (group_col, TransactionDT):
+    коды карт, время, суммы и интервалы до предыдущей транзакции карты
+    """
+    group_codes = pd.factorize(data[group_col], sort=True)[0]
+    times = data['TransactionDT'].to_numpy(dtype=float)
+    amount = data['TransactionAmt'].astype(float)
+
+    # интервал до предыдущей транзакции карты (у первой транзакции карты - NaN)
+    gaps = np.diff(times, prepend=np.nan)
+    gaps[np.r_[True, group_codes[1:] != group_codes[:-1]] | (group_codes < 0)] = np.nan
+    gaps = pd.Series(gaps, index=data.index)
+
+    # время с последней транзакции не зависит от окна
+    time_since_last = gaps.fillna(0)
+
+    return {
+        'group_codes': group_codes,
+        'times': times,
+        'amount': amount,
+        'gaps': gaps,
+        'time_since_last': time_since_last,
+        'log_time_since_last': np.log1p(time_since_last),
+    }
+
+
+def time_window_features(context, w, columns=None):
+    """
+    Признаки окна w часов по time_window_context
+
+    columns - какие столбцы нужны (None - все); промежуточные значения
+    (среднее и медиана для отношений) считаются, даже если их столбцы не нужны
+    """
+    def need(*stats):
+        return columns is None or any(f'{stat}_{w}h' in columns for stat in stats)
+
+    features = {}
+    if not need(*WINDOW_STATS):
+        return features
+
+    amount, gaps = context['amount'], context['gaps']
+    start, end = time_window_bounds(context['group_codes'], context['times'], w * 3600)
+    indexer = TimeWindowIndexer(start=start, end=end)
+
+    amt_roll = amount.rolling(indexer, min_periods=1)
+    gap_roll = gaps.rolling(indexer, min_periods=2)
+
+    # count
+    features[f'count_{w}h'] = pd.Series(
+        np.where(end > start, (end - start).astype(float), np.nan), index=amount.index)
+
+    # mean / median / min / max / sum
+    if need('amt_mean', 'amt_ratio_to_mean'):
+        features[f'amt_mean_{w}h'] = amt_roll.mean()
+    if need('amt_median', 'amt_ratio_to_median'):
+        features[f'amt_median_{w}h'] = amt_roll.median()
+    if need('amt_min'):
+        features[f'amt_min_{w}h'] = amt_roll.min()
+    if need('amt_max'):
+        features[f'amt_max_{w}h'] = amt_roll.max()
+    if need('amt_sum'):
+        features[f'amt_sum_{w}h'] = amt_roll.sum()
+
+    # std. 0, если точек меньше 2
+    if need('amt_std'):
+        features[f'amt_std_{w}h'] = amount.rolling(indexer, min_periods=2).std().fillna(0)
+
+    # div trans / mean
+    if need('amt_ratio_to_mean'):
+        features[f'amt_ratio_to_mean_{w}h'] = amount / (features[f'amt_mean_{w}h'] + 1)
+
+    # div trans / median
+    if need('amt_ratio_to_median'):
+        features[f'amt_ratio_to_median_{w}h'] = amount / (features[f'amt_median_{w}h'] + 1)
+
+
+    # deepseek
+    # --- Временные признаки ---
+
+    # Время с последней транзакции
+    features[f'time_since_last_{w}h'] = context['time_since_last']
+
+    # Логарифм времени с последней транзакции
+    features[f'log_time_since_last_{w}h'] = context['log_time_since_last']
+
+    # Средний / минимальный / максимальный интервал между транзакциями в окне
+    if need('mean_gap'):
+        features[f'mean_gap_{w}h'] = gap_roll.mean().fillna(0)
+    if need('min_gap'):
+        features[f'min_gap_{w}h'] = gap_roll.min().fillna(0)
+    if need('max_gap'):
+        features[f'max_gap_{w}h'] = gap_roll.max().fillna(0)
+
+    if columns is not None:
+        features = {col: value for col, value in features.items() if col in columns}
+    return features
+
+
+def make_time_window_features(data, group_col='card1', features=None):
     """
     Расчет временных окон по транзакциям для каждой карты (card1)
-    за разные окна (1ч, 6ч, 24ч, 7д):
-    - количество транзакций по карте 
+    за разные окна (1ч, 6ч, 24ч, 72ч, 7д) по TransactionDT:
+    - количество транзакций по карте
     - средняя, медианная, максимальная сумма по карте
     - стандартное отклонение суммы по карте
     - время с последней транзакции
     * + производные и временные признаки
-    
+
+    Данные сортируются по (card1, TransactionDT) один раз, границы окон считаются
+    через searchsorted, статистики - одним rolling по всей таблице на каждое окно.
+    features - какие столбцы строить (None - все)
+
     """
-    
-    data = data.sort_values([group_col, 'TransactionDT'])
 
-    # 
-    windows = [1, 6, 24, 72, 168]
-
-    for w in windows:
-        w_sec = w * 3600
-        
-        grouped = data.groupby(group_col)
-        
-        # count
-        data[f'count_{w}h'] = grouped['TransactionDT'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=1).count())
-        
-        # mean
-        data[f'amt_mean_{w}h'] = grouped['TransactionAmt'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=1).mean())
-        
-        # median
-        data[f'amt_median_{w}h'] = grouped['TransactionAmt'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=1).median())
-        
-        # min
-        data[f'amt_min_{w}h'] = grouped['TransactionAmt'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=1).min())
-        
-        # max
-        data[f'amt_max_{w}h'] = grouped['TransactionAmt'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=1).max())
-        
-        # sum
-        data[f'amt_sum_{w}h'] = grouped['TransactionAmt'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=1).sum())
-        
-        # std. 0, если точек меньше 2
-        data[f'amt_std_{w}h'] = grouped['TransactionAmt'].transform(
-            lambda x: x.rolling(window=w_sec, min_periods=2).std()).fillna(0)
-        
-        # div trans / mean
-        data[f'amt_ratio_to_mean_{w}h'] = data['TransactionAmt'] / (data[f'amt_mean_{w}h'] + 1)
-        
-        # div trans / median
-        data[f'amt_ratio_to_median_{w}h'] = data['TransactionAmt'] / (data[f'amt_median_{w}h'] + 1)
-        
-        
-        # deepseek
-        # --- Временные признаки ---
-        
-        # Время с последней транзакции
-        data[f'time_since_last_{w}h'] = grouped['TransactionDT'].transform(
-            lambda x: x.diff()).fillna(0)
-        
-        # Логарифм времени с последней транзакции
-        data[f'log_time_since_last_{w}h'] = np.log1p(data[f'time_since_last_{w}h'])
-        
-        # Средний интервал между транзакциями
-        data[f'mean_gap_{w}h'] = grouped['TransactionDT'].transform(
-            lambda x: x.diff().rolling(window=w_sec, min_periods=2).mean()).fillna(0)
-        
-        # Минимальный интервал
-        data[f'min_gap_{w}h'] = grouped['TransactionDT'].transform(
-            lambda x: x.diff().rolling(window=w_sec, min_periods=2).min()
-        ).fillna(0)
-        
-        # Максимальный интервал
-        data[f'max_gap_{w}h'] = grouped['TransactionDT'].transform(
-            lambda x: x.diff().rolling(window=w_sec, min_periods=2).max()
-        ).fillna(0)
+    data = data.sort_values([group_col, 'TransactionDT'])
+    context = time_window_context(data, group_col)
 
-    return data
+    columns = None if features is None else set(features)
+    window_features = {}
+    for w in WINDOWS:
+        window_features.update(time_window_features(context, w, columns))
 
+    data = data.drop(columns=[col for col in window_features if col in data.columns])
+    # copy=False: столбцы отсортированной таблицы не копируются еще раз
+    data = pd.concat([data, pd.DataFrame(window_features, index=data.index)], axis=1, copy=False)
 
+    return data